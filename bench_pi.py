@@ -0,0 +1,392 @@
+"""
+Benchmark del pipeline de pedidos de pi.py:
+    POST /hacer_trago -> pedidos_queue -> procesar_pedidos()
+
+Los pedidos entran por el test client de Flask y el worker real vierte sobre
+el driver de bombas simulado. El reloj es virtual y avanza solo cuando el
+worker está esperando un deadline o no tiene trabajo, así que una hora de
+evento se simula en segundos y los resultados son reproducibles.
+
+Uso:
+    python bench_pi.py                              # escenario 'evento'
+    python bench_pi.py --escenario rafaga --modo paralelo
+    python bench_pi.py --escenario rafaga --vasos 3   # estación multi-vaso
+    python bench_pi.py --guardar bench_base.json
+    python bench_pi.py --comparar bench_base.json   # código 1 si hay regresión
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+
+os.environ.setdefault('PI_GPIO_BACKEND', 'sim')
+os.environ.setdefault('PI_INVENTARIO', '')  # No pisar el inventario real
+os.environ.setdefault('PI_CALIBRACION', '')  # ...ni usar la calibración medida
+os.environ.setdefault('PI_LOG', '')  # Sin logs del worker mezclados con el reporte
+import pi
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+
+# ============================================
+# ESCENARIOS
+# ============================================
+# tasa: pedidos por hora (llegadas Poisson). rafaga: todos llegan juntos.
+ESCENARIOS = {
+    'tranquilo': {"pedidos": 60, "tasa": 30, "rafaga": False},
+    'evento': {"pedidos": 150, "tasa": 90, "rafaga": False},
+    'rafaga': {"pedidos": 40, "tasa": 0, "rafaga": True},
+}
+
+TOLERANCIA_DEFAULT = 0.05  # 5% de margen al comparar contra una base
+
+# ============================================
+# RELOJ VIRTUAL SINCRONIZADO
+# ============================================
+class RelojSincronizado:
+    """
+    Reloj virtual compartido entre el worker y el simulador. El worker se
+    bloquea en esperar_hasta() y el simulador decide cuándo avanzar el tiempo.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._ahora = 0
+        self._deadline = None
+
+    def monotonic_ns(self):
+        return self._ahora
+
+    def esperar_hasta(self, deadline_ns, interrumpir=None):
+        with self._cond:
+            if deadline_ns <= self._ahora:
+                return
+            self._deadline = deadline_ns
+            while self._ahora < deadline_ns:
+                self._cond.wait()
+            self._deadline = None
+
+    def esperando(self):
+        """Deadline por el que está bloqueado el worker (o None)"""
+        with self._cond:
+            if self._deadline is not None and self._deadline > self._ahora:
+                return self._deadline
+            return None
+
+    def avanzar(self, t_ns):
+        with self._cond:
+            if t_ns > self._ahora:
+                self._ahora = t_ns
+            self._cond.notify_all()
+
+class ColaInstrumentada(pi.PlanificadorPedidos):
+    """Planificador que además sabe si el worker está bloqueado esperando pedidos"""
+    def __init__(self):
+        super().__init__()
+        self.ocioso = False
+        self.admitidos = []
+
+    def _put(self, item):
+        self.admitidos.append(item)
+        super()._put(item)
+
+    def get(self, block=True, timeout=None):
+        self.ocioso = True
+        return super().get(block, timeout)
+
+    def _get(self):
+        self.ocioso = False
+        return super()._get()
+
+    def en_reposo(self):
+        with self.mutex:
+            return self.ocioso and not self._qsize()
+
+# ============================================
+# SIMULADOR
+# ============================================
+class Simulador:
+    def __init__(self, config_path):
+        self.reloj = RelojSincronizado()
+        self.cola = ColaInstrumentada()
+
+        pi.config_store = pi.ConfigStore(config_path)
+        pi.bombas = pi.DriverSimulado(self.reloj)
+        pi.pedidos_queue = self.cola
+
+        with contextlib.redirect_stdout(None):
+            if not pi.setup_gpio():
+                raise RuntimeError(f"No se pudo cargar {config_path}")
+
+        self.cliente = pi.app.test_client()
+        self.trabajos = self.cola.admitidos
+        self.rechazados = 0
+        self.admision_ms = []
+
+        threading.Thread(target=pi.procesar_pedidos, daemon=True).start()
+
+    def _esperar_reposo(self):
+        """Espera a que el worker esté bloqueado (en un deadline o sin pedidos)"""
+        while True:
+            deadline = self.reloj.esperando()
+            if deadline is not None:
+                return deadline
+            if self.cola.en_reposo():
+                return None
+            time.sleep(0.0001)
+
+    def correr_hasta(self, t_ns):
+        """Avanza el reloj virtual hasta t_ns atendiendo los deadlines del worker"""
+        while True:
+            deadline = self._esperar_reposo()
+            if deadline is None or deadline > t_ns:
+                self.reloj.avanzar(t_ns)
+                return
+            self.reloj.avanzar(deadline)
+
+    def drenar(self):
+        """Avanza el reloj hasta que el worker termina todos los pedidos"""
+        while True:
+            deadline = self._esperar_reposo()
+            if deadline is None:
+                return
+            self.reloj.avanzar(deadline)
+
+    def pedir(self, recipe_id, cliente=None, prioridad='normal'):
+        inicio = time.perf_counter()
+        resp = self.cliente.post('/hacer_trago', json={
+            "recipe_id": recipe_id, "cliente": cliente, "prioridad": prioridad
+        })
+        self.admision_ms.append((time.perf_counter() - inicio) * 1000)
+        if resp.status_code != 200:
+            self.rechazados += 1
+
+# ============================================
+# MÉTRICAS
+# ============================================
+def percentiles(valores):
+    if not valores:
+        return {"p50": 0, "p95": 0, "p99": 0, "max": 0}
+    ordenados = sorted(valores)
+
+    def rango(p):
+        idx = max(0, min(len(ordenados) - 1, int(round(p / 100.0 * len(ordenados) + 0.5)) - 1))
+        return round(ordenados[idx], 3)
+
+    return {"p50": rango(50), "p95": rango(95), "p99": rango(99), "max": round(ordenados[-1], 3)}
+
+def profundidad_cola(trabajos, fin_ns, tramos=12):
+    """Profundidad de la cola en el tiempo: máximo, media ponderada y por tramos"""
+    eventos = []
+    for job in trabajos:
+        eventos.append((job['admitido_ns'], 1))
+        eventos.append((job['inicio_ns'], -1))
+    eventos.sort()
+
+    tramo_ns = max(1, fin_ns // tramos)
+    por_tramo = [0] * tramos
+    profundidad = maximo = 0
+    area = 0
+    anterior = 0
+    for t, delta in eventos:
+        area += profundidad * (t - anterior)
+        anterior = t
+        profundidad += delta
+        maximo = max(maximo, profundidad)
+        idx = min(tramos - 1, t // tramo_ns)
+        por_tramo[idx] = max(por_tramo[idx], profundidad)
+
+    return {
+        "max": maximo,
+        "media": round(area / fin_ns, 2) if fin_ns else 0,
+        "por_tramo": por_tramo
+    }
+
+def uso_bombas(transiciones, etiquetas, fin_ns):
+    """Porcentaje del tiempo simulado que estuvo encendida cada bomba"""
+    encendida_desde = {}
+    total_ns = {}
+    for t, pin, encendida in transiciones:
+        if encendida:
+            encendida_desde[pin] = t
+        elif pin in encendida_desde:
+            total_ns[pin] = total_ns.get(pin, 0) + t - encendida_desde.pop(pin)
+
+    return {
+        etiquetas.get(pin, f"PIN {pin}"): round(100.0 * ns / fin_ns, 1) if fin_ns else 0
+        for pin, ns in sorted(total_ns.items())
+    }
+
+def resultados(sim, escenario, modo):
+    terminados = [job for job in sim.trabajos if 'fin_ns' in job]
+    fin_ns = max((job['fin_ns'] for job in terminados), default=0)
+
+    espera = [(job['inicio_ns'] - job['admitido_ns']) / 1e9 for job in terminados]
+    total = [(job['fin_ns'] - job['admitido_ns']) / 1e9 for job in terminados]
+    # Diferencia entre el ETA prometido al admitir y lo que tardó de verdad
+    error_eta = [abs(t - job['eta_admision_s']) for t, job in zip(total, terminados)]
+
+    config = pi.load_config()
+    etiquetas = {p['pin']: p['label'] for p in config.get('config', {}).values()}
+
+    return {
+        "escenario": escenario,
+        "modo": modo,
+        "pedidos": len(sim.trabajos),
+        "rechazados": sim.rechazados,
+        "duracion_s": round(fin_ns / 1e9, 1),
+        "tragos_por_hora": round(len(terminados) * 3600e9 / fin_ns, 1) if fin_ns else 0,
+        "espera_s": percentiles(espera),
+        "total_s": percentiles(total),
+        "admision_ms": percentiles(sim.admision_ms),
+        "error_eta_s": percentiles(error_eta),
+        "cola": profundidad_cola(terminados, fin_ns),
+        "uso_bombas_pct": uso_bombas(pi.bombas.transiciones, etiquetas, fin_ns),
+    }
+
+# ============================================
+# EJECUCIÓN
+# ============================================
+def preparar_config(modo, max_bombas, sjf, vasos=None, inventario=False):
+    """
+    Copia pi.json a un temporal con el modo de vertido / planificación pedidos.
+    Sin `inventario` las botellas no se controlan (nunca se vacían).
+    """
+    with open(os.path.join(DIRECTORIO, 'pi.json'), 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    if not inventario:
+        for pump_info in config.get('config', {}).values():
+            pump_info.pop('capacidad_ml', None)
+    preparacion = config.setdefault('preparacion', {})
+    if modo:
+        preparacion['modo'] = modo
+    if max_bombas:
+        preparacion['max_bombas_simultaneas'] = max_bombas
+    if vasos:
+        preparacion['vasos_simultaneos'] = vasos
+    if sjf:
+        config.setdefault('planificacion', {})['sjf'] = True
+
+    fd, ruta = tempfile.mkstemp(prefix='bench_pi_', suffix='.json')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+    return ruta
+
+def parsear_mezcla(texto, ids):
+    """'1:3,6:1' -> {1: 3.0, 6: 1.0}. Sin texto, todas las recetas por igual"""
+    if not texto:
+        return {rid: 1.0 for rid in ids}
+    mezcla = {}
+    for parte in texto.split(','):
+        rid, peso = parte.split(':')
+        mezcla[int(rid)] = float(peso)
+    return mezcla
+
+def correr(args):
+    parametros = dict(ESCENARIOS[args.escenario])
+    if args.pedidos:
+        parametros['pedidos'] = args.pedidos
+    if args.tasa is not None:
+        parametros['tasa'] = args.tasa
+        parametros['rafaga'] = args.tasa <= 0
+
+    sim = Simulador(preparar_config(args.modo, args.max_bombas, args.sjf, args.vasos, args.inventario))
+    modo, _ = pi.ajustes_vertido(pi.load_config())
+
+    ids = [item['id'] for item in pi.load_config().get('menu', [])]
+    mezcla = parsear_mezcla(args.mezcla, ids)
+    rng = random.Random(args.semilla)
+    # Generador aparte para que cambiar clientes/VIP no cambie la mezcla de tragos
+    rng_clientes = random.Random(args.semilla + 1)
+    recetas = list(mezcla)
+    pesos = [mezcla[rid] for rid in recetas]
+
+    t = 0.0
+    with contextlib.redirect_stdout(None):
+        for _ in range(parametros['pedidos']):
+            if not parametros['rafaga']:
+                t += rng.expovariate(parametros['tasa'] / 3600.0)
+            sim.correr_hasta(int(t * 1e9))
+            receta = rng.choices(recetas, pesos)[0]
+            cliente = f"kiosco_{rng_clientes.randrange(args.clientes)}"
+            prioridad = 'vip' if rng_clientes.random() < args.vip else 'normal'
+            sim.pedir(receta, cliente, prioridad)
+        sim.drenar()
+
+    return resultados(sim, args.escenario, modo)
+
+def comparar(actual, base, tolerancia):
+    """Lista de regresiones de `actual` respecto de `base`"""
+    regresiones = []
+    if actual['tragos_por_hora'] < base['tragos_por_hora'] * (1 - tolerancia):
+        regresiones.append(f"tragos/hora {actual['tragos_por_hora']} < {base['tragos_por_hora']}")
+    for clave in ('espera_s', 'total_s'):
+        for p in ('p50', 'p95', 'p99'):
+            if actual[clave][p] > base[clave][p] * (1 + tolerancia) + 1e-9:
+                regresiones.append(f"{clave} {p} {actual[clave][p]} > {base[clave][p]}")
+    return regresiones
+
+def imprimir(res):
+    print(f"\n{'='*50}")
+    print(f"📊 BENCHMARK: {res['escenario']} (modo {res['modo']})")
+    print(f"{'='*50}")
+    print(f"Pedidos: {res['pedidos']} | Rechazados: {res['rechazados']} | Simulado: {res['duracion_s']}s")
+    print(f"Tragos/hora: {res['tragos_por_hora']}")
+    for clave, titulo in (('espera_s', 'Espera (s)'), ('total_s', 'Total (s)'),
+                          ('error_eta_s', 'Error ETA (s)'), ('admision_ms', 'Admisión (ms)')):
+        p = res[clave]
+        print(f"{titulo:14} p50={p['p50']} p95={p['p95']} p99={p['p99']} max={p['max']}")
+    cola = res['cola']
+    print(f"Cola: max={cola['max']} media={cola['media']} por tramo={cola['por_tramo']}")
+    print("Uso de bombas:")
+    for label, pct in res['uso_bombas_pct'].items():
+        print(f"   {label}: {pct}%")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline de pedidos de pi.py")
+    parser.add_argument('--escenario', choices=sorted(ESCENARIOS), default='evento')
+    parser.add_argument('--pedidos', type=int, help="Cantidad de pedidos")
+    parser.add_argument('--tasa', type=float, help="Pedidos por hora (0 = todos juntos)")
+    parser.add_argument('--mezcla', help="Pesos por receta, ej: '1:3,6:1'")
+    parser.add_argument('--modo', choices=[pi.MODO_SERIE, pi.MODO_PARALELO])
+    parser.add_argument('--max-bombas', type=int, help="Máximo de bombas simultáneas")
+    parser.add_argument('--vasos', type=int, help="Vasos que la estación prepara a la vez")
+    parser.add_argument('--inventario', action='store_true',
+                        help="Controla el stock de las botellas (rechaza al vaciarse)")
+    parser.add_argument('--clientes', type=int, default=1, help="Kioscos que reparten los pedidos")
+    parser.add_argument('--vip', type=float, default=0.0, help="Fracción de pedidos VIP (0-1)")
+    parser.add_argument('--sjf', action='store_true', help="Activa shortest-job-first")
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--guardar', help="Guarda los resultados en un JSON")
+    parser.add_argument('--comparar', help="JSON base contra el que detectar regresiones")
+    parser.add_argument('--tolerancia', type=float, default=TOLERANCIA_DEFAULT)
+    parser.add_argument('--json', action='store_true', help="Imprime los resultados como JSON")
+    args = parser.parse_args()
+
+    res = correr(args)
+
+    if args.json:
+        print(json.dumps(res, indent=2, ensure_ascii=False))
+    else:
+        imprimir(res)
+
+    if args.guardar:
+        with open(args.guardar, 'w', encoding='utf-8') as f:
+            json.dump(res, f, indent=2, ensure_ascii=False)
+
+    if args.comparar:
+        with open(args.comparar, 'r', encoding='utf-8') as f:
+            base = json.load(f)
+        regresiones = comparar(res, base, args.tolerancia)
+        if regresiones:
+            print("\n❌ REGRESIONES:")
+            for r in regresiones:
+                print(f"   - {r}")
+            sys.exit(1)
+        print("\n✅ Sin regresiones")
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,383 @@
+import os
 import json
+import math
 import time
 import threading
 from queue import Queue
+import heapq
+import bisect
+from collections import namedtuple, deque
 from datetime import datetime
-import RPi.GPIO as GPIO
-from flask import Flask, request, jsonify
+import itertools
+import functools
+import multiprocessing
+import signal
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+from flask import Flask, request, jsonify, Response
 
 # ============================================
 # CONFIGURACIÓN GLOBAL
 # ============================================
 app = Flask(__name__)
-GPIO.setmode(GPIO.BCM)
 
-# Cola de pedidos y locks
-pedidos_queue = Queue()
+# Estado del worker (la cola de pedidos está en PLANIFICADOR DE PEDIDOS)
 preparando = False
 preparando_lock = threading.Lock()
 
+# ============================================
+# REGISTRO (LOGS)
+# ============================================
+# Los mensajes se encolan y los escribe un hilo aparte, así ni el worker ni
+# los endpoints esperan nunca a stdout (journald, una sesión SSH lenta...).
+# PI_LOG=texto (por defecto) escribe una línea legible por mensaje,
+# PI_LOG=json una línea JSON con los campos (pedido_id, tiempos...) y
+# PI_LOG='' no escribe nada.
+LOG_FORMATO = os.environ.get('PI_LOG', 'texto')
+LOG_MAX_PENDIENTES = 2000  # Si stdout no da abasto se descartan (y se cuentan)
+
+class Log:
+    """
+    Logger estructurado que no bloquea a quien lo llama. El hilo que escribe
+    arranca con el primer mensaje, no al importar: así DriverProceso hace
+    el fork mientras el proceso todavía tiene un solo hilo.
+    """
+    def __init__(self, formato=LOG_FORMATO, max_pendientes=LOG_MAX_PENDIENTES):
+        self.formato = formato
+        self.max_pendientes = max_pendientes
+        self.descartados = 0
+        self._pendientes = deque()
+        self._aviso = threading.Event()
+        self._hilo = None
+        self._hilo_lock = threading.Lock()
+
+    def info(self, mensaje, **campos):
+        self._anotar('info', mensaje, campos)
+
+    def aviso(self, mensaje, **campos):
+        self._anotar('aviso', mensaje, campos)
+
+    def error(self, mensaje, **campos):
+        self._anotar('error', mensaje, campos)
+
+    def _anotar(self, nivel, mensaje, campos):
+        if not self.formato:
+            return
+        if len(self._pendientes) >= self.max_pendientes:
+            self.descartados += 1
+            return
+        self._pendientes.append((time.time(), nivel, mensaje, campos))
+        if self._hilo is None:
+            self._arrancar()
+        self._aviso.set()
+
+    def _arrancar(self):
+        with self._hilo_lock:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._escribir, daemon=True)
+                self._hilo.start()
+
+    def _formatear(self, t, nivel, mensaje, campos):
+        if self.formato == 'json':
+            registro = {"t": round(t, 3), "nivel": nivel, "msg": mensaje, **campos}
+            return json.dumps(registro, ensure_ascii=False, default=str) + "\n"
+        if 'traza' in campos:
+            return f"{mensaje}\n{campos['traza']}"
+        return mensaje + "\n"
+
+    def _escribir(self):
+        while True:
+            self._aviso.wait()
+            self._aviso.clear()
+            lineas = []
+            while self._pendientes:
+                lineas.append(self._formatear(*self._pendientes.popleft()))
+            salida = sys.stdout
+            if not lineas or salida is None:
+                continue
+            try:
+                salida.write("".join(lineas))
+                salida.flush()
+            except (OSError, ValueError):
+                pass
+
+log = Log()
+
+# ============================================
+# BACKEND DE BOMBAS (GPIO REAL O SIMULADO)
+# ============================================
+# PI_GPIO_BACKEND=rpi (por defecto) usa RPi.GPIO; PI_GPIO_BACKEND=sim usa el
+# simulador en memoria. PI_SIM_VELOCIDAD acelera el reloj del simulador.
+# PI_DRIVER_PROCESO=1 corre el driver en un proceso aparte (ver DriverProceso),
+# con PI_DRIVER_PRIORIDAD (SCHED_FIFO 1-99) y PI_DRIVER_CPU (núcleo fijo).
+GPIO_BACKEND = os.environ.get('PI_GPIO_BACKEND', 'rpi')
+DRIVER_PROCESO = os.environ.get('PI_DRIVER_PROCESO', '') == '1'
+DRIVER_PRIORIDAD = int(os.environ.get('PI_DRIVER_PRIORIDAD', '0'))
+DRIVER_CPU = os.environ.get('PI_DRIVER_CPU', '')
+SPIN_FINAL_NS = 2_000_000  # Últimos 2 ms antes de un deadline en espera activa
+
+def _dormir(segundos, interrumpir):
+    if interrumpir is None:
+        time.sleep(segundos)
+    else:
+        interrumpir.wait(segundos)
+
+class RelojReal:
+    """Reloj monotónico del sistema"""
+    spin_ns = SPIN_FINAL_NS
+    def monotonic_ns(self):
+        return time.monotonic_ns()
+
+    def segundos_reales(self, duracion_ns):
+        return duracion_ns / 1e9
+
+    def esperar_hasta(self, deadline_ns, interrumpir=None):
+        """
+        Duerme hasta `deadline_ns` y hace spin en el último tramo. Si se
+        activa el Event `interrumpir` retorna enseguida.
+        """
+        while True:
+            if interrumpir is not None and interrumpir.is_set():
+                return
+            restante = deadline_ns - time.monotonic_ns()
+            if restante <= 0:
+                return
+            if restante > self.spin_ns:
+                _dormir((restante - self.spin_ns) / 1e9, interrumpir)
+
+class RelojAcelerado:
+    """Reloj que corre `factor` veces más rápido que el real"""
+    spin_ns = SPIN_FINAL_NS
+
+    def __init__(self, factor):
+        self.factor = float(factor)
+        self._base_real = time.monotonic_ns()
+
+    def monotonic_ns(self):
+        return int((time.monotonic_ns() - self._base_real) * self.factor)
+
+    def segundos_reales(self, duracion_ns):
+        return duracion_ns / self.factor / 1e9
+
+    def esperar_hasta(self, deadline_ns, interrumpir=None):
+        while True:
+            if interrumpir is not None and interrumpir.is_set():
+                return
+            restante_real = (deadline_ns - self.monotonic_ns()) / self.factor
+            if restante_real <= 0:
+                return
+            if restante_real > self.spin_ns:
+                _dormir((restante_real - self.spin_ns) / 1e9, interrumpir)
+
+class RelojVirtual:
+    """
+    Reloj que solo avanza cuando alguien espera: esperar_hasta() salta
+    directamente al deadline. Pensado para un único hilo de simulación.
+    """
+    def __init__(self):
+        self._ahora = 0
+
+    def monotonic_ns(self):
+        return self._ahora
+
+    def segundos_reales(self, duracion_ns):
+        return 0.0
+
+    def esperar_hasta(self, deadline_ns, interrumpir=None):
+        if deadline_ns > self._ahora:
+            self._ahora = deadline_ns
+
+class DriverRPi:
+    """Bombas conectadas a relés por RPi.GPIO (relés activos en LOW)"""
+    nombre = 'rpi'
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self._gpio = GPIO
+        self.reloj = RelojReal()
+        GPIO.setmode(GPIO.BCM)
+
+    def configurar(self, pin):
+        self._gpio.setup(pin, self._gpio.OUT)
+        self._gpio.output(pin, self._gpio.HIGH)  # Apagado inicial
+
+    def encender(self, pin, duracion_ns=None):
+        self._gpio.output(pin, self._gpio.LOW)
+
+    def apagar(self, pin):
+        self._gpio.output(pin, self._gpio.HIGH)
+
+    def limpiar(self):
+        self._gpio.cleanup()
+
+class DriverSimulado:
+    """
+    Bombas simuladas: guarda cada cambio de estado de los pines con el
+    instante del reloj (real, acelerado o virtual) en que ocurrió.
+    """
+    nombre = 'sim'
+
+    def __init__(self, reloj=None, max_transiciones=100000):
+        self.reloj = reloj or RelojReal()
+        self._lock = threading.Lock()
+        self.transiciones = deque(maxlen=max_transiciones)  # (t_ns, pin, encendida)
+        self.encendidas = {}  # pin -> True/False
+
+    def _registrar(self, pin, encendida):
+        with self._lock:
+            self.encendidas[pin] = encendida
+            self.transiciones.append((self.reloj.monotonic_ns(), pin, encendida))
+
+    def configurar(self, pin):
+        self._registrar(pin, False)
+
+    def encender(self, pin, duracion_ns=None):
+        self._registrar(pin, True)
+
+    def apagar(self, pin):
+        self._registrar(pin, False)
+
+    def limpiar(self):
+        with self._lock:
+            self.encendidas.clear()
+
+class DriverProceso:
+    """
+    Corre otro driver (rpi o sim) en un proceso hijo, lejos del GIL que
+    comparten el worker, los requests de Flask y el parseo de pi.json.
+
+    encender(pin, duracion_ns) le pasa al hijo la duración del paso: el
+    apagado lo hace el hijo en su deadline, con sleep + spin como
+    esperar_hasta(), aunque este proceso esté ocupado. Cuando el worker
+    llega a apagar(), el pin normalmente ya está apagado y el hijo
+    contesta cuándo lo apagó. Sin duración, el pin queda encendido hasta
+    apagar(), como con los otros drivers.
+
+    Cada llamada es un mensaje por un Pipe y su respuesta (el instante en
+    que pasó, en el reloj del driver). Si este proceso muere, el hijo ve
+    el Pipe cerrado y apaga todo antes de salir.
+    """
+    def __init__(self, driver):
+        # fork: el hijo hereda el driver ya creado y su reloj, así los
+        # instantes de ambos procesos se comparan directamente. Se crea al
+        # importar, antes de cualquier hilo (el del log arranca con el primer
+        # mensaje): un fork con otros hilos andando puede dejar al hijo con
+        # un lock tomado para siempre.
+        if threading.active_count() > 1:
+            print("⚠️ DriverProceso creado con otros hilos andando: el fork puede trabarse", flush=True)
+        contexto = multiprocessing.get_context('fork')
+        self._conexion, hijo = contexto.Pipe()
+        self._lock = threading.Lock()
+        self.nombre = f"{driver.nombre} (proceso aparte)"
+        self.reloj = driver.reloj
+        self._proceso = contexto.Process(target=_servir_bombas, args=(driver, hijo, self._conexion),
+                                         name='bombas', daemon=True)
+        self._proceso.start()
+        hijo.close()
+        # Los deadlines finos son del hijo: acá alcanza con despertarse a
+        # tiempo, sin competir con él por la CPU haciendo spin
+        self.reloj.spin_ns = 0
+
+    def _pedir(self, orden, pin=None, valor=None):
+        with self._lock:
+            try:
+                self._conexion.send((orden, pin, valor))
+                return self._conexion.recv()
+            except (EOFError, OSError) as e:
+                raise ConnectionError(f"El proceso de bombas no responde: {e}") from e
+
+    def configurar(self, pin):
+        self._pedir('configurar', pin)
+
+    def encender(self, pin, duracion_ns=None):
+        return self._pedir('encender', pin, duracion_ns)
+
+    def apagar(self, pin):
+        return self._pedir('apagar', pin)
+
+    def limpiar(self):
+        self._pedir('limpiar')
+
+def _prioridad_tiempo_real():
+    """Núcleo fijo y SCHED_FIFO para el proceso de bombas, si se pidieron"""
+    # En el hijo no corre el hilo del log: los avisos van directo a stdout
+    try:
+        if DRIVER_CPU:
+            os.sched_setaffinity(0, {int(DRIVER_CPU)})
+        if DRIVER_PRIORIDAD:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(DRIVER_PRIORIDAD))
+    except (OSError, AttributeError, ValueError) as e:
+        print(f"⚠️ Proceso de bombas sin prioridad de tiempo real: {e}", flush=True)
+
+def _servir_bombas(driver, conexion, otra_punta):
+    """Loop del proceso de bombas: atiende pedidos y apaga cada pin en su deadline"""
+    otra_punta.close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C lo maneja el proceso principal
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    _prioridad_tiempo_real()
+
+    reloj = driver.reloj
+    pines = set()
+    deadlines = {}  # pin -> cuándo apagarlo
+    apagadas = {}   # pin -> cuándo se apagó por su deadline (hasta que el worker lo pregunte)
+    try:
+        while True:
+            espera = None
+            if deadlines:
+                pin, deadline = min(deadlines.items(), key=lambda item: item[1])
+                espera = reloj.segundos_reales(deadline - reloj.monotonic_ns()) - reloj.spin_ns / 1e9
+                if espera <= 0:
+                    reloj.esperar_hasta(deadline)
+                    driver.apagar(pin)
+                    apagadas[pin] = reloj.monotonic_ns()
+                    del deadlines[pin]
+                    continue
+            if not conexion.poll(espera):
+                continue
+
+            orden, pin, valor = conexion.recv()
+            respuesta = None
+            if orden == 'encender':
+                driver.encender(pin)
+                respuesta = reloj.monotonic_ns()
+                apagadas.pop(pin, None)
+                if valor is not None:
+                    deadlines[pin] = respuesta + valor
+            elif orden == 'apagar':
+                if pin in apagadas:
+                    respuesta = apagadas.pop(pin)
+                else:
+                    driver.apagar(pin)
+                    respuesta = reloj.monotonic_ns()
+                    deadlines.pop(pin, None)
+            elif orden == 'configurar':
+                driver.configurar(pin)
+                pines.add(pin)
+            elif orden == 'limpiar':
+                driver.limpiar()
+                deadlines.clear()
+            conexion.send(respuesta)
+    except EOFError:
+        pass  # Se cerró el proceso principal
+    finally:
+        for pin in pines:
+            driver.apagar(pin)
+
+def crear_driver(backend=GPIO_BACKEND, proceso=DRIVER_PROCESO):
+    """Crea el driver de bombas indicado ('rpi' o 'sim'), en un proceso aparte si se pide"""
+    if backend == 'sim':
+        velocidad = float(os.environ.get('PI_SIM_VELOCIDAD', '1'))
+        reloj = RelojAcelerado(velocidad) if velocidad != 1 else RelojReal()
+        driver = DriverSimulado(reloj)
+    else:
+        driver = DriverRPi()
+    return DriverProceso(driver) if proceso else driver
+
+bombas = crear_driver()
+
 # ============================================
 # ⚙️ CALIBRACIÓN CORREGIDA (VOLUMEN REAL)
 # ============================================
@@ -31,159 +392,2672 @@ CALIBRACION_POR_PIN = {
 }
 
 DEFAULT_RATE = 10.0 / 30.0
+PAUSA_ENTRE_PASOS = 0.5  # Segundos entre un ingrediente y el siguiente
+
+# Modos de vertido (sección "preparacion" de pi.json)
+MODO_SERIE = 'serie'        # Un ingrediente detrás de otro
+MODO_PARALELO = 'paralelo'  # Todos los ingredientes (o cada grupo) a la vez
+MAX_BOMBAS_DEFAULT = 6      # Límite de bombas encendidas a la vez (fuente de poder)
+
+# Estación multi-vaso (también en "preparacion")
+VASOS_SIMULTANEOS_DEFAULT = 1  # 1 = un pedido por vez, como siempre
+VENTANA_COLA_DEFAULT = 8       # Cuántos pedidos de la cola se miran hacia adelante
+MAX_ADELANTOS_DEFAULT = 3      # Veces que un pedido puede ser pasado por otro
+LINEA_LLENA_S_DEFAULT = 30     # Tras apagar, cuánto sigue cebada la manguera
+
+# Tiempo muerto de cada bomba al arrancar en frío, hasta que el líquido llega
+# al vaso (con la manguera todavía llena no hace falta cebar)
+ARRANQUE_POR_PIN = {}
+# ml que siguen cayendo después de apagar la bomba (se descuentan del vertido)
+GOTEO_POR_PIN = {}
+
+# Versión de la calibración: cambia cada vez que se toca CALIBRACION_POR_PIN
+calibracion_version = 0
+
+def set_calibracion(pin, rate, arranque=None, goteo=None):
+    """Actualiza los seg/ml (arranque y goteo) de un pin e invalida los planes compilados"""
+    global calibracion_version
+    CALIBRACION_POR_PIN[pin] = rate
+    if arranque is not None:
+        ARRANQUE_POR_PIN[pin] = arranque
+    if goteo is not None:
+        GOTEO_POR_PIN[pin] = goteo
+    calibracion_version += 1
+
+def duracion_vertido(pin, ml, cebada=False):
+    """
+    Segundos de bomba para servir `ml`: arranque (si la manguera no está
+    cebada) + (ml - goteo) * seg/ml. Los planes se compilan en frío, que es
+    el caso más largo; el worker recalcula al encender.
+    """
+    if ml <= 0:
+        return 0.0
+    arranque = 0.0 if cebada else ARRANQUE_POR_PIN.get(pin, 0.0)
+    return arranque + max(0.0, ml - GOTEO_POR_PIN.get(pin, 0.0)) * CALIBRACION_POR_PIN.get(pin, DEFAULT_RATE)
+
+# ============================================
+# CALIBRACIÓN POR MEDICIONES (LAZO CERRADO)
+# ============================================
+# Cada medición es (segundos que estuvo encendida la bomba, ml que cayeron
+# en el vaso). Por bomba se ajusta  ml = caudal * (segundos - arranque):
+# el caudal ya incluye la viscosidad del líquido de esa bomba y `arranque`
+# es el tiempo muerto hasta que el líquido llega al vaso. El resultado se
+# guarda en PI_CALIBRACION ('' = no guardar) y pisa el flow_rate de pi.json.
+CALIBRACION_PATH = os.environ.get('PI_CALIBRACION', 'calibracion.json')
+MAX_MUESTRAS_CALIBRACION = 30  # Solo las últimas (la bomba se gasta, la manguera cambia)
+MAX_ARRANQUE_S = 3.0
+MIN_DISPERSION_S = 0.5         # Variedad de tiempos necesaria para separar caudal y arranque
+
+def ajustar_caudal(muestras, arranque_previo=0.0):
+    """
+    Ajuste por mínimos cuadrados de [(segundos, ml)].
+    Retorna (caudal_ml_s, arranque_s) o None si las muestras no sirven.
+    """
+    if not all(math.isfinite(t) and math.isfinite(ml) for t, ml in muestras):
+        return None
+    n = len(muestras)
+    if n >= 2:
+        media_t = sum(t for t, _ in muestras) / n
+        media_ml = sum(ml for _, ml in muestras) / n
+        var_t = sum((t - media_t) ** 2 for t, _ in muestras) / n
+        if var_t ** 0.5 >= MIN_DISPERSION_S:
+            caudal = sum((t - media_t) * (ml - media_ml) for t, ml in muestras) / n / var_t
+            if caudal > 0:
+                arranque = media_t - media_ml / caudal
+                if 0.0 <= arranque <= MAX_ARRANQUE_S:
+                    return caudal, arranque
+
+    # Tiempos parecidos (o un ajuste sin sentido físico): se conserva el
+    # arranque conocido y solo se corrige el caudal
+    util = sum(max(0.0, t - arranque_previo) for t, _ in muestras)
+    total_ml = sum(ml for _, ml in muestras)
+    if util <= 0 or total_ml <= 0:
+        return None
+    caudal = total_ml / util
+    return (caudal, arranque_previo) if math.isfinite(caudal) and math.isfinite(arranque_previo) else None
+
+class CalibracionAutomatica:
+    """Mediciones por pin, modelo ajustado y su persistencia"""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.muestras = {}  # pin -> deque[(segundos, ml)]
+        self.modelos = {}   # pin -> (caudal_ml_s, arranque_s)
+
+    def cargar(self):
+        """Lee las mediciones guardadas y aplica los modelos a CALIBRACION_POR_PIN"""
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                guardado = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        with self._lock:
+            for pin, datos in guardado.items():
+                pin = int(pin)
+                self.muestras[pin] = deque((tuple(m) for m in datos.get('muestras', [])),
+                                           maxlen=MAX_MUESTRAS_CALIBRACION)
+                caudal, arranque = datos['caudal_ml_s'], datos['arranque_s']
+                if (isinstance(caudal, (int, float)) and isinstance(arranque, (int, float)) and
+                        math.isfinite(caudal) and caudal > 0 and math.isfinite(arranque)):
+                    self.modelos[pin] = (caudal, arranque)
+            modelos = dict(self.modelos)
+
+        for pin, (caudal, arranque) in modelos.items():
+            set_calibracion(pin, 1.0 / caudal, arranque)
+
+    def medir(self, pin, segundos, ml):
+        """
+        Agrega una medición (`segundos` como arranque en frío), reajusta el
+        modelo del pin y lo aplica.
+        Retorna (caudal, arranque, error_ml) donde error_ml es cuánto se
+        equivocaba el modelo anterior con esta medición, o None.
+        """
+        with self._lock:
+            arranque_previo = ARRANQUE_POR_PIN.get(pin, 0.0)
+            goteo = GOTEO_POR_PIN.get(pin, 0.0)
+            previsto = max(0.0, segundos - arranque_previo) / CALIBRACION_POR_PIN.get(pin, DEFAULT_RATE) + goteo
+            muestras = self.muestras.setdefault(pin, deque(maxlen=MAX_MUESTRAS_CALIBRACION))
+            muestras.append((segundos, ml - goteo))
+            modelo = ajustar_caudal(list(muestras), arranque_previo)
+            if modelo is None:
+                muestras.pop()
+                return None
+            self.modelos[pin] = modelo
+            self._guardar()
+
+        caudal, arranque = modelo
+        set_calibracion(pin, 1.0 / caudal, arranque)
+        return caudal, arranque, previsto - ml
+
+    def cantidad(self, pin):
+        with self._lock:
+            return len(self.muestras.get(pin, ()))
+
+    def _guardar(self):
+        if not self.path:
+            return
+        datos = {
+            str(pin): {
+                "caudal_ml_s": round(caudal, 4),
+                "arranque_s": round(arranque, 4),
+                "muestras": [[round(t, 4), round(ml, 2)] for t, ml in self.muestras.get(pin, ())]
+            }
+            for pin, (caudal, arranque) in self.modelos.items()
+        }
+        try:
+            temporal = self.path + '.tmp'
+            with open(temporal, 'w', encoding='utf-8') as f:
+                json.dump(datos, f)
+            os.replace(temporal, self.path)
+        except OSError as e:
+            log.error(f"❌ Error guardando la calibración: {e}")
+
+calibracion_auto = CalibracionAutomatica(CALIBRACION_PATH)
+
+# ============================================
+# MODELO DE DOMINIO (DOS DIALECTOS DE pi.json)
+# ============================================
+# pi.json puede venir en el formato de este servidor ("config" con las
+# bombas, "menu" con recetas de id numérico e ingredientes [{"pump", "ml"}],
+# "preparacion", "planificacion") o en el de rasberry/py2.py ("pumps" con
+# name/value/pin, "recipes" {id: {"name", "ingredients": {ingrediente: ml}}}
+# y sus opciones en "config"). El segundo se traduce al primero al leerlo:
+# se valida una sola vez y el mismo servidor anda con cualquiera de las dos
+# instalaciones. Con eso se arma un Modelo inmutable (tuplas con nombre,
+# textos internados, ingredientes que apuntan directo a su Bomba) que usan
+# los endpoints y el worker en vez de recorrer los dicts del JSON.
+FLOW_RATE_DEFAULT = 3.0
+FLOW_RATE_PY2_DEFAULT = 2.0  # py2.py usa 0.5 seg/ml para las bombas sin flow_rate
+
+Bomba = namedtuple('Bomba', ['id', 'label', 'pin', 'flow_rate', 'arranque_s', 'goteo_ml',
+                             'capacidad_ml', 'max_encendida_s', 'densidad_g_ml'])
+Ingrediente = namedtuple('Ingrediente', ['bomba', 'ml', 'grupo'])
+Receta = namedtuple('Receta', ['id', 'clave', 'name', 'description', 'ingredientes'])
+# `config` es el snapshot (congelado) del que sale todo lo demás; `no_disponibles`
+# son las recetas que no se pueden preparar (id -> motivo)
+Modelo = namedtuple('Modelo', ['config', 'bombas', 'por_pin', 'recetas', 'por_clave', 'no_disponibles'])
+
+# Opción de py2.py ("config") -> (sección, clave) de este servidor.
+# cleanup_delay no tiene equivalente: acá la pausa es PAUSA_ENTRE_PASOS.
+_OPCIONES_PY2 = {
+    'max_concurrent_pumps': ('preparacion', 'max_bombas_simultaneas'),
+    'vip_advantage_s': ('planificacion', 'ventaja_vip_s'),
+    'maintenance_delay_s': ('planificacion', 'retraso_mantenimiento_s'),
+    'shortest_job_first': ('planificacion', 'sjf'),
+    'sjf_weight': ('planificacion', 'peso_sjf'),
+}
+
+def es_config_py2(config):
+    """¿El JSON viene en el dialecto de rasberry/py2.py?"""
+    return isinstance(config, dict) and 'menu' not in config and ('pumps' in config or 'recipes' in config)
+
+def traducir_config_py2(config):
+    """
+    Pasa un pi.json de py2.py al formato de este servidor. Las recetas con
+    id de texto reciben un id numérico libre y conservan el original en
+    "clave". Un ingrediente que no tiene bomba queda con "pump": None y su
+    nombre, así solo esa receta queda no disponible (como en py2.py). El
+    resto de lo que no se pueda traducir queda tal cual para validar_config().
+    """
+    pumps = config.get('pumps')
+    recetas = config.get('recipes')
+    opciones = config.get('config')
+    pumps = pumps if isinstance(pumps, dict) else {}
+    recetas = recetas if isinstance(recetas, dict) else {}
+    opciones = opciones if isinstance(opciones, dict) else {}
+
+    bombas_cfg = {}
+    bomba_por_ingrediente = {}
+    for pump_id, info in pumps.items():
+        if not isinstance(info, dict):
+            bombas_cfg[pump_id] = info
+            continue
+        bomba = {"label": info.get('value', info.get('name')), "pin": info.get('pin'),
+                 "flow_rate": info.get('flow_rate') or FLOW_RATE_PY2_DEFAULT}
+        if 'dead_time_s' in info:
+            bomba['arranque_s'] = info['dead_time_s']
+        if 'density_g_ml' in info:
+            bomba['densidad_g_ml'] = info['density_g_ml']
+        if 'max_on_s' in info:
+            bomba['max_encendida_s'] = info['max_on_s']
+        bombas_cfg[pump_id] = bomba
+        if isinstance(info.get('value'), str):
+            bomba_por_ingrediente.setdefault(info['value'], pump_id)
+
+    libres = itertools.count(max((int(c) for c in recetas if c.isdecimal()), default=0) + 1)
+    menu = []
+    for clave, recipe in recetas.items():
+        if not isinstance(recipe, dict):
+            menu.append(recipe)
+            continue
+        ingredientes = recipe.get('ingredients')
+        menu.append({
+            "id": int(clave) if clave.isdecimal() else next(libres),
+            "clave": clave,
+            "name": recipe.get('name'),
+            "description": recipe.get('description', ''),
+            "ingredients": [{"pump": bomba_por_ingrediente.get(ingrediente), "ingrediente": ingrediente, "ml": ml}
+                            for ingrediente, ml in (ingredientes or {}).items()]
+                           if isinstance(ingredientes, dict) else ingredientes
+        })
+
+    traducida = {"config": bombas_cfg, "menu": menu, "preparacion": {}, "planificacion": {}}
+    if opciones.get('parallel_pour'):
+        traducida['preparacion']['modo'] = MODO_PARALELO
+    for origen, (seccion, clave) in _OPCIONES_PY2.items():
+        if origen in opciones:
+            traducida[seccion][clave] = opciones[origen]
+    return traducida
+
+def crear_modelo(config):
+    """Arma el Modelo de un snapshot ya validado"""
+    bombas_modelo = {}
+    for pump_id, info in config['config'].items():
+        bombas_modelo[pump_id] = Bomba(
+            sys.intern(pump_id), sys.intern(info['label']), info['pin'],
+            float(info.get('flow_rate', FLOW_RATE_DEFAULT)), float(info.get('arranque_s', 0.0)),
+            float(info.get('goteo_ml', 0.0)), info.get('capacidad_ml'), info.get('max_encendida_s'),
+            float(info.get('densidad_g_ml', 1.0)))
+
+    recetas = {}
+    no_disponibles = {}
+    for recipe in config.get('menu', ()):
+        error = error_receta(recipe, bombas_modelo)
+        if error:
+            no_disponibles[recipe['id']] = error
+            continue
+        ingredientes = tuple(Ingrediente(bombas_modelo[ingredient['pump']], ingredient['ml'],
+                                         ingredient.get('grupo', 0))
+                             for ingredient in recipe['ingredients'])
+        recetas[recipe['id']] = Receta(recipe['id'], sys.intern(str(recipe.get('clave', recipe['id']))),
+                                       sys.intern(recipe['name']), recipe.get('description', ''), ingredientes)
+
+    por_pin = {bomba.pin: bomba for bomba in bombas_modelo.values()}
+    # También las no disponibles, para responder por qué no se pueden pedir
+    por_clave = {sys.intern(str(recipe.get('clave', recipe['id']))): recipe['id']
+                 for recipe in config.get('menu', ())}
+    return Modelo(config, bombas_modelo, por_pin, recetas, por_clave, no_disponibles)
+
+def id_receta(modelo, valor):
+    """recipe_id de un request: el id numérico o la clave de texto de py2.py (None si no es ninguno)"""
+    if valor is None or isinstance(valor, bool):
+        return None
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return modelo.por_clave.get(str(valor)) if modelo else None
+
+# ============================================
+# CACHÉ DE CONFIGURACIÓN
+# ============================================
+CONFIG_PATH = 'pi.json'
+CONFIG_RECHECK_MS = 500  # Cada cuánto se revisa si pi.json cambió en disco
+
+class _FrozenDict(dict):
+    """dict de solo lectura (sigue siendo serializable por jsonify)"""
+    def _solo_lectura(self, *args, **kwargs):
+        raise TypeError("La configuración es de solo lectura")
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _solo_lectura
+
+def _freeze(value):
+    """Convierte dicts/listas del JSON en estructuras inmutables"""
+    if isinstance(value, dict):
+        return _FrozenDict((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def _numero(valor, minimo=0.0, estricto=False):
+    """¿Es un número (no bool) >= minimo (o > minimo si estricto)?"""
+    if isinstance(valor, bool) or not isinstance(valor, (int, float)):
+        return False
+    return valor > minimo if estricto else valor >= minimo
+
+def validar_config(config):
+    """
+    Revisa la estructura de pi.json antes de usarlo.
+    Retorna la lista de problemas (vacía si se puede aplicar). Una receta
+    con ingredientes que no se pueden preparar no invalida el archivo: la
+    marca error_receta() y solo falla esa receta al pedirla.
+    """
+    if not isinstance(config, dict):
+        return ["El archivo no es un objeto JSON"]
+    errores = []
+
+    pumps = config.get('config')
+    if not isinstance(pumps, dict) or not pumps:
+        errores.append("Falta la sección 'config' con las bombas")
+        pumps = {}
+    pines = {}
+    for pump_id, info in pumps.items():
+        if not isinstance(info, dict):
+            errores.append(f"{pump_id}: no es un objeto")
+            continue
+        pin = info.get('pin')
+        if isinstance(pin, bool) or not isinstance(pin, int) or pin < 0:
+            errores.append(f"{pump_id}: 'pin' inválido ({pin!r})")
+        elif pin in pines:
+            errores.append(f"{pump_id}: el pin {pin} ya lo usa {pines[pin]}")
+        else:
+            pines[pin] = pump_id
+        if not isinstance(info.get('label'), str):
+            errores.append(f"{pump_id}: falta 'label'")
+        for clave, estricto in (('flow_rate', True), ('capacidad_ml', True), ('max_encendida_s', True),
+                                ('densidad_g_ml', True), ('arranque_s', False), ('goteo_ml', False)):
+            if clave in info and not _numero(info[clave], estricto=estricto):
+                errores.append(f"{pump_id}: '{clave}' inválido ({info[clave]!r})")
+
+    menu = config.get('menu', [])
+    if not isinstance(menu, (list, tuple)):
+        errores.append("'menu' no es una lista")
+        menu = []
+    ids = set()
+    for recipe in menu:
+        if not isinstance(recipe, dict):
+            errores.append("Receta que no es un objeto en 'menu'")
+            continue
+        recipe_id = recipe.get('id')
+        nombre = recipe.get('name', recipe_id)
+        if isinstance(recipe_id, bool) or not isinstance(recipe_id, int):
+            errores.append(f"Receta {nombre!r}: 'id' inválido ({recipe_id!r})")
+        elif recipe_id in ids:
+            errores.append(f"Receta {nombre!r}: id {recipe_id} repetido")
+        ids.add(recipe_id)
+
+    prep = config.get('preparacion', {})
+    if not isinstance(prep, dict):
+        errores.append("'preparacion' no es un objeto")
+    else:
+        if prep.get('modo', MODO_SERIE) not in (MODO_SERIE, MODO_PARALELO):
+            errores.append(f"preparacion.modo inválido ({prep['modo']!r})")
+        for clave in ('max_bombas_simultaneas', 'vasos_simultaneos', 'ventana_cola', 'max_adelantos',
+                      'linea_llena_s'):
+            if clave in prep and not _numero(prep[clave]):
+                errores.append(f"preparacion.{clave} inválido ({prep[clave]!r})")
+
+    plan = config.get('planificacion', {})
+    if not isinstance(plan, dict):
+        errores.append("'planificacion' no es un objeto")
+    else:
+        for clave in ('ventaja_vip_s', 'retraso_mantenimiento_s', 'peso_sjf'):
+            if clave in plan and not _numero(plan[clave]):
+                errores.append(f"planificacion.{clave} inválido ({plan[clave]!r})")
+    return errores
+
+def error_receta(recipe, pumps):
+    """Por qué no se puede preparar una receta del menú (None si se puede)"""
+    if not isinstance(recipe.get('name'), str):
+        return "Receta sin 'name'"
+    ingredients = recipe.get('ingredients')
+    if not isinstance(ingredients, (list, tuple)) or not ingredients:
+        return f"Receta '{recipe['name']}' sin ingredientes"
+    for ingredient in ingredients:
+        if not isinstance(ingredient, dict):
+            return f"Ingrediente inválido ({ingredient!r})"
+        if ingredient.get('pump') is None and 'ingrediente' in ingredient:
+            return f"Ingrediente '{ingredient['ingrediente']}' no disponible en ninguna bomba"
+        if ingredient.get('pump') not in pumps:
+            return f"Bomba '{ingredient.get('pump')}' no configurada"
+        if not _numero(ingredient.get('ml'), estricto=True):
+            return f"'ml' inválido ({ingredient.get('ml')!r})"
+        if not _numero(ingredient.get('grupo', 0)):
+            return f"'grupo' inválido ({ingredient.get('grupo')!r})"
+    return None
+
+class ConfigStore:
+    """
+    Mantiene una única copia parseada y validada de pi.json en memoria
+    (el snapshot congelado y su Modelo, que se cambian juntos).
+
+    Solo vuelve a mirar el disco (stat) como mucho cada `recheck_ms`, y solo
+    re-parsea si cambió el inode, el mtime o el tamaño del archivo. Con
+    iniciar() eso lo hace un hilo aparte y get() no hace más que devolver
+    el snapshot vigente.
+
+    Un pi.json nuevo se valida entero; si tiene errores (o está a medio
+    escribir) se sigue con el último que anduvo. Uno válido queda pendiente
+    y se aplica entre pedidos: pines y calibración (aplicar_config), el
+    cambio de snapshot y la compilación de los planes. El worker tiene
+    `en_uso` mientras prepara, así nunca cambia nada a mitad de un vaso, y
+    con una recarga `pendiente` no arranca vasos nuevos hasta aplicarla.
+    """
+    def __init__(self, path, recheck_ms=CONFIG_RECHECK_MS):
+        self.path = path
+        self.recheck_s = recheck_ms / 1000.0
+        self.recargas = 0
+        self.rechazos = 0
+        self.ultimo_error = None
+        self.en_uso = threading.Lock()
+        self._lock = threading.Lock()
+        # (versión, Modelo) se reemplaza entero: quien lo lee una vez tiene
+        # un Modelo y la versión que le corresponde
+        self._vigente = (0, None)
+        self._pendiente = None
+        self._firma = None
+        self._proxima_revision = 0.0
+        self._vigilando = False
+
+    def get(self):
+        """Devuelve el snapshot vigente (None solo si nunca hubo un pi.json válido)"""
+        modelo = self.modelo()
+        return modelo.config if modelo else None
+
+    def modelo(self):
+        """Devuelve el Modelo vigente (o None)"""
+        return self.vigente()[1]
+
+    def vigente(self):
+        """Devuelve (versión, Modelo) vigentes, leídos juntos"""
+        if not self._vigilando:
+            self.revisar()
+        return self._vigente
+
+    @property
+    def version(self):
+        """Se incrementa en cada configuración aplicada"""
+        return self._vigente[0]
+
+    @property
+    def pendiente(self):
+        """¿Hay un pi.json válido esperando a que la estación quede libre?"""
+        return self._pendiente is not None
+
+    def iniciar(self):
+        """Revisa pi.json desde un hilo propio, fuera de los requests"""
+        if self._vigilando:
+            return
+        self._vigilando = True
+        threading.Thread(target=self._vigilar, daemon=True).start()
+
+    def _vigilar(self):
+        while True:
+            time.sleep(self.recheck_s)
+            try:
+                self.revisar()
+            except Exception as e:
+                log.error(f"❌ Error recargando {self.path}: {e}", archivo=self.path)
+
+    def revisar(self):
+        """Si pi.json cambió en disco lo lee, lo valida y lo deja pendiente"""
+        if time.monotonic() < self._proxima_revision:
+            return
+
+        with self._lock:
+            ahora = time.monotonic()
+            if ahora < self._proxima_revision:
+                return
+            self._proxima_revision = ahora + self.recheck_s
+
+            try:
+                st = os.stat(self.path)
+                firma = (st.st_ino, st.st_mtime_ns, st.st_size)
+            except OSError as e:
+                if self._firma is not None or self.version == 0:
+                    self._rechazar(str(e))
+                self._firma = None
+                return
+
+            if firma == self._firma:
+                return
+            self._firma = firma
+
+            nuevo, error = self._leer()
+            if error:
+                self._rechazar(error)
+                return
+            self.ultimo_error = None
+            for recipe_id, motivo in nuevo.no_disponibles.items():
+                log.aviso(f"⚠️ Receta {recipe_id} no disponible: {motivo}", recipe_id=recipe_id, motivo=motivo)
+            if self._vigente[1] is None:
+                # Primera carga: la aplica setup_gpio()
+                self._vigente = (self.version + 1, nuevo)
+                self.recargas += 1
+                return
+            self._pendiente = nuevo
+
+        self.aplicar_pendiente()
+
+    def aplicar_pendiente(self):
+        """Aplica la configuración pendiente si la estación está entre pedidos"""
+        if self._pendiente is None or not self.en_uso.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                nuevo, self._pendiente = self._pendiente, None
+            if nuevo is None:
+                return
+            anterior = self._vigente[1]
+            aplicar_config(nuevo, anterior)
+            self._vigente = (self.version + 1, nuevo)
+            self.recargas += 1
+            revalidar_cola(nuevo)
+        finally:
+            self.en_uso.release()
+        plan_index.tabla()  # Compilar ya, no en el primer pedido
+        log.info(f"🔄 {self.path} recargado (versión {self.version})", archivo=self.path, version=self.version)
+
+    def invalidar(self):
+        """Fuerza una revisión del archivo en la próxima lectura"""
+        self._proxima_revision = 0.0
+
+    def _rechazar(self, error):
+        self.rechazos += 1
+        self.ultimo_error = error
+        if self._vigente[1] is None:
+            log.error(f"❌ Error leyendo {self.path}: {error}", archivo=self.path)
+        else:
+            log.error(f"❌ {self.path} inválido, sigo con la última configuración buena: {error}",
+                      archivo=self.path)
+
+    def _leer(self):
+        """Retorna (Modelo, None) o (None, error)"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        except Exception as e:
+            return None, str(e)
+        if es_config_py2(config):
+            config = traducir_config_py2(config)
+        errores = validar_config(config)
+        if errores:
+            return None, "; ".join(errores)
+        return crear_modelo(_freeze(config)), None
+
+config_store = ConfigStore(CONFIG_PATH)
 
 # ============================================
 # FUNCIONES AUXILIARES
 # ============================================
 def load_config():
-    """Lee el archivo pi.json con el nuevo formato"""
-    try:
-        with open('pi.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception as e:
-        print(f"❌ Error leyendo pi.json: {e}")
-        return None
+    """Devuelve el snapshot (inmutable) de pi.json desde la caché"""
+    return config_store.get()
+
+def load_modelo():
+    """Devuelve el Modelo (bombas y recetas) de pi.json desde la caché"""
+    return config_store.modelo()
+
+PINES_CONFIGURADOS = set()  # Todo lo que apaga una parada de emergencia
 
 def setup_gpio():
     """Configura los pines basándose en config.json"""
-    config = load_config()
-    if not config: return False
+    modelo = load_modelo()
+    if not modelo: return False
+    
+    log.info("🔌 Configurando Pines GPIO:")
+    configurar_bombas(modelo)
+    
+    # Lo medido en el vaso manda sobre el flow_rate de pi.json
+    calibracion_auto.cargar()
+    for pin, (caudal, arranque) in calibracion_auto.modelos.items():
+        log.info(f"   📏 Pin {pin} calibrado por mediciones: {caudal:.2f} ml/s, arranque {arranque:.2f}s",
+                 pin=pin, caudal_ml_s=round(caudal, 4), arranque_s=round(arranque, 4))
+    
+    inventario.configurar(modelo)
+    return True
+
+def configurar_bombas(modelo, anterior=None):
+    """
+    Configura pines y calibración desde pi.json. Con `anterior` (una
+    recarga) solo toca las bombas que cambiaron y apaga los pines que ya
+    no están.
+    """
+    nuevas = modelo.por_pin
+    viejas = anterior.por_pin if anterior else {}
     
-    pumps = config.get('config', {})
-    print("\n🔌 Configurando Pines GPIO:")
+    for pin in set(viejas) - set(nuevas):
+        bombas.apagar(pin)
+        PINES_CONFIGURADOS.discard(pin)
+        log.info(f"   ✗ Pin {pin} ya no se usa (apagado)", pin=pin)
     
-    for pump_key, pump_info in pumps.items():
-        pin = pump_info["pin"]
-        GPIO.setup(pin, GPIO.OUT)
-        GPIO.output(pin, GPIO.HIGH)  # Apagado inicial
+    for pin, bomba in nuevas.items():
+        if viejas.get(pin) == bomba:
+            continue
+        if pin not in viejas:
+            bombas.configurar(pin)  # Apagado inicial
+            PINES_CONFIGURADOS.add(pin)
         
         # Calculamos calibración desde flow_rate
-        flow_rate = pump_info.get('flow_rate', 3.0)
-        rate = 1.0 / flow_rate  # segundos por ml
+        rate = 1.0 / bomba.flow_rate  # segundos por ml
         
-        # Actualizamos el diccionario de calibración
-        CALIBRACION_POR_PIN[pin] = rate
+        # Actualizamos el diccionario de calibración (lo medido en el vaso manda)
+        if pin in calibracion_auto.modelos:
+            caudal, arranque = calibracion_auto.modelos[pin]
+            set_calibracion(pin, 1.0 / caudal, arranque, bomba.goteo_ml)
+        else:
+            set_calibracion(pin, rate, bomba.arranque_s, bomba.goteo_ml)
         
-        print(f"   ✓ {pump_info['label']} (Pin {pin}) -> {flow_rate} ml/s ({rate:.4f} seg/ml)")
+        log.info(f"   ✓ {bomba.label} (Pin {pin}) -> {bomba.flow_rate} ml/s ({rate:.4f} seg/ml)",
+                 pin=pin, bomba=bomba.label, flow_rate=bomba.flow_rate)
+
+def aplicar_config(modelo, anterior):
+    """Lo que hay que tocar al recargar pi.json (entre pedidos)"""
+    log.info("🔌 Reconfigurando bombas:")
+    configurar_bombas(modelo, anterior)
+    inventario.configurar(modelo)
+
+# ============================================
+# LÓGICA DE PREPARACIÓN
+# ============================================
+# Paso de un plan: inmutable y compartido por todos los pedidos de la receta.
+# `grupo` indica qué pasos pueden verterse juntos en modo paralelo.
+Paso = namedtuple('Paso', ['name', 'pin', 'amount', 'duration', 'rate_used', 'grupo'], defaults=[0])
+PlanCompilado = namedtuple('PlanCompilado', ['recipe_id', 'name', 'steps', 'total_estimado'])
+
+def ajustes_vertido(config):
+    """Lee modo de vertido y máximo de bombas simultáneas de pi.json"""
+    prep = config.get('preparacion', {}) if config else {}
+    modo = prep.get('modo', MODO_SERIE)
+    if modo not in (MODO_SERIE, MODO_PARALELO):
+        modo = MODO_SERIE
+    try:
+        max_bombas = max(1, int(prep.get('max_bombas_simultaneas', MAX_BOMBAS_DEFAULT)))
+    except (TypeError, ValueError):
+        max_bombas = MAX_BOMBAS_DEFAULT
+    return modo, max_bombas
+
+def ajustes_estacion(config):
+    """Lee vasos simultáneos, ventana de la cola y máximo de adelantos de pi.json"""
+    prep = config.get('preparacion', {}) if config else {}
+    try:
+        vasos = max(1, int(prep.get('vasos_simultaneos', VASOS_SIMULTANEOS_DEFAULT)))
+        ventana = max(1, int(prep.get('ventana_cola', VENTANA_COLA_DEFAULT)))
+        adelantos = max(0, int(prep.get('max_adelantos', MAX_ADELANTOS_DEFAULT)))
+    except (TypeError, ValueError):
+        vasos, ventana, adelantos = VASOS_SIMULTANEOS_DEFAULT, VENTANA_COLA_DEFAULT, MAX_ADELANTOS_DEFAULT
+    return vasos, ventana, adelantos
+
+def ajustes_cebado(config):
+    """
+    Retorna (linea_llena_s, mantener_encendida) de "preparacion" en pi.json.
+    mantener_encendida deja la bomba andando de un pedido al siguiente si
+    éste empieza con el mismo ingrediente (solo con carrusel o un cambio de
+    vaso que no necesite cortar el chorro).
+    """
+    prep = config.get('preparacion', {}) if config else {}
+    try:
+        linea_llena_s = max(0.0, float(prep.get('linea_llena_s', LINEA_LLENA_S_DEFAULT)))
+    except (TypeError, ValueError):
+        linea_llena_s = LINEA_LLENA_S_DEFAULT
+    return linea_llena_s, bool(prep.get('mantener_encendida', False))
+
+def agrupar_pasos(steps, modo):
+    """
+    Divide los pasos en grupos que se vierten uno después de otro.
+    En serie cada paso es su propio grupo; en paralelo se agrupan por `grupo`
+    respetando el orden de aparición.
+    """
+    if modo != MODO_PARALELO:
+        return [(step,) for step in steps]
+    
+    grupos = {}
+    for step in steps:
+        grupos.setdefault(step.grupo, []).append(step)
+    return [tuple(grupo) for grupo in grupos.values()]
+
+def duracion_grupo(grupo, max_bombas):
+    """Tiempo que tarda un grupo respetando el límite de bombas simultáneas"""
+    if len(grupo) == 1:
+        return grupo[0].duration
+    
+    fin = 0.0
+    for inicio, step in _calendario_grupo(grupo, max_bombas):
+        fin = max(fin, inicio + step.duration)
+    return fin
+
+def _calendario_grupo(grupo, max_bombas):
+    """
+    Simula el arranque de cada paso de un grupo en paralelo.
+    Un paso arranca en cuanto hay un hueco libre y su pin no está en uso.
+    Retorna: [(segundo_de_inicio, paso)]
+    """
+    pendientes = list(grupo)
+    activos = []  # heap de (fin, orden, paso)
+    calendario = []
+    ahora = 0.0
+    orden = 0
+    
+    while pendientes or activos:
+        pines_activos = {step.pin for _, _, step in activos}
+        for step in list(pendientes):
+            if len(activos) >= max_bombas:
+                break
+            if step.pin in pines_activos:
+                continue
+            pendientes.remove(step)
+            pines_activos.add(step.pin)
+            calendario.append((ahora, step))
+            heapq.heappush(activos, (ahora + step.duration, orden, step))
+            orden += 1
         
-    return True
+        ahora, _, _ = heapq.heappop(activos)
+    
+    return calendario
+
+def _estimar_total(steps, modo=MODO_SERIE, max_bombas=MAX_BOMBAS_DEFAULT):
+    """Duración de un pedido: grupos más las pausas entre ellos (no después del último)"""
+    grupos = agrupar_pasos(steps, modo)
+    pausas = max(0, len(grupos) - 1) * PAUSA_ENTRE_PASOS
+    return sum(duracion_grupo(g, max_bombas) for g in grupos) + pausas
+
+def compilar_receta(receta, modo=MODO_SERIE, max_bombas=MAX_BOMBAS_DEFAULT):
+    """
+    Convierte una Receta del modelo en un PlanCompilado.
+    Retorna: (plan, None) o (None, mensaje_error)
+    """
+    steps = []
+    
+    for ingrediente in receta.ingredientes:
+        pin = ingrediente.bomba.pin
+        
+        # Calcular tiempo usando calibración
+        rate = CALIBRACION_POR_PIN.get(pin, DEFAULT_RATE)
+        steps.append(Paso(ingrediente.bomba.label, pin, ingrediente.ml, duracion_vertido(pin, ingrediente.ml),
+                          rate, ingrediente.grupo))
+    
+    steps = tuple(steps)
+    total = _estimar_total(steps, modo, max_bombas)
+    return PlanCompilado(receta.id, receta.name, steps, total), None
+
+class PlanIndex:
+    """
+    Tabla receta_id -> PlanCompilado, construida una sola vez por cada
+    versión de pi.json y de la calibración. La búsqueda es un acceso a dict.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (clave, modelo, planes, errores) se reemplaza entero para que las
+        # lecturas sin lock siempre vean una tabla consistente
+        self._tabla = (None, None, {}, {})
+
+    def _compilar(self, modelo):
+        planes = {}
+        errores = dict(modelo.no_disponibles)
+        modo, max_bombas = ajustes_vertido(modelo.config)
+        for receta in modelo.recetas.values():
+            plan, error = compilar_receta(receta, modo, max_bombas)
+            if plan:
+                planes[receta.id] = plan
+            else:
+                errores[receta.id] = error
+        return planes, errores
+
+    def instantanea(self):
+        """
+        Devuelve (modelo, planes, errores) vigentes, recompilando si hace
+        falta. Los planes son los del modelo que viene con ellos: quien
+        necesita las dos cosas (resolver ids y buscar planes) usa esto.
+        """
+        version, modelo = config_store.vigente()
+        if not modelo:
+            return None
+        
+        clave = (version, calibracion_version)
+        tabla = self._tabla
+        if tabla[0] != clave:
+            with self._lock:
+                tabla = self._tabla
+                if tabla[0] != clave:
+                    planes, errores = self._compilar(modelo)
+                    tabla = self._tabla = (clave, modelo, planes, errores)
+        return tabla[1:]
+
+    def tabla(self):
+        """Devuelve (planes, errores) vigentes, recompilando si hace falta"""
+        instantanea = self.instantanea()
+        return instantanea and instantanea[1:]
+
+    def get(self, recipe_id):
+        """Retorna: (PlanCompilado, None) o (None, mensaje_error)"""
+        tabla = self.tabla()
+        if tabla is None:
+            return None, "Error de Config"
+        
+        planes, errores = tabla
+        plan = planes.get(recipe_id)
+        if plan:
+            return plan, None
+        if recipe_id in errores:
+            return None, errores[recipe_id]
+        return None, f"Receta con ID {recipe_id} no encontrada"
+
+plan_index = PlanIndex()
+
+def prepare_preparation_plan(recipe_id):
+    """
+    Convierte un ID de receta en una lista de instrucciones.
+    Usa el índice de planes precompilados (búsqueda O(1)).
+    """
+    plan, error = plan_index.get(recipe_id)
+    if not plan:
+        return None, error
+    return plan.steps, plan.name
+
+# ============================================
+# PLANIFICADOR DE PEDIDOS
+# ============================================
+PRIORIDAD_MANTENIMIENTO = 'mantenimiento'
+PRIORIDAD_VIP = 'vip'
+PRIORIDAD_NORMAL = 'normal'
+
+# Valores por defecto de la sección "planificacion" de pi.json
+VENTAJA_VIP_S = 120             # Un VIP pasa delante de lo pedido hasta 2 min antes
+RETRASO_MANTENIMIENTO_S = 300   # Las pruebas esperan hasta 5 min a los clientes
+PESO_SJF = 1.0                  # Segundos de "castigo" por segundo de preparación
+
+def ajustes_planificacion(config):
+    """Retorna {prioridad: desfase_s}, sjf, peso_sjf según pi.json"""
+    plan = config.get('planificacion', {}) if config else {}
+    desfases = {
+        PRIORIDAD_VIP: -float(plan.get('ventaja_vip_s', VENTAJA_VIP_S)),
+        PRIORIDAD_NORMAL: 0.0,
+        PRIORIDAD_MANTENIMIENTO: float(plan.get('retraso_mantenimiento_s', RETRASO_MANTENIMIENTO_S)),
+    }
+    return desfases, bool(plan.get('sjf', False)), float(plan.get('peso_sjf', PESO_SJF))
+
+class PlanificadorPedidos(Queue):
+    """
+    Reemplaza la cola FIFO. Cada pedido recibe al entrar una clave fija y
+    el worker siempre toma la menor:
+
+        clave = inicio_justo(cliente) + desfase(prioridad) [+ peso_sjf * duración]
+
+    - inicio_justo: reparto equitativo entre clientes (kioscos). Cada cliente
+      tiene un "reloj virtual" que avanza con el tiempo de preparación de sus
+      pedidos, así que quien pide seis tragos de golpe se intercala con el resto.
+    - desfase: los VIP se adelantan y el mantenimiento se atrasa, pero solo
+      hasta un máximo de segundos, por lo que ningún pedido espera para siempre.
+    - sjf (opcional): los tragos cortos se adelantan para bajar la espera media.
+      Entre pedidos de un mismo cliente se mantiene el orden de llegada.
+
+    Como las claves no cambian, la cola es una lista ordenada: la posición de
+    un pedido es una búsqueda binaria. Lo que tiene delante se lleva acumulado
+    por pedido (_antes) y se corrige al entrar o salir uno, así el ETA no
+    vuelve a sumar la cola. Sacar el primero, lo más común, solo mueve _base.
+    """
+    def _init(self, maxsize):
+        self._claves = []       # (clave, seq) ordenadas
+        self._pedidos = []      # pedido de cada clave
+        self._duraciones = []   # tiempo estimado de cada clave
+        self._antes = []        # _antes[i] - _base = tiempo de los pedidos antes del i
+        self._base = 0.0
+        self._total = 0.0
+        self._seq = itertools.count()
+        self._fin_cliente = {}
+        self.cambios = 0        # Cuenta entradas y salidas (para cachear el plan del ETA)
+
+    def _qsize(self):
+        return len(self._claves)
+
+    def _put(self, job):
+        desfases, sjf, peso_sjf = ajustes_planificacion(load_config())
+        ahora = ahora_ns() / 1e9
+        duracion = job['tiempo_estimado']
+        
+        cliente = job.get('cliente')
+        inicio = max(ahora, self._fin_cliente.get(cliente, 0.0))
+        self._fin_cliente[cliente] = inicio + duracion
+        if len(self._fin_cliente) > 1000:
+            self._fin_cliente = {c: fin for c, fin in self._fin_cliente.items() if fin > ahora}
+        
+        clave = inicio + desfases.get(job.get('prioridad'), 0.0)
+        if sjf:
+            clave += peso_sjf * duracion
+        
+        entrada = (clave, next(self._seq))
+        job['clave_planificacion'] = entrada
+        i = bisect.bisect_left(self._claves, entrada)
+        antes = self._antes[i] if i < len(self._antes) else self._total + self._base
+        self._claves.insert(i, entrada)
+        self._pedidos.insert(i, job)
+        self._duraciones.insert(i, duracion)
+        self._antes.insert(i, antes)
+        for k in range(i + 1, len(self._antes)):
+            self._antes[k] += duracion
+        self._total += duracion
+        self.cambios += 1
+
+    def _get(self):
+        return self._sacar(0)
+
+    def _sacar(self, i):
+        """Saca el pedido de la posición i (con self.mutex tomado)"""
+        del self._claves[i]
+        del self._antes[i]
+        duracion = self._duraciones.pop(i)
+        self._total -= duracion
+        self.cambios += 1
+        if not self._claves:
+            self._base = self._total = 0.0  # Sin arrastrar error de redondeo
+        elif i == 0:
+            self._base += duracion
+        else:
+            for k in range(i, len(self._antes)):
+                self._antes[k] -= duracion
+        return self._pedidos.pop(i)
+
+    def put_lote(self, jobs):
+        """Encola todos los pedidos o ninguno: si uno falla, saca los que ya había puesto"""
+        with self.not_full:
+            fin_cliente = dict(self._fin_cliente)
+            puestos = []
+            try:
+                for job in jobs:
+                    self._put(job)
+                    puestos.append(job)
+            except Exception:
+                for job in puestos:
+                    self._sacar(self._indice(job))
+                self._fin_cliente = fin_cliente
+                raise
+            self.unfinished_tasks += len(jobs)
+            self.not_empty.notify(len(jobs))
+
+    def tomar_compatible(self, ocupados, ventana, max_adelantos, pin_inicial=None):
+        """
+        Saca, sin bloquear, el primer pedido de los `ventana` próximos que no
+        use ningún pin de `ocupados` (y, si se indica, que empiece por
+        `pin_inicial`). Un pedido que ya fue pasado `max_adelantos` veces no
+        se puede volver a pasar: si no es compatible se espera a que se
+        liberen sus bombas. Retorna el pedido o None.
+        """
+        with self.mutex:
+            for i, job in enumerate(self._pedidos[:ventana]):
+                if (ocupados.isdisjoint(job['pines']) and
+                        (pin_inicial is None or job['instructions'][0].pin == pin_inicial)):
+                    for anterior in self._pedidos[:i]:
+                        anterior['adelantos'] = anterior.get('adelantos', 0) + 1
+                    self._sacar(i)
+                    self.not_full.notify()
+                    return job
+                if job.get('adelantos', 0) >= max_adelantos:
+                    return None
+            return None
+
+    def quitar(self, job):
+        """Saca `job` de la cola si todavía está. Retorna True si lo sacó."""
+        with self.mutex:
+            i = self._indice(job)
+            if i is None:
+                return False
+            self._sacar(i)
+            self.not_full.notify()
+            return True
+
+    def _indice(self, job):
+        entrada = job.get('clave_planificacion')
+        if entrada is None:
+            return None
+        i = bisect.bisect_left(self._claves, entrada)
+        if i < len(self._claves) and self._claves[i] == entrada:
+            return i
+        return None
+
+    def posicion(self, job):
+        """Posición (1 = el próximo) del pedido en la cola, o None si no está"""
+        with self.mutex:
+            i = self._indice(job)
+            return None if i is None else i + 1
+
+    def en_cola(self):
+        """Copia de los pedidos en cola, en el orden en que se van a preparar"""
+        with self.mutex:
+            return list(self._pedidos)
+
+    def trabajo_antes(self, job):
+        """Segundos estimados de los pedidos que se prepararán antes que `job`"""
+        with self.mutex:
+            i = self._indice(job)
+            return self._antes[i] - self._base if i else 0.0
+
+    def trabajo_total(self):
+        with self.mutex:
+            return self._total
+
+pedidos_queue = PlanificadorPedidos()
+
+# ============================================
+# TEMPORIZADOR DE BOMBAS
+# ============================================
+# Los tiempos de las bombas se miden con el reloj monotónico del driver; los
+# últimos SPIN_FINAL_NS antes del deadline se esperan en espera activa para
+# no depender de la precisión de time.sleep() del scheduler
+def ahora_ns():
+    return bombas.reloj.monotonic_ns()
+
+def esperar_hasta(deadline_ns, interrumpir=None):
+    """Bloquea hasta `deadline_ns` (según el reloj del driver de bombas) o hasta `interrumpir`"""
+    bombas.reloj.esperar_hasta(deadline_ns, interrumpir)
+
+class EstadisticasPulsos:
+    """Tiempo pedido vs. tiempo real encendido de cada paso"""
+    def __init__(self, max_muestras=200):
+        self._lock = threading.Lock()
+        self._muestras = deque(maxlen=max_muestras)
+        self.pasos = 0
+        self._suma_error = 0.0
+        self._suma_error2 = 0.0
+        self._max_error = 0.0
+        self.ultimo = {}  # pin -> segundos del último encendido, como arranque en frío
+
+    def registrar(self, pin, pedido_s, real_s, frio_s=None):
+        error = real_s - pedido_s
+        with self._lock:
+            self.ultimo[pin] = real_s if frio_s is None else frio_s
+            self._muestras.append((pin, pedido_s, real_s))
+            self.pasos += 1
+            self._suma_error += error
+            self._suma_error2 += error * error
+            self._max_error = max(self._max_error, abs(error))
+
+    def resumen(self):
+        with self._lock:
+            n = self.pasos
+            muestras = list(self._muestras)
+            media = self._suma_error / n if n else 0.0
+            varianza = max(0.0, self._suma_error2 / n - media * media) if n else 0.0
+            max_error = self._max_error
+        
+        return {
+            "pasos": n,
+            "error_medio_ms": round(media * 1000, 3),
+            "jitter_ms": round(varianza ** 0.5 * 1000, 3),
+            "error_max_ms": round(max_error * 1000, 3),
+            "ultimos": [
+                {"pin": pin, "pedido_s": round(pedido, 4), "real_s": round(real, 4)}
+                for pin, pedido, real in muestras[-20:]
+            ]
+        }
+
+estadisticas_pulsos = EstadisticasPulsos()
+
+# ============================================
+# MÉTRICAS (PROMETHEUS)
+# ============================================
+# GET /metrics en formato de texto de Prometheus. Anotar una métrica es un
+# deque.append() (atómico en CPython): la admisión y el worker no toman
+# ningún lock. Las anotaciones se suman al leer /metrics, o antes si se
+# juntan demasiadas.
+MAX_ANOTACIONES = 4096
+
+CUBETAS_ADMISION_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+CUBETAS_PARADA_S = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+CUBETAS_ERROR_PASO_S = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+
+CONTADOR = 'counter'
+MEDIDOR = 'gauge'
+HISTOGRAMA = 'histogram'
+
+class Metricas:
+    """Registro de contadores, medidores e histogramas con etiquetas"""
+    def __init__(self):
+        self._anotaciones = deque()
+        self._lock = threading.Lock()
+        self._definiciones = {}  # nombre -> (tipo, ayuda, cubetas o función)
+        self._valores = {}       # nombre -> {etiquetas: valor o [cubetas..., suma, cuenta]}
+
+    def definir(self, nombre, tipo, ayuda, cubetas=None, leer=None):
+        """
+        Declara una métrica. Con `leer` el valor no se anota: se pide al
+        exportar (una función que retorna un número o {etiquetas: número}).
+        """
+        self._definiciones[nombre] = (tipo, ayuda, leer or cubetas)
+        self._valores[nombre] = {}
+
+    def sumar(self, nombre, valor=1, **etiquetas):
+        self._anotaciones.append((nombre, tuple(sorted(etiquetas.items())), valor))
+        if len(self._anotaciones) > MAX_ANOTACIONES:
+            self._acumular()
+
+    # En un histograma cada anotación es una observación
+    observar = sumar
+
+    def _acumular(self):
+        with self._lock:
+            while self._anotaciones:
+                nombre, etiquetas, valor = self._anotaciones.popleft()
+                tipo, _, cubetas = self._definiciones[nombre]
+                valores = self._valores[nombre]
+                if tipo != HISTOGRAMA:
+                    valores[etiquetas] = valores.get(etiquetas, 0) + valor
+                    continue
+                serie = valores.get(etiquetas)
+                if serie is None:
+                    serie = valores[etiquetas] = [0] * (len(cubetas) + 3)  # cubetas, +Inf, suma, cuenta
+                serie[bisect.bisect_left(cubetas, valor)] += 1
+                serie[-2] += valor
+                serie[-1] += 1
+
+    def exportar(self):
+        """Texto para /metrics"""
+        self._acumular()
+        lineas = []
+        with self._lock:
+            for nombre, (tipo, ayuda, extra) in self._definiciones.items():
+                lineas.append(f"# HELP {nombre} {ayuda}")
+                lineas.append(f"# TYPE {nombre} {tipo}")
+                if callable(extra):
+                    valor = extra()
+                    series = valor.items() if isinstance(valor, dict) else [((), valor)]
+                else:
+                    series = sorted(self._valores[nombre].items())
+                for etiquetas, valor in series:
+                    if tipo != HISTOGRAMA:
+                        lineas.append(f"{nombre}{_etiquetas(etiquetas)} {valor}")
+                        continue
+                    acumulado = 0
+                    for limite, cuenta in zip(extra + (float('inf'),), valor):
+                        acumulado += cuenta
+                        le = '+Inf' if limite == float('inf') else repr(limite)
+                        lineas.append(f"{nombre}_bucket{_etiquetas(etiquetas + (('le', le),))} {acumulado}")
+                    lineas.append(f"{nombre}_sum{_etiquetas(etiquetas)} {valor[-2]}")
+                    lineas.append(f"{nombre}_count{_etiquetas(etiquetas)} {valor[-1]}")
+        return "\n".join(lineas) + "\n"
+
+def _etiquetas(etiquetas):
+    if not etiquetas:
+        return ""
+    return "{" + ",".join(f'{clave}="{valor}"' for clave, valor in etiquetas) + "}"
+
+metricas = Metricas()
+
+M_ADMITIDOS = 'bartender_pedidos_admitidos_total'
+M_RECHAZADOS = 'bartender_pedidos_rechazados_total'
+M_TERMINADOS = 'bartender_pedidos_terminados_total'
+M_ADMISION = 'bartender_admision_segundos'
+M_PASOS_PEDIDO = 'bartender_bomba_pedido_segundos_total'
+M_BOMBA_ENCENDIDA = 'bartender_bomba_encendida_segundos_total'
+M_BOMBA_ML = 'bartender_bomba_ml_total'
+M_ERROR_PASO = 'bartender_paso_error_segundos'
+M_WORKER_OCUPADO = 'bartender_worker_ocupado_segundos_total'
+M_WORKER_OCIOSO = 'bartender_worker_ocioso_segundos_total'
+M_PARADA = 'bartender_parada_emergencia_segundos'
+M_VIGILANTE = 'bartender_vigilante_disparos_total'
+
+metricas.definir(M_ADMITIDOS, CONTADOR, "Pedidos admitidos en la cola")
+metricas.definir(M_RECHAZADOS, CONTADOR, "Pedidos rechazados, por motivo")
+metricas.definir(M_TERMINADOS, CONTADOR, "Pedidos terminados, por estado")
+metricas.definir(M_ADMISION, HISTOGRAMA, "Latencia de los endpoints que admiten pedidos",
+                 cubetas=CUBETAS_ADMISION_S)
+metricas.definir(M_PASOS_PEDIDO, CONTADOR, "Segundos de bomba pedidos, por pin")
+metricas.definir(M_BOMBA_ENCENDIDA, CONTADOR, "Segundos reales de bomba encendida, por pin")
+metricas.definir(M_BOMBA_ML, CONTADOR, "ml servidos, por pin")
+metricas.definir(M_ERROR_PASO, HISTOGRAMA, "Diferencia absoluta entre el encendido pedido y el real",
+                 cubetas=CUBETAS_ERROR_PASO_S)
+metricas.definir(M_PARADA, HISTOGRAMA, "Desde POST /parar hasta que quedaron todas las bombas apagadas",
+                 cubetas=CUBETAS_PARADA_S)
+metricas.definir(M_VIGILANTE, CONTADOR, "Paradas de emergencia del vigilante de bombas, por motivo")
+metricas.definir(M_WORKER_OCUPADO, CONTADOR, "Segundos del worker preparando pedidos")
+metricas.definir(M_WORKER_OCIOSO, CONTADOR, "Segundos del worker esperando pedidos")
+metricas.definir('bartender_cola_pedidos', MEDIDOR, "Pedidos esperando en la cola",
+                 leer=lambda: pedidos_queue.qsize())
+metricas.definir('bartender_vasos_en_preparacion', MEDIDOR, "Pedidos que se están sirviendo",
+                 leer=lambda: len(pedidos.en_curso))
+metricas.definir('bartender_clientes_eventos', MEDIDOR, "Clientes conectados a /eventos",
+                 leer=lambda: eventos.conectados())
+metricas.definir('bartender_config_recargas_total', CONTADOR, "Veces que se recargó pi.json",
+                 leer=lambda: config_store.recargas)
+metricas.definir('bartender_config_rechazos_total', CONTADOR, "Versiones de pi.json rechazadas por inválidas",
+                 leer=lambda: config_store.rechazos)
+metricas.definir('bartender_log_descartados_total', CONTADOR, "Mensajes de log descartados por cola llena",
+                 leer=lambda: log.descartados)
+
+def medir_admision(endpoint):
+    """Decorador: anota la latencia del endpoint en bartender_admision_segundos"""
+    @functools.wraps(endpoint)
+    def medido(*args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            metricas.observar(M_ADMISION, time.perf_counter() - inicio, endpoint=endpoint.__name__)
+    return medido
+
+# ============================================
+# EVENTOS DE PEDIDOS (SSE)
+# ============================================
+# Tipos de evento que recibe un cliente de /eventos
+EVENTO_EN_COLA = 'en_cola'
+EVENTO_INICIADO = 'iniciado'
+EVENTO_PASO_INICIADO = 'paso_iniciado'
+EVENTO_PASO_TERMINADO = 'paso_terminado'
+EVENTO_COMPLETADO = 'completado'
+EVENTO_FALLIDO = 'fallido'
+EVENTO_CANCELADO = 'cancelado'
+EVENTO_INTERRUMPIDO = 'interrumpido'
+
+SSE_KEEPALIVE_S = 15  # Comentario periódico para que proxies no corten la conexión
+
+_contador_pedidos = itertools.count(1)
+
+def nuevo_pedido_id():
+    """Id incremental que identifica a un pedido en respuestas y eventos"""
+    return next(_contador_pedidos)
+
+class Suscripcion:
+    """
+    Eventos pendientes de un cliente conectado (se descartan los más viejos).
+    Con `avisar` no se usa un threading.Event: se llama a esa función en cada
+    entrega (así despierta a un cliente que espera en el event loop).
+    """
+    def __init__(self, pedido_id=None, max_pendientes=256, avisar=None):
+        self.pedido_id = pedido_id
+        self._pendientes = deque(maxlen=max_pendientes)
+        self._aviso = threading.Event()
+        self._avisar = avisar or self._aviso.set
+
+    def entregar(self, evento):
+        if self.pedido_id is None or evento[1] == self.pedido_id:
+            self._pendientes.append(evento)
+            self._avisar()
+
+    def esperar(self, timeout):
+        """Retorna los eventos pendientes (lista vacía si venció el timeout)"""
+        if not self._aviso.wait(timeout):
+            return []
+        self._aviso.clear()
+        return self.tomar()
+
+    def tomar(self):
+        """Saca los eventos pendientes sin esperar"""
+        eventos = []
+        while self._pendientes:
+            eventos.append(self._pendientes.popleft())
+        return eventos
+
+class BusEventos:
+    """
+    Publica eventos de pedidos a todos los clientes conectados. Cada evento
+    se serializa una sola vez y se guarda un historial corto para que un
+    cliente que se reconecta (Last-Event-ID) no pierda nada.
+    """
+    def __init__(self, historial=500):
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._historial = deque(maxlen=historial)
+        self._suscriptores = set()
+
+    def publicar(self, tipo, pedido_id, **datos):
+        datos['pedido_id'] = pedido_id
+        datos['t'] = time.time()
+        with self._lock:
+            self._seq += 1
+            texto = f"id: {self._seq}\nevent: {tipo}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+            evento = (self._seq, pedido_id, texto)
+            self._historial.append(evento)
+            # Entregar bajo el lock: todos los clientes reciben los eventos en orden de id
+            for suscripcion in self._suscriptores:
+                suscripcion.entregar(evento)
+
+    def suscribir(self, pedido_id=None, desde=None, avisar=None):
+        suscripcion = Suscripcion(pedido_id, avisar=avisar)
+        with self._lock:
+            if desde is not None:
+                for evento in self._historial:
+                    if evento[0] > desde:
+                        suscripcion.entregar(evento)
+            self._suscriptores.add(suscripcion)
+        return suscripcion
+
+    def desuscribir(self, suscripcion):
+        with self._lock:
+            self._suscriptores.discard(suscripcion)
+
+    def conectados(self):
+        with self._lock:
+            return len(self._suscriptores)
+
+eventos = BusEventos()
+
+# ============================================
+# MOTOR DE ETA
+# ============================================
+# Estados de un pedido
+ESTADO_EN_COLA = 'en_cola'
+ESTADO_PREPARANDO = 'preparando'
+ESTADO_COMPLETADO = 'completado'
+ESTADO_FALLIDO = 'fallido'
+ESTADO_CANCELADO = 'cancelado'
+
+ETA_RECALCULO_S = 1.0  # Con varios vasos, cada cuánto se vuelve a simular la cola aunque no cambie
+
+def tramos_pedido(job, modo, max_bombas, factor=1.0):
+    """
+    Lo que hace el pedido en la estación, tramo por tramo: [segundos, pines
+    que todavía tiene reservados, bombas encendidas] de cada grupo de pasos
+    y de cada pausa entre grupos (sin bombas).
+    """
+    grupos = agrupar_pasos(job['instructions'], job.get('modo', modo))
+    tramos = []
+    for i, grupo in enumerate(grupos):
+        pines = frozenset(step.pin for siguiente in grupos[i:] for step in siguiente)
+        if i:
+            tramos.append([PAUSA_ENTRE_PASOS, pines, 0])
+        tramos.append([factor * duracion_grupo(grupo, max_bombas), pines, min(len(grupo), max_bombas)])
+    return tramos
+
+def ajustes_eta(config):
+    """Lo que la simulación de la cola necesita de pi.json"""
+    return ajustes_estacion(config) + ajustes_vertido(config)
+
+class MotorETA:
+    """
+    Estima cuándo estará listo cada pedido:
+    - lo que hay delante de un pedido en cola lo da el planificador, que lo
+      lleva acumulado por pedido (igual que el total) al entrar y salir pedidos;
+    - cada pedido en curso se mide con el fin previsto del grupo de pasos que
+      se está vertiendo más lo que le queda después;
+    - con varios vasos a la vez la suma no sirve: se simula la cola como la
+      atiende la Estacion (vasos libres, ventana, adelantos y pines ocupados)
+      y se guarda el fin de cada pedido hasta que cambie la cola o lo que
+      está en curso (o pase ETA_RECALCULO_S). Las max_bombas_simultaneas
+      van primero a los vasos más viejos y un vaso que consigue menos
+      bombas de las que pide avanza más lento en esa proporción;
+    - un factor de corrección aprende de los pedidos terminados cuánto
+      tardan de verdad respecto de lo estimado.
+    """
+    def __init__(self, suavizado=0.2):
+        self._lock = threading.Lock()
+        self.suavizado = suavizado
+        self.factor = 1.0
+        self._en_curso = {}  # pedido_id -> [fin_grupo_ns, restante_despues, pines reservados, bombas encendidas]
+        self._cambios = 0
+        self._plan = (None, 0, {})  # (clave, calculado_ns, pedido_id -> fin_ns)
+
+    def iniciar(self, job):
+        with self._lock:
+            self._en_curso[job['pedido_id']] = [job['inicio_ns'], job['tiempo_estimado'], job['pines'], 1]
+            self._cambios += 1
+
+    def avance(self, job, fin_grupo_ns, restante_despues, pines, bombas_grupo):
+        """
+        El worker avisa el fin previsto del grupo en curso, lo que queda
+        después, los pines que el vaso todavía usa y cuántas bombas enciende
+        """
+        with self._lock:
+            actual = self._en_curso.get(job['pedido_id'])
+            if actual is not None:
+                actual[:] = [fin_grupo_ns, restante_despues, pines, bombas_grupo]
+                self._cambios += 1
+
+    def terminar(self, job):
+        with self._lock:
+            self._en_curso.pop(job.get('pedido_id'), None)
+            self._cambios += 1
+            estimado = job['tiempo_estimado']
+            if 'fin_ns' in job and 'inicio_ns' in job and estimado > 0:
+                ratio = (job['fin_ns'] - job['inicio_ns']) / 1e9 / estimado
+                ratio = min(2.0, max(0.5, ratio))
+                self.factor += self.suavizado * (ratio - self.factor)
+
+    def _restante(self, actual, ahora):
+        fin_grupo_ns, restante_despues = actual[:2]
+        return max(0.0, (fin_grupo_ns - ahora) / 1e9) + self.factor * restante_despues
+
+    def _restante_actual(self, ahora):
+        return max((self._restante(actual, ahora) for actual in self._en_curso.values()), default=0.0)
+
+    def _simular(self, cola, ajustes, ahora):
+        """pedido_id -> fin_ns de cada pedido de `cola`, atendida como la Estacion"""
+        max_vasos, ventana, max_adelantos, modo, max_bombas = ajustes
+        # (pedido_id, tramos); de los vasos en curso se conoce lo que les falta en total
+        vasos = [(None, [[self._restante(actual, ahora), actual[2], actual[3]]])
+                 for actual in self._en_curso.values()]
+        pendientes = [[job, job.get('adelantos', 0)] for job in cola]
+        fines = {}
+        reloj = ahora
+        while pendientes or vasos:
+            ocupados = frozenset().union(*(tramos[0][1] for _, tramos in vasos))
+            while len(vasos) < max_vasos and pendientes:
+                elegido = None
+                for i, (job, pasado) in enumerate(pendientes[:ventana]):
+                    if ocupados.isdisjoint(job['pines']):
+                        elegido = i
+                        break
+                    if pasado >= max_adelantos:
+                        break
+                if elegido is None:
+                    break
+                for anterior in pendientes[:elegido]:
+                    anterior[1] += 1
+                job, _ = pendientes.pop(elegido)
+                vasos.append((job['pedido_id'], tramos_pedido(job, modo, max_bombas, self.factor)))
+                ocupados = ocupados | job['pines']
+
+            # Las bombas libres van primero a los vasos más viejos (como
+            # _encender); un vaso con menos de las que pide avanza más lento
+            libres = max_bombas
+            ritmos = []
+            for _, tramos in vasos:
+                pedidas = tramos[0][2]
+                if not pedidas:
+                    ritmos.append(1.0)
+                    continue
+                tiene = min(pedidas, libres)
+                libres -= tiene
+                ritmos.append(tiene / pedidas)
+            avance = min(tramos[0][0] / r for (_, tramos), r in zip(vasos, ritmos) if r > 0)
+            reloj += int(avance * 1e9)
+            siguen = []
+            for (pedido_id, tramos), r in zip(vasos, ritmos):
+                tramos[0][0] -= avance * r
+                if tramos[0][0] <= 1e-9:
+                    tramos.pop(0)
+                if tramos:
+                    siguen.append((pedido_id, tramos))
+                elif pedido_id is not None:
+                    fines[pedido_id] = reloj
+            vasos = siguen
+        return fines
+
+    def _plan_cola(self, ahora, ajustes):
+        """Fines simulados de la cola (del caché si nada cambió)"""
+        cambios = pedidos_queue.cambios
+        cola = pedidos_queue.en_cola()
+        with self._lock:
+            clave = (cambios, self._cambios, ajustes, self.factor)
+            anterior, calculado, fines = self._plan
+            if anterior != clave or ahora - calculado > ETA_RECALCULO_S * 1e9:
+                fines = self._simular(cola, ajustes, ahora)
+                self._plan = (clave, ahora, fines)
+            return fines
+
+    def eta(self, job):
+        """Segundos hasta que `job` esté listo"""
+        estado = job.get('estado')
+        if estado not in (ESTADO_EN_COLA, ESTADO_PREPARANDO):
+            return 0.0
+        
+        ahora = ahora_ns()
+        if estado == ESTADO_PREPARANDO:
+            with self._lock:
+                actual = self._en_curso.get(job['pedido_id'])
+                return self._restante(actual, ahora) if actual else 0.0
+        
+        ajustes = ajustes_eta(load_config())
+        if ajustes[0] > 1:
+            fin = self._plan_cola(ahora, ajustes).get(job['pedido_id'])
+            if fin is not None:
+                return max(0.0, (fin - ahora) / 1e9)
+        
+        antes = pedidos_queue.trabajo_antes(job) + job['tiempo_estimado']
+        with self._lock:
+            return self._restante_actual(ahora) + self.factor * antes
+
+    def trabajo_pendiente(self):
+        """Segundos hasta vaciar la cola (con un vaso por vez, la suma del trabajo)"""
+        ahora = ahora_ns()
+        ajustes = ajustes_eta(load_config())
+        if ajustes[0] > 1:
+            fines = self._plan_cola(ahora, ajustes)
+            with self._lock:
+                restante = self._restante_actual(ahora)
+            return max([restante] + [(fin - ahora) / 1e9 for fin in fines.values()])
+        
+        en_cola = pedidos_queue.trabajo_total()
+        with self._lock:
+            return self._restante_actual(ahora) + self.factor * en_cola
+
+motor_eta = MotorETA()
+
+# ============================================
+# INVENTARIO DE BOTELLAS
+# ============================================
+# Las bombas con "capacidad_ml" en pi.json llevan control de nivel; el nivel
+# actual se guarda en PI_INVENTARIO ('' = no guardar) para sobrevivir reinicios
+INVENTARIO_PATH = os.environ.get('PI_INVENTARIO', 'inventario.json')
+INVENTARIO_GUARDADO_S = 2.0   # Como mucho un guardado cada tanto (tarjeta SD)
+ALERTA_STOCK_PCT = 20         # Por debajo de esto /inventario marca "bajo"
+
+class Inventario:
+    """
+    Nivel de cada botella por pin. Al admitir un pedido se reserva todo lo
+    que va a usar, así la cola nunca promete más de lo que hay; al terminar
+    cada paso se descuenta lo servido de verdad y se libera su reserva.
+    Reservar es un recorrido por los ingredientes del pedido bajo un lock.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.capacidad = {}   # pin -> ml
+        self.nivel = {}       # pin -> ml en la botella
+        self.reservado = {}   # pin -> ml prometidos a pedidos en cola o en curso
+        self._sucio = threading.Event()
+        self._guardando = False
+
+    def configurar(self, modelo):
+        """Toma las capacidades de pi.json; las botellas nuevas arrancan llenas"""
+        guardado = self._leer()
+        capacidad = {}
+        for bomba in modelo.bombas.values():
+            if bomba.capacidad_ml is not None:
+                capacidad[bomba.pin] = float(bomba.capacidad_ml)
+
+        with self._lock:
+            for pin, ml in capacidad.items():
+                if pin not in self.nivel:
+                    self.nivel[pin] = min(ml, guardado.get(pin, ml))
+                self.reservado.setdefault(pin, 0.0)
+            for pin in set(self.nivel) - set(capacidad):
+                del self.nivel[pin]
+                del self.reservado[pin]
+            self.capacidad = capacidad
+
+        if self.path and not self._guardando:
+            self._guardando = True
+            threading.Thread(target=self._guardar, daemon=True).start()
+
+    def reservar(self, consumo, forzar=False):
+        """
+        Reserva {pin: ml}, todo o nada.
+        Retorna None o el pin cuya botella no alcanza.
+        """
+        with self._lock:
+            if not forzar:
+                for pin, ml in consumo.items():
+                    if pin in self.nivel and self.nivel[pin] - self.reservado[pin] < ml:
+                        return pin
+            for pin, ml in consumo.items():
+                if pin in self.reservado:
+                    self.reservado[pin] += ml
+        return None
+
+    def liberar(self, consumo):
+        with self._lock:
+            for pin, ml in consumo.items():
+                if pin in self.reservado:
+                    self.reservado[pin] = max(0.0, self.reservado[pin] - ml)
+
+    def servido(self, pin, reservado_ml, servido_ml):
+        """Un paso terminó: descuenta lo servido y libera lo que tenía reservado"""
+        with self._lock:
+            if pin not in self.nivel:
+                return
+            self.reservado[pin] = max(0.0, self.reservado[pin] - reservado_ml)
+            self.nivel[pin] = max(0.0, self.nivel[pin] - servido_ml)
+        self._sucio.set()
+
+    def rellenar(self, pin, nivel_ml=None):
+        """Repone una botella (llena si no se indica el nivel). False si no se controla."""
+        with self._lock:
+            if pin not in self.capacidad:
+                return False
+            ml = self.capacidad[pin] if nivel_ml is None else nivel_ml
+            self.nivel[pin] = max(0.0, min(self.capacidad[pin], float(ml)))
+        self._sucio.set()
+        return True
+
+    def estado(self, pin):
+        """(capacidad, nivel, reservado) de un pin o None si no se controla"""
+        with self._lock:
+            if pin not in self.capacidad:
+                return None
+            return self.capacidad[pin], self.nivel[pin], self.reservado[pin]
+
+    def _leer(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return {int(pin): float(ml) for pin, ml in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            return {}
+
+    def _guardar(self):
+        while True:
+            self._sucio.wait()
+            time.sleep(INVENTARIO_GUARDADO_S)
+            self._sucio.clear()
+            with self._lock:
+                niveles = {str(pin): round(ml, 1) for pin, ml in self.nivel.items()}
+            try:
+                temporal = self.path + '.tmp'
+                with open(temporal, 'w', encoding='utf-8') as f:
+                    json.dump(niveles, f)
+                os.replace(temporal, self.path)
+            except OSError as e:
+                log.error(f"❌ Error guardando el inventario: {e}")
+
+inventario = Inventario(INVENTARIO_PATH)
+
+def consumo_de(instructions):
+    """ml que usa cada pin en un plan: {pin: ml}"""
+    consumo = {}
+    for step in instructions:
+        if step.amount > 0:
+            consumo[step.pin] = consumo.get(step.pin, 0) + step.amount
+    return consumo
+
+# ============================================
+# TABLA DE PEDIDOS
+# ============================================
+MAX_PEDIDOS_ACTIVOS = 200     # Pedidos en cola + preparando
+MAX_PEDIDOS_TERMINADOS = 500  # Terminados que se siguen pudiendo consultar
+TTL_TERMINADOS_S = 15 * 60    # ...y por cuánto tiempo
+
+# Motivos por los que se rechaza un pedido (y su código HTTP)
+RECHAZO_COLA_LLENA = 'cola_llena'
+RECHAZO_SIN_STOCK = 'sin_stock'
+CODIGO_RECHAZO = {RECHAZO_COLA_LLENA: 503, RECHAZO_SIN_STOCK: 409}
+
+class TablaPedidos:
+    """
+    Todos los pedidos por id, para responder "¿dónde está mi trago?" sin
+    recorrer la cola. La posición la da el planificador y los tiempos
+    estimados `motor_eta`. Los pedidos terminados se descartan por TTL y
+    por cantidad.
+    """
+    def __init__(self, max_activos=MAX_PEDIDOS_ACTIVOS,
+                 max_terminados=MAX_PEDIDOS_TERMINADOS, ttl_s=TTL_TERMINADOS_S):
+        self.lock = threading.Lock()
+        self.max_activos = max_activos
+        self.max_terminados = max_terminados
+        self.ttl_s = ttl_s
+        self._pedidos = {}
+        self._terminados = deque()  # (terminado_monotonic, pedido_id) en orden
+        self._activos = 0
+        self.en_curso = {}  # pedido_id -> pedido, los que se están preparando
+
+    def admitir(self, job, cola):
+        """
+        Reserva los ingredientes, registra el pedido y lo encola.
+        Retorna None o (motivo, mensaje) si se rechaza.
+        """
+        return self.admitir_lote((job,), cola)
+
+    def admitir_lote(self, jobs, cola):
+        """Como admitir(), pero entran todos los pedidos o ninguno"""
+        with self.lock:
+            self._purgar()
+            if self._activos + len(jobs) > self.max_activos:
+                return RECHAZO_COLA_LLENA, "Cola llena, intenta en unos minutos"
+            
+            consumo = jobs[0]['reserva'] if len(jobs) == 1 else {}
+            if len(jobs) > 1:
+                for job in jobs:
+                    for pin, ml in job['reserva'].items():
+                        consumo[pin] = consumo.get(pin, 0) + ml
+            faltante = inventario.reservar(consumo)
+            if faltante is not None:
+                nombre = next(step.name for job in jobs for step in job['instructions'] if step.pin == faltante)
+                return RECHAZO_SIN_STOCK, f"No queda suficiente {nombre}"
+            
+            # Primero la cola (todo o nada); recién con los pedidos adentro se
+            # registran y se anotan en el diario
+            for job in jobs:
+                job['estado'] = ESTADO_EN_COLA
+            try:
+                cola.put_lote(jobs)
+            except Exception:
+                inventario.liberar(consumo)
+                raise
+            
+            for job in jobs:
+                self._pedidos[job['pedido_id']] = job
+                self._activos += 1
+                if diario.activo:
+                    diario.registrar(REG_ADMITIDO, job['pedido_id'], **registro_admision(job))
+        return None
+
+    def restaurar(self, job, cola, estado):
+        """Vuelve a cargar un pedido recuperado del diario (sin anotarlo de nuevo)"""
+        with self.lock:
+            job['estado'] = estado
+            self._pedidos[job['pedido_id']] = job
+            if cola is None:
+                self._terminados.append((time.monotonic(), job['pedido_id']))
+            else:
+                cola.put(job)  # Si falla no quedó nada a medias
+                self._activos += 1
+                inventario.reservar(job['reserva'], forzar=True)
+
+    def cancelar(self, job, cola, estado=ESTADO_CANCELADO):
+        """Saca de `cola` un pedido que todavía no empezó. False si ya no está en cola."""
+        with self.lock:
+            if job['estado'] != ESTADO_EN_COLA or not cola.quitar(job):
+                return False
+        self.terminar(job, estado)
+        cola.task_done()
+        return True
+
+    def iniciar(self, job):
+        with self.lock:
+            job['estado'] = ESTADO_PREPARANDO
+            self.en_curso[job['pedido_id']] = job
+            motor_eta.iniciar(job)
+
+    def terminar(self, job, estado):
+        with self.lock:
+            job['estado'] = estado
+            self.en_curso.pop(job.get('pedido_id'), None)
+            inventario.liberar(job.get('reserva', {}))
+            diario.registrar(REG_TERMINADO, job.get('pedido_id'), estado=estado)
+            motor_eta.terminar(job)
+            if job.get('pedido_id') in self._pedidos:
+                self._activos -= 1
+                self._terminados.append((time.monotonic(), job['pedido_id']))
+            self._purgar()
+        metricas.sumar(M_TERMINADOS, estado=estado)
+
+    def _purgar(self):
+        limite = time.monotonic() - self.ttl_s
+        while self._terminados and (self._terminados[0][0] < limite or
+                                    len(self._terminados) > self.max_terminados):
+            _, pedido_id = self._terminados.popleft()
+            self._pedidos.pop(pedido_id, None)
+
+    def get(self, pedido_id):
+        return self._pedidos.get(pedido_id)
+
+    def activos(self):
+        return self._activos
+
+pedidos = TablaPedidos()
+
+_contador_rondas = itertools.count(1)
+
+def nuevo_job(recipe_name, instructions, tiempo_estimado, **extra):
+    return {
+        "pedido_id": nuevo_pedido_id(),
+        "recipe_name": recipe_name,
+        "instructions": instructions,
+        "pines": frozenset(step.pin for step in instructions),
+        "reserva": consumo_de(instructions),  # ml reservados que falta servir
+        "tiempo_estimado": tiempo_estimado,
+        "timestamp": time.time(),
+        "admitido_ns": ahora_ns(),
+        **extra
+    }
+
+def error_pasos(job, modelo):
+    """
+    Motivo por el que `job` ya no se puede servir con `modelo` (o None): un
+    paso de receta cuyo pin ya no tiene bomba o tiene otra bebida. Las
+    duraciones se recalculan al encender, así que no hace falta mirarlas.
+    Las pruebas manuales (ml = 0) pueden usar cualquier pin.
+    """
+    for step in job['instructions']:
+        if step.amount <= 0:
+            continue
+        bomba = modelo.por_pin.get(step.pin) if modelo else None
+        if bomba is None or bomba.label != step.name:
+            return f"La bomba de {step.name} (pin {step.pin}) ya no está en pi.json"
+    return None
+
+def revalidar_cola(modelo):
+    """Tras recargar pi.json, da por fallidos los pedidos en cola que ya no se pueden servir"""
+    for job in pedidos_queue.en_cola():
+        error = error_pasos(job, modelo)
+        if error and pedidos.cancelar(job, pedidos_queue, ESTADO_FALLIDO):
+            job['error'] = error
+            eventos.publicar(EVENTO_FALLIDO, job['pedido_id'], error=error)
+            log.aviso(f"⚠️ Pedido {job['pedido_id']} ({job['recipe_name']}) descartado: {error}",
+                      pedido_id=job['pedido_id'], error=error)
+
+def _anunciar(job):
+    """Calcula el ETA de admisión del pedido y publica el evento en_cola"""
+    job['eta_admision_s'] = motor_eta.eta(job)
+    eventos.publicar(EVENTO_EN_COLA, job['pedido_id'], receta=job['recipe_name'],
+                     tiempo_estimado_s=round(job['tiempo_estimado'], 1),
+                     eta_s=round(job['eta_admision_s'], 1), ronda=job.get('ronda'))
+
+def encolar_pedido(recipe_name, instructions, tiempo_estimado, **extra):
+    """
+    Crea el pedido, lo registra en la tabla y lo pone en pedidos_queue.
+    Retorna (pedido, None) o (None, (motivo, mensaje)) si se rechaza.
+    """
+    job = nuevo_job(recipe_name, instructions, tiempo_estimado, **extra)
+    rechazo = pedidos.admitir(job, pedidos_queue)
+    if rechazo:
+        metricas.sumar(M_RECHAZADOS, motivo=rechazo[0])
+        return None, rechazo
+    
+    metricas.sumar(M_ADMITIDOS)
+    _anunciar(job)
+    return job, None
+
+def encolar_ronda(planes, **extra):
+    """
+    Encola un pedido por cada PlanCompilado de `planes`, todos juntos o
+    ninguno. Los pedidos comparten el id de ronda.
+    Retorna (ronda_id, [pedidos], None) o (None, None, (motivo, mensaje)).
+    """
+    ronda_id = next(_contador_rondas)
+    jobs = [nuevo_job(plan.name, plan.steps, plan.total_estimado, ronda=ronda_id, **extra)
+            for plan in planes]
+    rechazo = pedidos.admitir_lote(jobs, pedidos_queue)
+    if rechazo:
+        metricas.sumar(M_RECHAZADOS, len(jobs), motivo=rechazo[0])
+        return None, None, rechazo
+    
+    metricas.sumar(M_ADMITIDOS, len(jobs))
+    for job in jobs:
+        _anunciar(job)
+    return ronda_id, jobs, None
+
+def respuesta_rechazo(rechazo):
+    motivo, mensaje = rechazo
+    return jsonify({"status": "error", "motivo": motivo, "mensaje": mensaje}), CODIGO_RECHAZO[motivo]
+
+def listo_a_las(eta_s):
+    """Hora (ISO) a la que se espera tener listo un pedido"""
+    return datetime.fromtimestamp(time.time() + eta_s).isoformat(timespec='seconds')
+
+# ============================================
+# DIARIO DE PEDIDOS (WAL)
+# ============================================
+# Cada admisión, paso y fin de pedido se anota en un archivo de solo-agregar
+# para que un reinicio a mitad de la noche no pierda la cola. PI_DIARIO=''
+# lo desactiva.
+DIARIO_PATH = os.environ.get('PI_DIARIO', 'pedidos.journal')
+DIARIO_FSYNC_S = 0.05                # Cada cuánto se bajan los registros a disco
+DIARIO_MAX_BYTES = 256 * 1024        # Al pasarlo se compacta (tarjeta SD chica)
+
+# Tipos de registro
+REG_ADMITIDO = 'admitido'
+REG_PASO_INICIADO = 'paso_iniciado'
+REG_PASO_TERMINADO = 'paso_terminado'
+REG_TERMINADO = 'terminado'
+
+ESTADO_INTERRUMPIDO = 'interrumpido'  # Se cortó a mitad de un vertido: revisar
+
+class DiarioPedidos:
+    """
+    Write-ahead log de pedidos en líneas JSON.
+
+    registrar() solo agrega el registro a una deque (barato, se llama desde la
+    admisión y desde el worker sin hacer I/O). Un hilo aparte escribe lo
+    acumulado y hace un único fsync cada DIARIO_FSYNC_S, así que la admisión
+    nunca espera al disco. Ese hilo lleva también el estado de los pedidos
+    vivos y, cuando el archivo pasa DIARIO_MAX_BYTES, lo reescribe solo con
+    ellos (archivo temporal + os.replace, que es atómico).
+    """
+    def __init__(self, path):
+        self.path = path
+        self._pendientes = deque()
+        self._aviso = threading.Event()
+        self._archivo = None
+        self._vivos = {}  # pedido_id -> [registros]
+        self._bytes = 0
+        self.escritos = 0
+        self.compactaciones = 0
+
+    @property
+    def activo(self):
+        return self._archivo is not None
+
+    def registrar(self, tipo, pedido_id, **datos):
+        if self._archivo is None:
+            return
+        datos['tipo'] = tipo
+        datos['id'] = pedido_id
+        datos['t'] = time.time()
+        self._pendientes.append(datos)
+        self._aviso.set()
+
+    def leer(self):
+        """Registros del diario (se ignora una última línea a medio escribir)"""
+        registros = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for linea in f:
+                    try:
+                        registros.append(json.loads(linea))
+                    except ValueError:
+                        break
+        except FileNotFoundError:
+            pass
+        return registros
+
+    def abrir(self, vivos):
+        """
+        Empieza a escribir, partiendo de un diario compactado con `vivos`
+        ({pedido_id: [registros]}, lo que sobrevivió a la recuperación).
+        """
+        self._vivos = vivos
+        self._compactar()
+        threading.Thread(target=self._escribir, daemon=True).start()
+
+    def _escribir(self):
+        while True:
+            self._aviso.wait()
+            self._aviso.clear()
+
+            lineas = []
+            while self._pendientes:
+                registro = self._pendientes.popleft()
+                self._seguir(registro)
+                lineas.append(json.dumps(registro, ensure_ascii=False) + "\n")
+            if not lineas:
+                continue
+
+            try:
+                texto = "".join(lineas)
+                self._archivo.write(texto)
+                self._archivo.flush()
+                os.fsync(self._archivo.fileno())
+                self._bytes += len(texto.encode('utf-8'))
+                self.escritos += len(lineas)
+                if self._bytes > DIARIO_MAX_BYTES:
+                    self._compactar()
+            except OSError as e:
+                log.error(f"❌ Error escribiendo el diario: {e}")
+
+            # Agrupar lo que llegue mientras tanto en el próximo fsync
+            time.sleep(DIARIO_FSYNC_S)
+
+    def _seguir(self, registro):
+        """Mantiene los registros de los pedidos que siguen vivos"""
+        pedido_id = registro['id']
+        if registro['tipo'] == REG_TERMINADO:
+            self._vivos.pop(pedido_id, None)
+        elif registro['tipo'] == REG_ADMITIDO:
+            self._vivos[pedido_id] = [registro]
+        elif pedido_id in self._vivos:
+            self._vivos[pedido_id].append(registro)
+
+    def _compactar(self):
+        temporal = self.path + '.tmp'
+        with open(temporal, 'w', encoding='utf-8') as f:
+            for registros in self._vivos.values():
+                for registro in registros:
+                    f.write(json.dumps(registro, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, self.path)
+
+        if self._archivo:
+            self._archivo.close()
+        self._archivo = open(self.path, 'a', encoding='utf-8')
+        self._bytes = self._archivo.tell()
+        self.compactaciones += 1
+
+diario = DiarioPedidos(DIARIO_PATH)
+pedidos_interrumpidos = []  # Para que el operador revise el vaso
+
+def registro_admision(job):
+    """Lo necesario para volver a encolar el pedido después de un reinicio"""
+    return {
+        "receta": job['recipe_name'],
+        "pasos": [list(step) for step in job['instructions']],
+        "tiempo_estimado": job['tiempo_estimado'],
+        "timestamp": job['timestamp'],
+        **{clave: job[clave] for clave in ('modo', 'prioridad', 'cliente', 'ronda') if clave in job}
+    }
+
+def recuperar_pedidos():
+    """
+    Reproduce el diario al arrancar (antes de lanzar el worker):
+    - pedidos admitidos que no llegaron a empezar: vuelven a la cola;
+    - pedidos que ya habían empezado a verter: quedan 'interrumpido' con lo
+      que se alcanzó a servir, para que el operador revise el vaso.
+    Un registro que no se pueda reconstruir se anota en el log y se descarta
+    (no impide arrancar). Después deja el diario compactado y empieza a escribir.
+    """
+    global _contador_pedidos, _contador_rondas
+
+    if not diario.path:
+        return
+
+    admitidos = {}
+    pasos = {}
+    for registro in diario.leer():
+        pedido_id = registro.get('id') if isinstance(registro, dict) else None
+        if isinstance(pedido_id, bool) or not isinstance(pedido_id, int):
+            log.error(f"❌ Registro del diario descartado: {registro!r}")
+            continue
+        tipo = registro.get('tipo')
+        if tipo == REG_ADMITIDO:
+            admitidos[pedido_id] = registro
+            pasos[pedido_id] = {}
+        elif tipo == REG_TERMINADO:
+            admitidos.pop(pedido_id, None)
+        elif pedido_id in admitidos and tipo in (REG_PASO_INICIADO, REG_PASO_TERMINADO):
+            pasos[pedido_id][registro.get('paso')] = registro.get('real_s')
+
+    vivos = {}
+    jobs = []
+    for pedido_id, registro in sorted(admitidos.items()):
+        try:
+            instructions = tuple(Paso(*campos) for campos in registro['pasos'])
+            extra = {clave: registro[clave] for clave in ('modo', 'prioridad', 'cliente', 'ronda')
+                     if clave in registro}
+            job = nuevo_job(registro['receta'], instructions, registro['tiempo_estimado'], **extra)
+            job['pedido_id'] = pedido_id
+            job['timestamp'] = registro['timestamp']
+            if not pasos[pedido_id]:
+                pedidos.restaurar(job, pedidos_queue, ESTADO_EN_COLA)
+        except (KeyError, TypeError, ValueError) as e:
+            log.error(f"❌ Registro del diario descartado (pedido {pedido_id}): {e!r}", pedido_id=pedido_id)
+            continue
+
+        if not pasos[pedido_id]:
+            vivos[pedido_id] = [registro]
+            jobs.append(job)
+            continue
+
+        servido = {
+            "pedido_id": pedido_id,
+            "receta": registro['receta'],
+            "pasos": [
+                {"paso": i + 1, "ingrediente": step.name, "ml": step.amount,
+                 "estado": ("terminado" if pasos[pedido_id].get(i) is not None
+                            else "cortado" if i in pasos[pedido_id] else "pendiente")}
+                for i, step in enumerate(instructions)
+            ]
+        }
+        pedidos_interrumpidos.append(servido)
+        pedidos.restaurar(job, None, ESTADO_INTERRUMPIDO)
+        log.aviso(f"⚠️ Pedido {pedido_id} ({registro['receta']}) interrumpido a mitad de vertido: revisar vaso",
+                  pedido_id=pedido_id, receta=registro['receta'])
+
+    # Los ids nuevos siguen después de los recuperados
+    ultimo_id = max(admitidos, default=0)
+    ultima_ronda = max((r.get('ronda') for r in admitidos.values() if isinstance(r.get('ronda'), int)), default=0)
+    _contador_pedidos = itertools.count(max(ultimo_id + 1, next(_contador_pedidos)))
+    _contador_rondas = itertools.count(max(ultima_ronda + 1, next(_contador_rondas)))
+    
+    diario.abrir(vivos)
+    for job in jobs:
+        job['eta_admision_s'] = motor_eta.eta(job)
+    if jobs:
+        log.info(f"♻️ {len(jobs)} pedidos recuperados del diario", recuperados=len(jobs))
 
 # ============================================
-# LÓGICA DE PREPARACIÓN
+# HILO DE TRABAJO (WORKER)
 # ============================================
-def prepare_preparation_plan(recipe_id):
+# Mientras queda lugar para otro vaso, el worker se despierta cada tanto a
+# mirar la cola aunque no venza ningún deadline (nunca pegado a un apagado)
+REVISION_COLA_S = 0.25
+MARGEN_REVISION_NS = 10_000_000
+
+class Vaso:
+    """Un pedido en preparación: sus grupos de pasos y por cuál va"""
+    def __init__(self, job, modo, max_bombas):
+        self.job = job
+        self.pedido_id = job.get('pedido_id')
+        self.modo = modo
+        self.pasos = job['instructions']
+        self.grupos = agrupar_pasos(self.pasos, modo)
+        self.indices = {id(step): i for i, step in enumerate(self.pasos)}
+
+        # Lo que falta después de cada grupo (para el ETA del pedido en curso)
+        self.duraciones = [duracion_grupo(g, max_bombas) for g in self.grupos]
+        self.restante_despues = [0.0] * len(self.grupos)
+        for i in range(len(self.grupos) - 2, -1, -1):
+            self.restante_despues[i] = self.restante_despues[i + 1] + self.duraciones[i + 1] + PAUSA_ENTRE_PASOS
+
+        job['reales'] = [None] * len(self.pasos)  # segundos encendida (en frío) de cada paso
+
+        self.grupo = -1
+        self.pendientes = []      # pasos del grupo en curso que no arrancaron
+        self.vertiendo = 0        # bombas de este vaso encendidas ahora
+        self.pines = frozenset()  # pines que este vaso todavía va a usar
+
+    def siguiente_grupo(self):
+        """Pasa al próximo grupo. Retorna False si ya no quedan."""
+        self.grupo += 1
+        if self.grupo >= len(self.grupos):
+            self.pendientes = []
+            self.pines = frozenset()
+            return False
+
+        self.pendientes = list(self.grupos[self.grupo])
+        self.pines = frozenset(step.pin for grupo in self.grupos[self.grupo:] for step in grupo)
+        return True
+
+    def ultimo_paso(self):
+        """¿Lo único que le queda al vaso es la bomba que está vertiendo?"""
+        return not self.pendientes and self.vertiendo == 1 and self.grupo == len(self.grupos) - 1
+
+class Estacion:
     """
-    Convierte un ID de receta en una lista de instrucciones.
-    Ahora trabaja con el nuevo formato de menu e ingredientes.
+    Prepara los pedidos sobre las bombas. Cada bomba es un recurso: un vaso
+    reserva los pines que todavía va a usar y los libera a medida que avanza.
+
+    Con vasos_simultaneos = 1 se prepara un pedido por vez. Con más vasos,
+    mientras se vierte uno se mira hacia adelante en la cola y se arranca el
+    primer pedido que no necesite ninguna bomba reservada (un Destornillador
+    mientras se sirve una Margarita). Dentro de cada vaso los pasos siguen
+    en orden, el límite de max_bombas_simultaneas es para toda la estación y
+    ningún pedido es pasado más de max_adelantos veces.
+
+    Cada paso se cronometra al encenderlo: si la bomba se apagó hace menos
+    de linea_llena_s la manguera sigue cebada y no se suma el arranque. Con
+    mantener_encendida, cuando el último paso de un vaso termina y el
+    próximo pedido de la cola empieza con la misma bomba, ésta no se apaga:
+    el paso siguiente arranca en ese mismo instante, sin cebar.
+
+    Todo corre en el hilo del worker con un único heap de deadlines: nada de
+    hilos por vaso ni I/O entre el encendido y el apagado de una bomba.
     """
-    config = load_config()
-    if not config: return None, "Error de Config"
-    
-    # 1. Buscar Receta por ID
-    menu = config.get('menu', [])
-    recipe = None
-    
-    for item in menu:
-        if item['id'] == recipe_id:
-            recipe = item
-            break
-    
-    if not recipe:
-        return None, f"Receta con ID {recipe_id} no encontrada"
-    
-    ingredients_list = recipe['ingredients']
-    plan = []
-    available_pumps = config.get('config', {})
-    
-    # 2. Procesar cada ingrediente
-    for ingredient in ingredients_list:
-        pump_id = ingredient['pump']  # Ej: "pump_6"
-        amount_ml = ingredient['ml']
-        
-        # Buscar info de la bomba
-        if pump_id not in available_pumps:
-            return None, f"Bomba '{pump_id}' no configurada"
-        
-        pump_info = available_pumps[pump_id]
-        pin = pump_info['pin']
-        label = pump_info['label']
-        
-        # 3. Calcular tiempo usando calibración
-        rate = CALIBRACION_POR_PIN.get(pin, DEFAULT_RATE)
-        duration = amount_ml * rate
-        
-        plan.append({
-            "name": label,
-            "pin": pin,
-            "amount": amount_ml,
-            "duration": duration,
-            "rate_used": rate
-        })
-    
-    return plan, recipe['name']
+    def __init__(self):
+        self.vasos = []
+        # heap de (deadline_ns, orden, vaso, paso, inicio_ns, cebada); paso None = pausa
+        self._deadlines = []
+        self._orden = itertools.count()
+        self._encendidas = set()
+        self._apagada_ns = {}  # pin -> cuándo se apagó por última vez
+        self._sin_apagar = {}  # pin -> desde cuándo, bombas que siguen andando para el próximo vaso
 
-def verter(pin, duration, name):
-    """Activa el relé por el tiempo especificado"""
-    print(f"   Running PIN {pin} ({name}) por {duration:.2f}s...")
-    GPIO.output(pin, GPIO.LOW)  # ON
-    time.sleep(duration)
-    GPIO.output(pin, GPIO.HIGH)  # OFF
+        # Parada de emergencia: parar() corre en el hilo del request. El lock
+        # solo cubre encender/apagar, así que parar() nunca espera más que
+        # una pasada de _encender() y el worker no puede encender nada después.
+        # Cada parar() suma una parada: el worker compara el contador con el
+        # que vio al empezar, así no se pierde una parada aunque /reanudar
+        # llegue antes de que despierte. _parar solo sirve para despertarlo.
+        self._lock_bombas = threading.Lock()
+        self._parar = threading.Event()
+        self._paradas = 0
+        self._vistas = 0
+        self._habilitada = threading.Event()
+        self._habilitada.set()
+        self._parada_ns = 0
+
+    @property
+    def detenida(self):
+        return not self._habilitada.is_set()
+
+    def parar(self, pines):
+        """
+        Parada de emergencia: apaga `pines` y todas las que tenga encendidas
+        la estación (también las de una prueba manual en un pin que no está
+        en pi.json) ya mismo y frena la estación hasta reanudar(). El worker
+        cierra los vasos en curso al despertar.
+        Retorna los segundos que tardó en dejar todo apagado.
+        """
+        inicio = time.perf_counter()
+        with self._lock_bombas:
+            self._parada_ns = ahora_ns()
+            self._paradas += 1
+            self._parar.set()
+            self._habilitada.clear()
+            # Copias: el worker puede estar sacando pines de estos conjuntos
+            for pin in set(pines) | set(self._encendidas) | set(self._sin_apagar):
+                bombas.apagar(pin)
+            vigilante.todas_apagadas()
+        latencia = time.perf_counter() - inicio
+        metricas.observar(M_PARADA, latencia)
+        return latencia
+
+    def reanudar(self):
+        with self._lock_bombas:
+            # Un Event nuevo: el worker que duerme en el anterior igual despierta
+            self._parar = threading.Event()
+            self._habilitada.set()
+
+    def _hubo_parada(self):
+        """¿Hubo un parar() desde que el worker empezó con estos vasos?"""
+        return self._paradas != self._vistas
+
+    def esperar_habilitada(self):
+        """Bloquea al worker mientras la estación está detenida"""
+        self._habilitada.wait()
+
+    def atender(self, job):
+        """Prepara `job` y los pedidos compatibles que vayan entrando, hasta vaciar la estación"""
+        config = load_config()
+        self.modo, self.max_bombas = ajustes_vertido(config)
+        self.max_vasos, self.ventana, self.max_adelantos = ajustes_estacion(config)
+        linea_llena_s, self.mantener_encendida = ajustes_cebado(config)
+        self.linea_llena_ns = int(linea_llena_s * 1e9)
+
+        with self._lock_bombas:
+            # Una parada que llegó antes de empezar cuenta si sigue vigente
+            self._vistas = self._paradas - (1 if self.detenida else 0)
+        self._empezar(job)
+        try:
+            while self.vasos:
+                if self._hubo_parada():
+                    self._detener()
+                    return
+                self._admitir()
+                self._encender()
+                self._esperar()
+        finally:
+            vigilante.latido(None)
+
+    def _admitir(self):
+        # Con una recarga pendiente no entran vasos: la estación se vacía y
+        # el worker la aplica antes del próximo pedido
+        while len(self.vasos) < self.max_vasos and not config_store.pendiente:
+            ocupados = frozenset().union(*(vaso.pines for vaso in self.vasos))
+            job = pedidos_queue.tomar_compatible(ocupados, self.ventana, self.max_adelantos)
+            if job is None:
+                return
+            self._empezar(job)
+
+    def _empezar(self, job):
+        job['inicio_ns'] = ahora_ns()
+        pedidos.iniciar(job)
+        error = error_pasos(job, load_modelo())
+        if error:
+            self._fallar(job, error)
+            return
+        try:
+            vaso = Vaso(job, job.get('modo', self.modo), self.max_bombas)
+        except Exception as e:
+            log.error(f"❌ Error en worker: {e}", pedido_id=job.get('pedido_id'))
+            self._fallar(job, str(e))
+            return
+        self.vasos.append(vaso)
+
+        eventos.publicar(EVENTO_INICIADO, vaso.pedido_id, receta=job['recipe_name'], modo=vaso.modo)
+
+        log.info(f"🍹 INICIANDO: {job['recipe_name']} (modo {vaso.modo}, vasos en curso: {len(self.vasos)})",
+                 pedido_id=vaso.pedido_id, receta=job['recipe_name'], modo=vaso.modo,
+                 vasos=len(self.vasos), espera_s=round((job['inicio_ns'] - job['admitido_ns']) / 1e9, 3))
+
+        self._avanzar(vaso)
+
+    def _avanzar(self, vaso):
+        """Arranca el próximo grupo del vaso o lo da por terminado"""
+        if not vaso.siguiente_grupo():
+            self._terminar(vaso)
+            return
+
+        i = vaso.grupo
+        motor_eta.avance(vaso.job, ahora_ns() + int(vaso.duraciones[i] * 1e9), vaso.restante_despues[i],
+                         vaso.pines, min(len(vaso.grupos[i]), self.max_bombas))
+
+        grupo = vaso.grupos[i]
+        if len(grupo) == 1:
+            step = grupo[0]
+            if step.amount > 0:
+                msg = f"Sirviendo {step.amount}ml de {step.name}"
+            else:
+                msg = f"Prueba manual de {step.name}"
+        else:
+            msg = "Sirviendo en paralelo: " + ", ".join(step.name for step in grupo)
+        log.info(f"[{i+1}/{len(vaso.grupos)}] {msg} (Tiempo: {vaso.duraciones[i]:.2f}s)...",
+                 pedido_id=vaso.pedido_id, grupo=i + 1, grupos=len(vaso.grupos),
+                 ingredientes=[step.name for step in grupo], duracion_s=round(vaso.duraciones[i], 3))
+
+    def _encender(self):
+        """Enciende los pasos que puedan arrancar (los vasos más viejos primero)"""
+        with self._lock_bombas:
+            if self._hubo_parada():
+                return
+            for vaso in self.vasos:
+                for step in list(vaso.pendientes):
+                    if len(self._encendidas) >= self.max_bombas:
+                        break
+                    if step.pin not in self._encendidas:
+                        self._arrancar(vaso, step)
+                else:
+                    continue
+                break
+
+            # Las que quedaron andando para un vaso que no pudo arrancar se apagan
+            for pin in self._sin_apagar:
+                self._apagar(pin)
+            self._sin_apagar.clear()
+
+    def _arrancar(self, vaso, step):
+        sigue = step.pin in self._sin_apagar
+        if sigue:
+            cebada = True
+        else:
+            ahora = ahora_ns()
+            apagada = self._apagada_ns.get(step.pin)
+            cebada = apagada is not None and ahora - apagada < self.linea_llena_ns
+        duracion = duracion_vertido(step.pin, step.amount, cebada) if step.amount > 0 else step.duration
+
+        if sigue:
+            inicio = self._sin_apagar.pop(step.pin)
+        else:
+            # El driver apaga solo en el deadline (si sabe), salvo que la
+            # bomba pueda quedar andando para el próximo pedido
+            traspaso = self.mantener_encendida and step.amount > 0 and vaso.grupo == len(vaso.grupos) - 1
+            vigilante.latido(ahora)
+            inicio = bombas.encender(step.pin, None if traspaso else int(duracion * 1e9))
+            if inicio is None:
+                inicio = ahora_ns()
+        vigilante.encendida(step.pin, inicio)
+
+        vaso.pendientes.remove(step)
+        vaso.vertiendo += 1
+        self._encendidas.add(step.pin)
+        heapq.heappush(self._deadlines, (inicio + int(duracion * 1e9), next(self._orden),
+                                         vaso, step, inicio, cebada))
+
+        vaso.job['paso_actual'] = vaso.indices[id(step)]
+        diario.registrar(REG_PASO_INICIADO, vaso.pedido_id, paso=vaso.indices[id(step)])
+        eventos.publicar(EVENTO_PASO_INICIADO, vaso.pedido_id, paso=vaso.indices[id(step)] + 1,
+                         pasos=len(vaso.pasos), ingrediente=step.name,
+                         ml=step.amount, duracion_s=round(duracion, 2), cebada=cebada)
+
+    def _apagar(self, pin):
+        fin = bombas.apagar(pin)
+        vigilante.apagada(pin)
+        if fin is None:
+            fin = ahora_ns()
+        self._apagada_ns[pin] = fin
+        return fin
+
+    def _esperar(self):
+        """Espera el próximo deadline y atiende todo lo que venció"""
+        if not self._deadlines:
+            return
+        deadline = self._deadlines[0][0]
+        parar = self._parar
+        if self._hubo_parada():
+            return
+        if len(self.vasos) < self.max_vasos:
+            revision = ahora_ns() + int(REVISION_COLA_S * 1e9)
+            if revision < deadline - MARGEN_REVISION_NS:
+                vigilante.latido(revision)
+                esperar_hasta(revision, parar)
+                return
+        vigilante.latido(deadline)
+        esperar_hasta(deadline, parar)
+        if self._hubo_parada():
+            return  # Lo que quedó encendido lo cierra _detener()
+
+        # Primero apagar todo lo vencido, después el resto
+        ahora = ahora_ns()
+        vencidos = []  # (vaso, paso, deadline_ns, inicio_ns, fin_ns, cebada, sucesor)
+        seguir = []    # últimos pasos que quizás le pasen la bomba andando al próximo pedido
+        while self._deadlines and self._deadlines[0][0] <= ahora:
+            deadline, _, vaso, step, inicio, cebada = heapq.heappop(self._deadlines)
+            if step is None:
+                vencidos.append((vaso, None, 0, 0, 0, False, None))
+            elif self.mantener_encendida and step.amount > 0 and vaso.ultimo_paso():
+                seguir.append((vaso, step, deadline, inicio, cebada))
+            else:
+                vencidos.append((vaso, step, deadline, inicio, self._apagar(step.pin), cebada, None))
+
+        for vaso, step, deadline, inicio, cebada in seguir:
+            ocupados = frozenset().union(*(otro.pines for otro in self.vasos if otro is not vaso))
+            sucesor = None if config_store.pendiente else pedidos_queue.tomar_compatible(
+                ocupados, 1, self.max_adelantos, pin_inicial=step.pin)
+            if sucesor:
+                self._sin_apagar[step.pin] = deadline
+                fin = deadline
+            else:
+                fin = self._apagar(step.pin)
+            vencidos.append((vaso, step, deadline, inicio, fin, cebada, sucesor))
+
+        for vaso, step, deadline, inicio, fin, cebada, sucesor in vencidos:
+            if step is None:
+                self._avanzar(vaso)
+                continue
+
+            objetivo = (deadline - inicio) / 1e9
+            real = (fin - inicio) / 1e9
+            # Para calibrar, el encendido se expresa como si hubiera arrancado en frío
+            frio = real + (ARRANQUE_POR_PIN.get(step.pin, 0.0) if cebada else 0.0)
+            self._encendidas.discard(step.pin)
+            vaso.vertiendo -= 1
+            estadisticas_pulsos.registrar(step.pin, objetivo, real, frio)
+            metricas.sumar(M_PASOS_PEDIDO, objetivo, pin=step.pin)
+            metricas.sumar(M_BOMBA_ENCENDIDA, real, pin=step.pin)
+            metricas.observar(M_ERROR_PASO, abs(real - objetivo))
+            vaso.job['reales'][vaso.indices[id(step)]] = frio
+            if step.amount > 0:
+                vaso.job['reserva'][step.pin] -= step.amount
+                servido_ml = step.amount * real / objetivo if objetivo else 0.0
+                inventario.servido(step.pin, step.amount, servido_ml)
+                metricas.sumar(M_BOMBA_ML, servido_ml, pin=step.pin)
+            diario.registrar(REG_PASO_TERMINADO, vaso.pedido_id, paso=vaso.indices[id(step)],
+                             real_s=round(real, 3))
+            eventos.publicar(EVENTO_PASO_TERMINADO, vaso.pedido_id, paso=vaso.indices[id(step)] + 1,
+                             pasos=len(vaso.pasos), ingrediente=step.name,
+                             real_s=round(real, 3))
+
+            if not vaso.pendientes and not vaso.vertiendo:
+                if vaso.grupo < len(vaso.grupos) - 1:
+                    heapq.heappush(self._deadlines, (ahora_ns() + int(PAUSA_ENTRE_PASOS * 1e9),
+                                                     next(self._orden), vaso, None, 0, False))
+                else:
+                    self._avanzar(vaso)
+
+            if sucesor:
+                self._empezar(sucesor)
+
+    def _terminar(self, vaso):
+        job = vaso.job
+        job['fin_ns'] = ahora_ns()
+        total_time = (job['fin_ns'] - job['inicio_ns']) / 1e9
+        self.vasos.remove(vaso)
+        pedidos.terminar(job, ESTADO_COMPLETADO)
+        eventos.publicar(EVENTO_COMPLETADO, vaso.pedido_id, receta=job['recipe_name'],
+                         total_s=round(total_time, 2))
+        log.info(f"✅ {job['recipe_name']} LISTO en {total_time:.2f}s", pedido_id=vaso.pedido_id,
+                 receta=job['recipe_name'], total_s=round(total_time, 3),
+                 reales_s=[None if real is None else round(real, 3) for real in job['reales']])
+        pedidos_queue.task_done()
+
+    def _detener(self):
+        """
+        Cierra los vasos en curso tras una parada de emergencia (las bombas
+        ya las apagó parar()). Cada vaso queda 'interrumpido' con lo que
+        llegó a servir cada paso, en /interrumpidos.
+        """
+        cortados = {}  # (id(vaso), índice del paso) -> ml servidos
+        for deadline, _, vaso, step, inicio, _ in self._deadlines:
+            if step is None:
+                continue
+            objetivo = (deadline - inicio) / 1e9
+            real = max(0, self._parada_ns - inicio) / 1e9
+            servido_ml = step.amount * real / objetivo if objetivo and step.amount > 0 else 0.0
+            idx = vaso.indices[id(step)]
+            vaso.job['reales'][idx] = real
+            cortados[(id(vaso), idx)] = servido_ml
+            if step.amount > 0:
+                vaso.job['reserva'][step.pin] -= step.amount
+                inventario.servido(step.pin, step.amount, servido_ml)
+                metricas.sumar(M_BOMBA_ML, servido_ml, pin=step.pin)
+
+        for vaso in self.vasos:
+            job = vaso.job
+            job['fin_ns'] = ahora_ns()
+            job['error'] = "Parada de emergencia"
+            pasos = []
+            for i, step in enumerate(vaso.pasos):
+                if (id(vaso), i) in cortados:
+                    estado, ml = "cortado", cortados[(id(vaso), i)]
+                elif job['reales'][i] is not None:
+                    estado, ml = "terminado", step.amount
+                else:
+                    estado, ml = "pendiente", 0
+                pasos.append({"paso": i + 1, "ingrediente": step.name, "ml": step.amount,
+                              "ml_servidos": round(ml, 1), "estado": estado})
+            pedidos_interrumpidos.append({"pedido_id": vaso.pedido_id, "receta": job['recipe_name'],
+                                          "pasos": pasos})
+            pedidos.terminar(job, ESTADO_INTERRUMPIDO)
+            eventos.publicar(EVENTO_INTERRUMPIDO, vaso.pedido_id, receta=job['recipe_name'], pasos=pasos)
+            log.aviso(f"🛑 Pedido {vaso.pedido_id} ({job['recipe_name']}) interrumpido por parada de emergencia",
+                      pedido_id=vaso.pedido_id, pasos=pasos)
+            pedidos_queue.task_done()
+
+        self.vasos = []
+        self._deadlines = []
+        self._encendidas.clear()
+        self._sin_apagar.clear()
+
+    def abortar(self, error):
+        """Ante un error apaga todas las bombas y marca fallidos los vasos en curso"""
+        for pin in self._encendidas | set(self._sin_apagar):
+            bombas.apagar(pin)
+            vigilante.apagada(pin)
+        self._encendidas.clear()
+        self._sin_apagar.clear()
+        self._deadlines = []
+
+        for vaso in self.vasos:
+            self._fallar(vaso.job, error)
+        self.vasos = []
+
+    def _fallar(self, job, error):
+        job['fin_ns'] = ahora_ns()
+        job['error'] = error
+        log.error(f"❌ Pedido {job.get('pedido_id')} fallido: {error}", pedido_id=job.get('pedido_id'))
+        pedidos.terminar(job, ESTADO_FALLIDO)
+        eventos.publicar(EVENTO_FALLIDO, job.get('pedido_id'), error=error)
+        pedidos_queue.task_done()
+
+estacion = Estacion()
 
-# ============================================
-# HILO DE TRABAJO (WORKER)
-# ============================================
 def procesar_pedidos():
     global preparando
-    
+
     while True:
+        espera = ahora_ns()
+        job = pedidos_queue.get()
+        estacion.esperar_habilitada()
+        inicio = ahora_ns()
+        metricas.sumar(M_WORKER_OCIOSO, (inicio - espera) / 1e9)
+
+        with preparando_lock:
+            preparando = True
+
         try:
-            job = pedidos_queue.get()
-            
-            with preparando_lock:
-                preparando = True
-                
-            recipe_name = job['recipe_name']
-            instructions = job['instructions']
-            
-            print(f"\n{'='*50}")
-            print(f"🍹 INICIANDO: {recipe_name}")
-            print(f"{'='*50}")
-            
-            start_total = time.time()
-            
-            for i, step in enumerate(instructions):
-                if step['amount'] > 0:
-                    msg = f"Sirviendo {step['amount']}ml de {step['name']}"
-                else:
-                    msg = f"Prueba manual de {step['name']}"
-
-                print(f"[{i+1}/{len(instructions)}] {msg} (Tiempo: {step['duration']:.2f}s)...")
-                
-                verter(step['pin'], step['duration'], step['name'])
-                
-                if i < len(instructions) - 1:
-                    time.sleep(0.5)
-            
-            total_time = time.time() - start_total
-            print(f"\n✅ {recipe_name} LISTO en {total_time:.2f}s")
-            print(f"{'='*50}\n")
-            
+            config_store.aplicar_pendiente()
+            with config_store.en_uso:
+                estacion.atender(job)
         except Exception as e:
-            print(f"❌ Error en worker: {e}")
-            
+            log.error(f"❌ Error en worker: {e}")
+            estacion.abortar(str(e))
         finally:
             with preparando_lock:
                 preparando = False
-            pedidos_queue.task_done()
+            metricas.sumar(M_WORKER_OCUPADO, (ahora_ns() - inicio) / 1e9)
+            config_store.aplicar_pendiente()  # Lo que llegó mientras preparaba
+
+# ============================================
+# VIGILANTE DE BOMBAS (WATCHDOG)
+# ============================================
+# Un hilo aparte, que no depende del worker, mira cada VIGILANTE_TICK_S las
+# bombas encendidas y hace una parada de emergencia si una lleva encendida
+# más que su máximo o si el worker no volvió de una espera cuando había
+# prometido (colgado con una bomba andando). Si se cae el proceso entero
+# ningún hilo sirve: al volver a arrancar setup_gpio() deja todos los pines
+# apagados y el diario marca 'interrumpido' lo que se estaba sirviendo.
+VIGILANTE_TICK_S = 0.005
+MARGEN_ENCENDIDA_PCT = 25     # Sobre el paso más largo del menú para esa bomba
+MARGEN_ENCENDIDA_S = 1.0
+MARGEN_LATIDO_S = 0.5         # Atraso tolerado del worker respecto de lo prometido
+MAX_PRUEBA_MANUAL_S = 30      # También es el mínimo de encendido permitido por bomba
+LIMITE_SIN_CONFIGURAR_S = MAX_PRUEBA_MANUAL_S * (1 + MARGEN_ENCENDIDA_PCT / 100) + MARGEN_ENCENDIDA_S
+
+DISPARO_MAX_ENCENDIDA = 'max_encendida'
+DISPARO_SIN_LATIDO = 'sin_latido'
+
+def limites_encendido(modelo, planes):
+    """
+    Segundos que puede estar encendida cada bomba: "max_encendida_s" de
+    pi.json o el paso más largo de los planes compilados (al menos una
+    prueba manual) con margen.
+    """
+    largo = {}
+    for plan in planes.values():
+        for step in plan.steps:
+            largo[step.pin] = max(largo.get(step.pin, 0.0), step.duration)
+
+    limites = {}
+    for pin, bomba in modelo.por_pin.items():
+        if bomba.max_encendida_s is not None:
+            limites[pin] = float(bomba.max_encendida_s)
+        else:
+            paso = max(largo.get(pin, 0.0), MAX_PRUEBA_MANUAL_S)
+            limites[pin] = paso * (1 + MARGEN_ENCENDIDA_PCT / 100) + MARGEN_ENCENDIDA_S
+    return limites
+
+class Vigilante:
+    """
+    La estación avisa encendida()/apagada() de cada pin y, antes de cada
+    espera, latido(hasta_ns): hasta cuándo puede no dar señales. Todo son
+    asignaciones a un dict, así el worker no paga nada y el tick solo
+    recorre las bombas encendidas. Sin bombas encendidas el hilo duerme.
+    """
+    def __init__(self):
+        self._desde = {}          # pin -> ns desde que está encendida
+        self._promesa_ns = None   # el worker vuelve antes de esto (None = no está en una espera)
+        self._aviso = threading.Event()
+        self._limites = {}
+        self._clave = None
+        self.disparos = {}        # motivo -> veces
+        self.ultimo_disparo = None
+
+    def encendida(self, pin, desde_ns):
+        self._desde[pin] = desde_ns
+        self._aviso.set()
+
+    def apagada(self, pin):
+        self._desde.pop(pin, None)
+
+    def todas_apagadas(self):
+        self._desde.clear()
+
+    def latido(self, hasta_ns):
+        self._promesa_ns = hasta_ns
+
+    def iniciar(self):
+        threading.Thread(target=self._vigilar, daemon=True).start()
+
+    def _vigilar(self):
+        while True:
+            if not self._desde:
+                self._aviso.clear()
+                if not self._desde:
+                    self._aviso.wait()
+                continue
+            time.sleep(VIGILANTE_TICK_S)
+            try:
+                self._revisar()
+            except Exception as e:
+                log.error(f"❌ Error en el vigilante: {e}")
+
+    def _revisar(self):
+        clave = (config_store.version, calibracion_version)
+        if clave != self._clave:
+            instantanea = plan_index.instantanea()
+            if instantanea:
+                modelo, planes, _ = instantanea
+                self._limites = limites_encendido(modelo, planes)
+                self._clave = clave
+
+        ahora = ahora_ns()
+        for pin, desde in list(self._desde.items()):
+            limite = self._limites.get(pin, LIMITE_SIN_CONFIGURAR_S)
+            if ahora - desde > limite * 1e9:
+                self._disparar(DISPARO_MAX_ENCENDIDA, f"PIN {pin} lleva más de {limite:.1f}s encendido",
+                               pin=pin, limite_s=round(limite, 2))
+                return
+
+        promesa = self._promesa_ns
+        if promesa is not None and self._desde and ahora - promesa > MARGEN_LATIDO_S * 1e9:
+            self._disparar(DISPARO_SIN_LATIDO, "El worker no responde con bombas encendidas",
+                           atraso_s=round((ahora - promesa) / 1e9, 3), pines=sorted(self._desde))
+
+    def _disparar(self, motivo, mensaje, **campos):
+        # Las configuradas y las que el vigilante tiene anotadas como encendidas
+        latencia = estacion.parar(PINES_CONFIGURADOS | set(self._desde))
+        self._desde.clear()
+        self._promesa_ns = None
+        self.disparos[motivo] = self.disparos.get(motivo, 0) + 1
+        self.ultimo_disparo = {"motivo": motivo, "mensaje": mensaje, "timestamp": time.time()}
+        metricas.sumar(M_VIGILANTE, motivo=motivo)
+        log.error(f"🐕 VIGILANTE: {mensaje}. Parada de emergencia, POST /reanudar para seguir",
+                  motivo=motivo, latencia_ms=round(latencia * 1000, 3), **campos)
+
+vigilante = Vigilante()
 
 # ============================================
 # ENDPOINTS FLASK
 # ============================================
 @app.route('/hacer_trago', methods=['POST'])
+@medir_admision
 def hacer_trago():
     """
-    Ahora recibe el ID numérico de la receta
+    Recibe el ID numérico de la receta (o su id de texto si pi.json
+    viene en el formato de py2.py)
     Payload: {"recipe_id": 1}
+    Opcional: "prioridad" ("normal" | "vip") y "cliente" (id del kiosco,
+    por defecto la IP) para el reparto equitativo de la cola.
     """
     data = request.json
     recipe_id = data.get('recipe_id')
@@ -191,34 +3065,212 @@ def hacer_trago():
     if recipe_id is None:
         return jsonify({"status": "error", "mensaje": "Falta recipe_id"}), 400
     
-    try:
-        recipe_id = int(recipe_id)
-    except ValueError:
-        return jsonify({"status": "error", "mensaje": "recipe_id debe ser un número"}), 400
+    recibido = recipe_id
+    recipe_id = id_receta(load_modelo(), recibido)
+    if recipe_id is None:
+        return jsonify({"status": "error", "mensaje": f"Receta '{recibido}' no encontrada"}), 400
         
-    print(f"📥 Petición recibida: Recipe ID {recipe_id}")
+    log.info(f"📥 Petición recibida: Recipe ID {recipe_id}", recipe_id=recipe_id)
     
-    instructions, result_name = prepare_preparation_plan(recipe_id)
+    prioridad = data.get('prioridad', PRIORIDAD_NORMAL)
+    if prioridad not in (PRIORIDAD_NORMAL, PRIORIDAD_VIP):
+        return jsonify({"status": "error", "mensaje": "prioridad debe ser 'normal' o 'vip'"}), 400
+    cliente = data.get('cliente') or request.remote_addr
+    if not isinstance(cliente, str):
+        return jsonify({"status": "error", "mensaje": "cliente debe ser un texto"}), 400
     
-    if not instructions:
-        return jsonify({"status": "error", "mensaje": result_name}), 400
+    plan, error = plan_index.get(recipe_id)
     
-    total_est = sum(step['duration'] for step in instructions) + (len(instructions) * 0.5)
+    if not plan:
+        return jsonify({"status": "error", "mensaje": error}), 400
     
-    job = {
-        "recipe_name": result_name,
-        "instructions": instructions,
-        "timestamp": time.time()
-    }
-    pedidos_queue.put(job)
+    job, rechazo = encolar_pedido(plan.name, plan.steps, plan.total_estimado, prioridad=prioridad, cliente=cliente)
+    if rechazo:
+        return respuesta_rechazo(rechazo)
+    
+    # tiempo_estimado: hasta que el trago esté listo, contando la cola
+    return jsonify({
+        "status": "success",
+        "pedido_id": job['pedido_id'],
+        "mensaje": f"Marchando un {plan.name}",
+        "tiempo_estimado": f"{job['eta_admision_s']:.1f}s",
+        "tiempo_preparacion": f"{plan.total_estimado:.1f}s",
+        "listo_a_las": listo_a_las(job['eta_admision_s']),
+        "cola": pedidos_queue.qsize()
+    })
+
+MAX_TRAGOS_POR_RONDA = 24
+
+@app.route('/hacer_tragos', methods=['POST'])
+@medir_admision
+def hacer_tragos():
+    """
+    Ronda de tragos para una mesa. Se valida entera contra una sola versión
+    del menú y se encola toda junta o nada.
+    Payload: {"tragos": [{"recipe_id": 1, "cantidad": 2}, {"recipe_id": 6}]}
+    Opcional: "prioridad" y "cliente", igual que /hacer_trago.
+    """
+    data = request.json or {}
+    tragos = data.get('tragos')
+    
+    if not tragos or not isinstance(tragos, list):
+        return jsonify({"status": "error", "mensaje": "Se requiere una lista de 'tragos'"}), 400
+    
+    prioridad = data.get('prioridad', PRIORIDAD_NORMAL)
+    if prioridad not in (PRIORIDAD_NORMAL, PRIORIDAD_VIP):
+        return jsonify({"status": "error", "mensaje": "prioridad debe ser 'normal' o 'vip'"}), 400
+    cliente = data.get('cliente') or request.remote_addr
+    if not isinstance(cliente, str):
+        return jsonify({"status": "error", "mensaje": "cliente debe ser un texto"}), 400
+    
+    # Una sola versión del menú para toda la ronda: ids, planes y errores
+    instantanea = plan_index.instantanea()
+    if instantanea is None:
+        return jsonify({"status": "error", "mensaje": "Error de Config"}), 500
+    modelo, planes_menu, errores_menu = instantanea
+    
+    planes = []
+    errores = []
+    for item in tragos:
+        try:
+            recipe_id = id_receta(modelo, item.get('recipe_id'))
+            cantidad = item.get('cantidad', 1)
+        except (AttributeError, ValueError, TypeError):
+            errores.append(f"Item inválido: {item}")
+            continue
+        if recipe_id is None:
+            errores.append(f"Receta '{item.get('recipe_id')}' no encontrada")
+            continue
+        if isinstance(cantidad, bool) or not isinstance(cantidad, int):
+            errores.append(f"cantidad debe ser un número entero: {cantidad!r}")
+            continue
+        
+        plan = planes_menu.get(recipe_id)
+        if not plan:
+            errores.append(errores_menu.get(recipe_id, f"Receta con ID {recipe_id} no encontrada"))
+        elif not 1 <= cantidad <= MAX_TRAGOS_POR_RONDA:
+            errores.append(f"cantidad inválida para {plan.name}")
+        elif len(planes) + cantidad > MAX_TRAGOS_POR_RONDA:
+            return jsonify({"status": "error",
+                            "mensaje": f"Máximo {MAX_TRAGOS_POR_RONDA} tragos por ronda"}), 400
+        else:
+            planes.extend([plan] * cantidad)
+    
+    if errores:
+        return jsonify({"status": "error", "mensaje": "Ronda rechazada", "errores": errores}), 400
+    
+    log.info(f"📥 Ronda recibida: {len(planes)} tragos", tragos=len(planes))
+    
+    ronda_id, jobs, rechazo = encolar_ronda(planes, prioridad=prioridad, cliente=cliente)
+    if rechazo:
+        return respuesta_rechazo(rechazo)
     
+    # La ronda está lista cuando está listo su último trago
+    eta = max(job['eta_admision_s'] for job in jobs)
     return jsonify({
         "status": "success",
-        "mensaje": f"Marchando un {result_name}",
-        "tiempo_estimado": f"{total_est:.1f}s",
+        "ronda_id": ronda_id,
+        "pedido_ids": [job['pedido_id'] for job in jobs],
+        "mensaje": f"Marchando una ronda de {len(jobs)} tragos",
+        "tiempo_estimado": f"{eta:.1f}s",
+        "tiempo_preparacion": f"{sum(plan.total_estimado for plan in planes):.1f}s",
+        "listo_a_las": listo_a_las(eta),
         "cola": pedidos_queue.qsize()
     })
 
+@app.route('/pedido/<int:pedido_id>', methods=['GET'])
+def ver_pedido(pedido_id):
+    """Estado de un pedido: posición en cola, ETA, paso actual y tiempos"""
+    job = pedidos.get(pedido_id)
+    if not job:
+        return jsonify({"status": "error", "mensaje": f"Pedido {pedido_id} no encontrado"}), 404
+    
+    estado = job['estado']
+    instructions = job['instructions']
+    ahora = ahora_ns()
+    eta = motor_eta.eta(job)
+    
+    info = {
+        "status": "success",
+        "pedido_id": pedido_id,
+        "receta": job['recipe_name'],
+        "estado": estado,
+        "tiempo_estimado_s": round(job['tiempo_estimado'], 1),
+        "eta_s": round(eta, 1),
+        "listo_a_las": listo_a_las(eta),
+        "tiempos": {
+            "admitido": datetime.fromtimestamp(job['timestamp']).isoformat(),
+            "espera_s": round(((job.get('inicio_ns') or ahora) - job['admitido_ns']) / 1e9, 2)
+        }
+    }
+    
+    if 'ronda' in job:
+        info["ronda_id"] = job['ronda']
+    
+    if estado == ESTADO_EN_COLA:
+        info["posicion_cola"] = pedidos_queue.posicion(job)
+        info["prioridad"] = job.get('prioridad', PRIORIDAD_NORMAL)
+    
+    if 'inicio_ns' in job:
+        info["tiempos"]["preparacion_s"] = round(((job.get('fin_ns') or ahora) - job['inicio_ns']) / 1e9, 2)
+    
+    if estado == ESTADO_PREPARANDO and 'paso_actual' in job:
+        step = instructions[job['paso_actual']]
+        info["paso_actual"] = {
+            "paso": job['paso_actual'] + 1,
+            "pasos": len(instructions),
+            "ingrediente": step.name,
+            "ml": step.amount
+        }
+    
+    if 'fin_ns' in job:
+        info["tiempos"]["total_s"] = round((job['fin_ns'] - job['admitido_ns']) / 1e9, 2)
+    if 'error' in job:
+        info["error"] = job['error']
+    
+    return jsonify(info)
+
+@app.route('/pedido/<int:pedido_id>', methods=['DELETE'])
+def cancelar_pedido(pedido_id):
+    """Cancela un pedido que todavía está en la cola (libera su lugar y su reserva)"""
+    job = pedidos.get(pedido_id)
+    if not job:
+        return jsonify({"status": "error", "mensaje": f"Pedido {pedido_id} no encontrado"}), 404
+    
+    if not pedidos.cancelar(job, pedidos_queue):
+        return jsonify({
+            "status": "error",
+            "estado": job['estado'],
+            "mensaje": f"El pedido {pedido_id} ya no está en cola (para frenar uno en curso: POST /parar)"
+        }), 409
+    
+    eventos.publicar(EVENTO_CANCELADO, pedido_id, receta=job['recipe_name'])
+    log.info(f"🚫 Pedido {pedido_id} ({job['recipe_name']}) cancelado", pedido_id=pedido_id)
+    return jsonify({"status": "success", "pedido_id": pedido_id, "estado": ESTADO_CANCELADO})
+
+@app.route('/parar', methods=['POST'])
+def parar():
+    """
+    Parada de emergencia: apaga todas las bombas configuradas, interrumpe
+    los pedidos en curso (ver /interrumpidos) y no arranca otro pedido
+    hasta POST /reanudar. La cola se conserva.
+    """
+    latencia = estacion.parar(PINES_CONFIGURADOS)
+    log.aviso(f"🛑 PARADA DE EMERGENCIA ({latencia * 1000:.2f} ms)", latencia_ms=round(latencia * 1000, 3))
+    return jsonify({
+        "status": "success",
+        "mensaje": "Bombas apagadas. POST /reanudar para seguir con la cola",
+        "latencia_ms": round(latencia * 1000, 3),
+        "pines": sorted(PINES_CONFIGURADOS)
+    })
+
+@app.route('/reanudar', methods=['POST'])
+def reanudar():
+    """Vuelve a preparar pedidos después de una parada de emergencia"""
+    estacion.reanudar()
+    log.info("▶️ Estación reanudada")
+    return jsonify({"status": "success", "cola": pedidos_queue.qsize()})
+
 @app.route('/menu', methods=['GET'])
 def obtener_menu():
     """Devuelve el menú completo de tragos disponibles"""
@@ -251,15 +3303,12 @@ def prueba_manual():
             pin = int(item.get('pin'))
             secs = float(item.get('segundos'))
             
-            if secs <= 0: continue
+            if not math.isfinite(secs) or secs <= 0: continue
+            if secs > MAX_PRUEBA_MANUAL_S:
+                return jsonify({"status": "error",
+                                "mensaje": f"Máximo {MAX_PRUEBA_MANUAL_S}s por bomba en una prueba"}), 400
             
-            instructions.append({
-                "name": f"TEST_PIN_{pin}",
-                "pin": pin,
-                "amount": 0,
-                "duration": secs,
-                "rate_used": 0
-            })
+            instructions.append(Paso(f"TEST_PIN_{pin}", pin, 0, secs, 0))
             total_time_est += secs
             
         except (ValueError, TypeError):
@@ -268,61 +3317,435 @@ def prueba_manual():
     if not instructions:
         return jsonify({"status": "error", "mensaje": "No hay acciones válidas"}), 400
         
-    job = {
-        "recipe_name": "🛠️ PRUEBA MANUAL",
-        "instructions": instructions,
-        "timestamp": time.time()
-    }
-    pedidos_queue.put(job)
+    # Las pruebas siempre van bomba por bomba
+    job, rechazo = encolar_pedido("🛠️ PRUEBA MANUAL", tuple(instructions),
+                                  _estimar_total(instructions), modo=MODO_SERIE,
+                                  prioridad=PRIORIDAD_MANTENIMIENTO, cliente=request.remote_addr)
+    if rechazo:
+        return respuesta_rechazo(rechazo)
     
     return jsonify({
         "status": "success",
+        "pedido_id": job['pedido_id'],
         "mensaje": f"Encolando prueba de {len(instructions)} pasos",
         "tiempo_estimado": f"{total_time_est:.1f}s",
         "cola_actual": pedidos_queue.qsize()
     })
 
+@app.route('/metrics', methods=['GET'])
+def ver_metricas():
+    """Contadores, medidores e histogramas en formato Prometheus"""
+    return Response(metricas.exportar(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/estado', methods=['GET'])
 def estado():
     with preparando_lock:
         status = "preparando" if preparando else "libre"
     return jsonify({
-        "estado": status,
-        "cola": pedidos_queue.qsize()
+        "estado": "detenida" if estacion.detenida else status,
+        "cola": pedidos_queue.qsize(),
+        "vasos_en_preparacion": len(pedidos.en_curso),
+        "espera_estimada_s": round(motor_eta.trabajo_pendiente(), 1),
+        "clientes_eventos": eventos.conectados(),
+        "vigilante": {"disparos": dict(vigilante.disparos), "ultimo_disparo": vigilante.ultimo_disparo},
+        "config": {"version": config_store.version, "error": config_store.ultimo_error}
+    })
+
+@app.route('/eventos', methods=['GET'])
+def stream_eventos():
+    """
+    Stream Server-Sent Events con el progreso de los pedidos.
+    Query opcional: ?pedido=<id> para seguir un solo pedido.
+    Soporta reconexión con el header Last-Event-ID.
+    """
+    pedido_id = request.args.get('pedido', type=int)
+    desde = request.headers.get('Last-Event-ID', type=int)
+    suscripcion = eventos.suscribir(pedido_id, desde)
+    
+    def stream():
+        try:
+            yield "retry: 2000\n\n"
+            while True:
+                pendientes = suscripcion.esperar(SSE_KEEPALIVE_S)
+                if not pendientes:
+                    yield ": ping\n\n"
+                for _, _, texto in pendientes:
+                    yield texto
+        finally:
+            eventos.desuscribir(suscripcion)
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route('/precision', methods=['GET'])
+def ver_precision():
+    """Error entre el tiempo pedido y el tiempo real de encendido de las bombas"""
+    return jsonify(estadisticas_pulsos.resumen())
+
+@app.route('/inventario', methods=['GET'])
+def ver_inventario():
+    """Nivel, reservas y disponible de cada botella con control de stock"""
+    modelo = load_modelo()
+    if not modelo:
+        return jsonify({"status": "error"}), 500
+    
+    botellas = {}
+    for pump_id, bomba in modelo.bombas.items():
+        estado_botella = inventario.estado(bomba.pin)
+        if estado_botella is None:
+            continue
+        capacidad, nivel, reservado = estado_botella
+        disponible = max(0.0, nivel - reservado)
+        botellas[pump_id] = {
+            "label": bomba.label,
+            "pin": bomba.pin,
+            "capacidad_ml": capacidad,
+            "nivel_ml": round(nivel, 1),
+            "reservado_ml": round(reservado, 1),
+            "disponible_ml": round(disponible, 1),
+            "bajo": disponible < capacidad * ALERTA_STOCK_PCT / 100
+        }
+    
+    return jsonify({"status": "success", "inventario": botellas})
+
+@app.route('/inventario', methods=['POST'])
+def reponer_inventario():
+    """
+    Repone una botella.
+    Payload: {"pump": "pump_1"} (llena) o {"pump": "pump_1", "nivel_ml": 500}
+    """
+    data = request.json or {}
+    modelo = load_modelo()
+    if not modelo:
+        return jsonify({"status": "error"}), 500
+    
+    bomba = modelo.bombas.get(data.get('pump'))
+    if not bomba:
+        return jsonify({"status": "error", "mensaje": f"Bomba '{data.get('pump')}' no configurada"}), 400
+    
+    try:
+        nivel_ml = data.get('nivel_ml')
+        nivel_ml = None if nivel_ml is None else float(nivel_ml)
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "mensaje": "nivel_ml debe ser un número"}), 400
+    
+    if not inventario.rellenar(bomba.pin, nivel_ml):
+        return jsonify({"status": "error",
+                        "mensaje": f"{bomba.label} no tiene capacidad_ml en pi.json"}), 400
+    
+    log.info(f"🍾 Botella repuesta: {bomba.label}", pin=bomba.pin)
+    return jsonify({"status": "success", "mensaje": f"{bomba.label} repuesta"})
+
+@app.route('/interrumpidos', methods=['GET'])
+def ver_interrumpidos():
+    """Pedidos cortados a mitad de vertido por un reinicio: qué llegó a servirse"""
+    return jsonify({
+        "status": "success",
+        "interrumpidos": pedidos_interrumpidos
     })
 
 @app.route('/calibracion', methods=['GET'])
 def ver_calibracion():
     """Muestra la calibración actual de todas las bombas"""
-    config = load_config()
-    if not config:
+    modelo = load_modelo()
+    if not modelo:
         return jsonify({"status": "error"}), 500
     
     calibracion_info = {}
-    for pump_id, pump_data in config.get('config', {}).items():
-        pin = pump_data['pin']
+    for pump_id, bomba in modelo.bombas.items():
+        pin = bomba.pin
         calibracion_info[pump_id] = {
-            "label": pump_data['label'],
+            "label": bomba.label,
             "pin": pin,
-            "flow_rate_ml_s": pump_data.get('flow_rate', 0),
-            "segundos_por_ml": CALIBRACION_POR_PIN.get(pin, DEFAULT_RATE)
+            "flow_rate_ml_s": bomba.flow_rate,
+            "segundos_por_ml": CALIBRACION_POR_PIN.get(pin, DEFAULT_RATE),
+            "arranque_s": round(ARRANQUE_POR_PIN.get(pin, 0.0), 3),
+            "goteo_ml": GOTEO_POR_PIN.get(pin, 0.0),
+            "ajustado_por_mediciones": pin in calibracion_auto.modelos,
+            "mediciones": calibracion_auto.cantidad(pin)
         }
     
     return jsonify(calibracion_info)
 
+@app.route('/calibracion/medicion', methods=['POST'])
+def registrar_medicion():
+    """
+    Registra lo que realmente cayó en el vaso y reajusta el caudal de la bomba.
+    Payload (ml medidos, o gramos de una balanza con "densidad_g_ml" en pi.json):
+      {"pedido_id": 12, "paso": 1, "ml": 58}        un paso de un pedido
+      {"pump": "pump_1", "ml": 58}                  el último vertido de esa bomba
+      {"pump": "pump_1", "segundos": 16.2, "gramos": 61}
+    """
+    data = request.json or {}
+    modelo = load_modelo()
+    if not modelo:
+        return jsonify({"status": "error"}), 500
+    
+    if data.get('pedido_id') is not None:
+        try:
+            job = pedidos.get(int(data.get('pedido_id')))
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "mensaje": "pedido_id debe ser un número"}), 400
+        if not job:
+            return jsonify({"status": "error", "mensaje": "Pedido no encontrado"}), 404
+        try:
+            indice = int(data.get('paso', 1)) - 1
+        except (TypeError, ValueError):
+            indice = -1
+        reales = job.get('reales', [])
+        if not 0 <= indice < len(job['instructions']) or indice >= len(reales):
+            return jsonify({"status": "error", "mensaje": "Paso inválido"}), 400
+        step = job['instructions'][indice]
+        segundos = reales[indice]
+        pin = step.pin
+    else:
+        bomba = modelo.bombas.get(data.get('pump'))
+        if not bomba:
+            return jsonify({"status": "error", "mensaje": f"Bomba '{data.get('pump')}' no configurada"}), 400
+        pin = bomba.pin
+        segundos = data.get('segundos', estadisticas_pulsos.ultimo.get(pin))
+    
+    if segundos is None:
+        return jsonify({"status": "error", "mensaje": "Esa bomba todavía no vertió nada"}), 400
+    
+    densidad = modelo.por_pin[pin].densidad_g_ml if pin in modelo.por_pin else 1.0
+    try:
+        segundos = float(segundos)
+        ml = float(data['ml']) if 'ml' in data else float(data['gramos']) / densidad
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"status": "error", "mensaje": "Se requiere 'ml' o 'gramos' numérico"}), 400
+    if not (math.isfinite(segundos) and segundos > 0 and math.isfinite(ml) and ml > 0):
+        return jsonify({"status": "error", "mensaje": "segundos y ml deben ser números positivos"}), 400
+    
+    resultado = calibracion_auto.medir(pin, segundos, ml)
+    if not resultado:
+        return jsonify({"status": "error", "mensaje": "Medición inconsistente, no se usó"}), 400
+    caudal, arranque, error_ml = resultado
+    
+    log.info(f"📏 Pin {pin}: {ml:.1f}ml en {segundos:.2f}s -> {caudal:.2f} ml/s, arranque {arranque:.2f}s",
+             pin=pin, ml=ml, segundos=segundos, caudal_ml_s=round(caudal, 3), arranque_s=round(arranque, 3))
+    return jsonify({
+        "status": "success",
+        "pin": pin,
+        "caudal_ml_s": round(caudal, 3),
+        "arranque_s": round(arranque, 3),
+        "segundos_por_ml": round(1.0 / caudal, 4),
+        "error_anterior_ml": round(error_ml, 1),
+        "mediciones": calibracion_auto.cantidad(pin)
+    })
+
+# ============================================
+# SERVIDOR ASGI (ASYNCIO)
+# ============================================
+# PI_SERVIDOR=flask (por defecto) usa el servidor de Flask, un hilo por
+# conexión. PI_SERVIDOR=asgi sirve los mismos endpoints con uvicorn
+# (pip install uvicorn); también se puede lanzar con `uvicorn pi:asgi_app`.
+SERVIDOR = os.environ.get('PI_SERVIDOR', 'flask')
+ASGI_HILOS = 4  # Hilos para los endpoints Flask: ninguno espera al hardware
+
+_arrancado = False
+
+def arrancar():
+    """Carga la configuración, recupera el diario y lanza el worker (una sola vez)"""
+    global _arrancado
+    if _arrancado:
+        return True
+    if not setup_gpio():
+        return False
+    recuperar_pedidos()
+    config_store.iniciar()
+    threading.Thread(target=procesar_pedidos, daemon=True).start()
+    vigilante.iniciar()
+    _arrancado = True
+    return True
+
+def _entero(texto):
+    try:
+        return int(texto)
+    except (TypeError, ValueError):
+        return None
+
+class PuenteAsgi:
+    """
+    App ASGI con los endpoints de `app`.
+
+    /eventos se atiende en el event loop: cada cliente es una corrutina y
+    una Suscripcion, sin hilo propio, así cientos de pantallas conectadas
+    cuestan poca RAM. El resto de los endpoints son cortos (los pedidos y
+    las pruebas de bombas solo se encolan) y se pasan a la app Flask en un
+    pool chico de hilos para no frenar el loop. Los tiempos de las bombas
+    siguen en el hilo de la estación, lejos del parseo de HTTP.
+    """
+    def __init__(self, wsgi_app, hilos=ASGI_HILOS):
+        self.wsgi_app = wsgi_app
+        self._pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['path'] == '/eventos' and scope['method'] == 'GET':
+                await self._eventos(scope, receive, send)
+            else:
+                await self._wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            mensaje = await receive()
+            if mensaje['type'] == 'lifespan.startup':
+                if arrancar():
+                    await send({'type': 'lifespan.startup.complete'})
+                else:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': "Error fatal en configuración GPIO"})
+            elif mensaje['type'] == 'lifespan.shutdown':
+                self._pool.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _eventos(self, scope, receive, send):
+        """Mismo stream que stream_eventos(), pero sobre el event loop"""
+        cabeceras = {nombre.decode('latin-1'): valor.decode('latin-1') for nombre, valor in scope['headers']}
+        pedido_id = _entero(parse_qs(scope['query_string'].decode('latin-1')).get('pedido', [None])[0])
+        desde = _entero(cabeceras.get('last-event-id'))
+
+        loop = asyncio.get_running_loop()
+        aviso = asyncio.Event()
+
+        def avisar():
+            # Lo llama el hilo que publica (el worker): nunca debe fallar
+            try:
+                loop.call_soon_threadsafe(aviso.set)
+            except RuntimeError:
+                pass  # Loop cerrado
+
+        async def desconexion():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        suscripcion = eventos.suscribir(pedido_id, desde, avisar)
+        cortada = asyncio.ensure_future(desconexion())
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ]})
+            await send({'type': 'http.response.body', 'body': b"retry: 2000\n\n", 'more_body': True})
+            while True:
+                espera = asyncio.ensure_future(aviso.wait())
+                await asyncio.wait((espera, cortada), timeout=SSE_KEEPALIVE_S,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                avisado = espera.done()
+                espera.cancel()
+                if cortada.done():
+                    return
+                aviso.clear()
+                pendientes = suscripcion.tomar()
+                if pendientes:
+                    texto = "".join(t for _, _, t in pendientes)
+                elif avisado:
+                    continue  # Aviso de eventos que ya salieron en la tanda anterior
+                else:
+                    texto = ": ping\n\n"
+                await send({'type': 'http.response.body', 'body': texto.encode('utf-8'), 'more_body': True})
+        finally:
+            cortada.cancel()
+            eventos.desuscribir(suscripcion)
+
+    async def _wsgi(self, scope, receive, send):
+        cuerpo = []
+        while True:
+            mensaje = await receive()
+            if mensaje['type'] == 'http.disconnect':
+                return
+            cuerpo.append(mensaje.get('body', b''))
+            if not mensaje.get('more_body'):
+                break
+
+        environ = self._environ(scope, b"".join(cuerpo))
+        loop = asyncio.get_running_loop()
+        status, headers, body = await loop.run_in_executor(self._pool, self._llamar, environ)
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def _llamar(self, environ):
+        """Corre la app WSGI en un hilo del pool y junta la respuesta entera"""
+        respuesta = {}
+
+        def start_response(status, headers, exc_info=None):
+            respuesta['status'] = int(status.split(' ', 1)[0])
+            respuesta['headers'] = [(nombre.lower().encode('latin-1'), valor.encode('latin-1'))
+                                    for nombre, valor in headers]
+
+        resultado = self.wsgi_app(environ, start_response)
+        try:
+            body = b"".join(resultado)
+        finally:
+            if hasattr(resultado, 'close'):
+                resultado.close()
+        return respuesta['status'], respuesta['headers'], body
+
+    @staticmethod
+    def _environ(scope, body):
+        servidor = scope.get('server') or ('localhost', 80)
+        cliente = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': servidor[0],
+            'SERVER_PORT': str(servidor[1]),
+            'REMOTE_ADDR': cliente[0],
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for nombre, valor in scope['headers']:
+            nombre = nombre.decode('latin-1')
+            valor = valor.decode('latin-1')
+            if nombre == 'content-type':
+                environ['CONTENT_TYPE'] = valor
+            elif nombre != 'content-length':
+                clave = 'HTTP_' + nombre.upper().replace('-', '_')
+                environ[clave] = f"{environ[clave]},{valor}" if clave in environ else valor
+        return environ
+
+asgi_app = PuenteAsgi(app)
+
+def servir_asgi(host, port):
+    try:
+        import uvicorn
+    except ImportError:
+        print("⚠️ PI_SERVIDOR=asgi necesita uvicorn (pip install uvicorn): uso el servidor de Flask")
+        app.run(host=host, port=port, debug=False)
+        return
+    print(f"⚡ Servidor ASGI (uvicorn) en {host}:{port}")
+    uvicorn.run(asgi_app, host=host, port=port, log_level='warning')
+
 # ============================================
 # MAIN
 # ============================================
 if __name__ == '__main__':
     try:
         print("\n--- INICIANDO BARTENDER IA (NUEVO FORMATO) ---")
-        if setup_gpio():
-            t = threading.Thread(target=procesar_pedidos, daemon=True)
-            t.start()
-            app.run(host='0.0.0.0', port=5000, debug=False)
+        print(f"🔌 Backend de bombas: {bombas.nombre}")
+        if arrancar():
+            if SERVIDOR == 'asgi':
+                servir_asgi('0.0.0.0', 5000)
+            else:
+                app.run(host='0.0.0.0', port=5000, debug=False)
         else:
             print("Error fatal en configuración GPIO")
             
     except KeyboardInterrupt:
         print("\nApagando...")
-        GPIO.cleanup()
\ No newline at end of file
+        bombas.limpiar()
\ No newline at end of file
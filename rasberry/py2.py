@@ -1,40 +1,610 @@
+import os
 import json
+import math
+import sys
 import time
 import threading
+import traceback
 from queue import Queue
+import heapq
+import bisect
+import itertools
+import multiprocessing
+import signal
+from collections import namedtuple, deque
 from datetime import datetime
-import RPi.GPIO as GPIO
 from flask import Flask, request, jsonify
 
 # ============================================
 # CONFIGURACIÓN GLOBAL
 # ============================================
 app = Flask(__name__)
-GPIO.setmode(GPIO.BCM)
 
-# Cola de pedidos y sistema de estado
-pedidos_queue = Queue()
+# Estado del worker (la cola de pedidos está en PLANIFICADOR DE PEDIDOS)
 preparando = False
 preparando_lock = threading.Lock()
 
+# ============================================
+# REGISTRO (LOGS)
+# ============================================
+# Los mensajes se encolan y los escribe un hilo aparte, así ni el worker ni
+# los endpoints esperan nunca a stdout (journald, una sesión SSH lenta...).
+# PI_LOG=texto (por defecto) escribe una línea legible por mensaje,
+# PI_LOG=json una línea JSON con los campos (pedido_id, tiempos...) y
+# PI_LOG='' no escribe nada.
+LOG_FORMATO = os.environ.get('PI_LOG', 'texto')
+LOG_MAX_PENDIENTES = 2000  # Si stdout no da abasto se descartan (y se cuentan)
+
+class Log:
+    """
+    Logger estructurado que no bloquea a quien lo llama. El hilo que escribe
+    arranca con el primer mensaje, no al importar: así DriverProceso hace
+    el fork mientras el proceso todavía tiene un solo hilo.
+    """
+    def __init__(self, formato=LOG_FORMATO, max_pendientes=LOG_MAX_PENDIENTES):
+        self.formato = formato
+        self.max_pendientes = max_pendientes
+        self.descartados = 0
+        self._pendientes = deque()
+        self._aviso = threading.Event()
+        self._hilo = None
+        self._hilo_lock = threading.Lock()
+
+    def info(self, mensaje, **campos):
+        self._anotar('info', mensaje, campos)
+
+    def aviso(self, mensaje, **campos):
+        self._anotar('aviso', mensaje, campos)
+
+    def error(self, mensaje, **campos):
+        self._anotar('error', mensaje, campos)
+
+    def _anotar(self, nivel, mensaje, campos):
+        if not self.formato:
+            return
+        if len(self._pendientes) >= self.max_pendientes:
+            self.descartados += 1
+            return
+        self._pendientes.append((time.time(), nivel, mensaje, campos))
+        if self._hilo is None:
+            self._arrancar()
+        self._aviso.set()
+
+    def _arrancar(self):
+        with self._hilo_lock:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._escribir, daemon=True)
+                self._hilo.start()
+
+    def _formatear(self, t, nivel, mensaje, campos):
+        if self.formato == 'json':
+            registro = {"t": round(t, 3), "nivel": nivel, "msg": mensaje, **campos}
+            return json.dumps(registro, ensure_ascii=False, default=str) + "\n"
+        if 'traza' in campos:
+            return f"{mensaje}\n{campos['traza']}"
+        return mensaje + "\n"
+
+    def _escribir(self):
+        while True:
+            self._aviso.wait()
+            self._aviso.clear()
+            lineas = []
+            while self._pendientes:
+                lineas.append(self._formatear(*self._pendientes.popleft()))
+            salida = sys.stdout
+            if not lineas or salida is None:
+                continue
+            try:
+                salida.write("".join(lineas))
+                salida.flush()
+            except (OSError, ValueError):
+                pass
+
+log = Log()
+
+# ============================================
+# BACKEND DE BOMBAS (GPIO REAL O SIMULADO)
+# ============================================
+# PI_GPIO_BACKEND=rpi (por defecto) usa RPi.GPIO; PI_GPIO_BACKEND=sim usa el
+# simulador en memoria. PI_SIM_VELOCIDAD acelera el reloj del simulador.
+# PI_DRIVER_PROCESO=1 corre el driver en un proceso aparte (ver DriverProceso),
+# con PI_DRIVER_PRIORIDAD (SCHED_FIFO 1-99) y PI_DRIVER_CPU (núcleo fijo).
+GPIO_BACKEND = os.environ.get('PI_GPIO_BACKEND', 'rpi')
+DRIVER_PROCESO = os.environ.get('PI_DRIVER_PROCESO', '') == '1'
+DRIVER_PRIORIDAD = int(os.environ.get('PI_DRIVER_PRIORIDAD', '0'))
+DRIVER_CPU = os.environ.get('PI_DRIVER_CPU', '')
+SPIN_FINAL_NS = 2_000_000  # Últimos 2 ms antes de un deadline en espera activa
+
+class RelojReal:
+    """Reloj monotónico del sistema"""
+    spin_ns = SPIN_FINAL_NS
+    def monotonic_ns(self):
+        return time.monotonic_ns()
+
+    def segundos_reales(self, duracion_ns):
+        return duracion_ns / 1e9
+
+    def esperar_hasta(self, deadline_ns):
+        """Duerme hasta `deadline_ns` y hace spin en el último tramo"""
+        while True:
+            restante = deadline_ns - time.monotonic_ns()
+            if restante <= 0:
+                return
+            if restante > self.spin_ns:
+                time.sleep((restante - self.spin_ns) / 1e9)
+
+class RelojAcelerado:
+    """Reloj que corre `factor` veces más rápido que el real"""
+    spin_ns = SPIN_FINAL_NS
+
+    def __init__(self, factor):
+        self.factor = float(factor)
+        self._base_real = time.monotonic_ns()
+
+    def monotonic_ns(self):
+        return int((time.monotonic_ns() - self._base_real) * self.factor)
+
+    def segundos_reales(self, duracion_ns):
+        return duracion_ns / self.factor / 1e9
+
+    def esperar_hasta(self, deadline_ns):
+        while True:
+            restante_real = (deadline_ns - self.monotonic_ns()) / self.factor
+            if restante_real <= 0:
+                return
+            if restante_real > self.spin_ns:
+                time.sleep((restante_real - self.spin_ns) / 1e9)
+
+class RelojVirtual:
+    """
+    Reloj que solo avanza cuando alguien espera: esperar_hasta() salta
+    directamente al deadline. Pensado para un único hilo de simulación.
+    """
+    def __init__(self):
+        self._ahora = 0
+
+    def monotonic_ns(self):
+        return self._ahora
+
+    def segundos_reales(self, duracion_ns):
+        return 0.0
+
+    def esperar_hasta(self, deadline_ns):
+        if deadline_ns > self._ahora:
+            self._ahora = deadline_ns
+
+class DriverRPi:
+    """Bombas conectadas a relés por RPi.GPIO (relés activos en LOW)"""
+    nombre = 'rpi'
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self._gpio = GPIO
+        self.reloj = RelojReal()
+        GPIO.setmode(GPIO.BCM)
+
+    def configurar(self, pin):
+        self._gpio.setup(pin, self._gpio.OUT)
+        self._gpio.output(pin, self._gpio.HIGH)  # Apagado inicial
+
+    def encender(self, pin, duracion_ns=None):
+        self._gpio.output(pin, self._gpio.LOW)
+
+    def apagar(self, pin):
+        self._gpio.output(pin, self._gpio.HIGH)
+
+    def limpiar(self):
+        self._gpio.cleanup()
+
+class DriverSimulado:
+    """
+    Bombas simuladas: guarda cada cambio de estado de los pines con el
+    instante del reloj (real, acelerado o virtual) en que ocurrió.
+    """
+    nombre = 'sim'
+
+    def __init__(self, reloj=None, max_transiciones=100000):
+        self.reloj = reloj or RelojReal()
+        self._lock = threading.Lock()
+        self.transiciones = deque(maxlen=max_transiciones)  # (t_ns, pin, encendida)
+        self.encendidas = {}  # pin -> True/False
+
+    def _registrar(self, pin, encendida):
+        with self._lock:
+            self.encendidas[pin] = encendida
+            self.transiciones.append((self.reloj.monotonic_ns(), pin, encendida))
+
+    def configurar(self, pin):
+        self._registrar(pin, False)
+
+    def encender(self, pin, duracion_ns=None):
+        self._registrar(pin, True)
+
+    def apagar(self, pin):
+        self._registrar(pin, False)
+
+    def limpiar(self):
+        with self._lock:
+            self.encendidas.clear()
+
+class DriverProceso:
+    """
+    Corre otro driver (rpi o sim) en un proceso hijo, lejos del GIL que
+    comparten el worker, los requests de Flask y el parseo de pi.json.
+
+    encender(pin, duracion_ns) le pasa al hijo la duración del paso: el
+    apagado lo hace el hijo en su deadline, con sleep + spin como
+    esperar_hasta(), aunque este proceso esté ocupado. Cuando el worker
+    llega a apagar(), el pin normalmente ya está apagado y el hijo
+    contesta cuándo lo apagó. Sin duración, el pin queda encendido hasta
+    apagar(), como con los otros drivers.
+
+    Cada llamada es un mensaje por un Pipe y su respuesta (el instante en
+    que pasó, en el reloj del driver). Si este proceso muere, el hijo ve
+    el Pipe cerrado y apaga todo antes de salir.
+    """
+    def __init__(self, driver):
+        # fork: el hijo hereda el driver ya creado y su reloj, así los
+        # instantes de ambos procesos se comparan directamente. Se crea al
+        # importar, antes de cualquier hilo (el del log arranca con el primer
+        # mensaje): un fork con otros hilos andando puede dejar al hijo con
+        # un lock tomado para siempre.
+        if threading.active_count() > 1:
+            print("⚠️ DriverProceso creado con otros hilos andando: el fork puede trabarse", flush=True)
+        contexto = multiprocessing.get_context('fork')
+        self._conexion, hijo = contexto.Pipe()
+        self._lock = threading.Lock()
+        self.nombre = f"{driver.nombre} (proceso aparte)"
+        self.reloj = driver.reloj
+        self._proceso = contexto.Process(target=_servir_bombas, args=(driver, hijo, self._conexion),
+                                         name='bombas', daemon=True)
+        self._proceso.start()
+        hijo.close()
+        # Los deadlines finos son del hijo: acá alcanza con despertarse a
+        # tiempo, sin competir con él por la CPU haciendo spin
+        self.reloj.spin_ns = 0
+
+    def _pedir(self, orden, pin=None, valor=None):
+        with self._lock:
+            try:
+                self._conexion.send((orden, pin, valor))
+                return self._conexion.recv()
+            except (EOFError, OSError) as e:
+                raise ConnectionError(f"El proceso de bombas no responde: {e}") from e
+
+    def configurar(self, pin):
+        self._pedir('configurar', pin)
+
+    def encender(self, pin, duracion_ns=None):
+        return self._pedir('encender', pin, duracion_ns)
+
+    def apagar(self, pin):
+        return self._pedir('apagar', pin)
+
+    def limpiar(self):
+        self._pedir('limpiar')
+
+def _prioridad_tiempo_real():
+    """Núcleo fijo y SCHED_FIFO para el proceso de bombas, si se pidieron"""
+    # En el hijo no corre el hilo del log: los avisos van directo a stdout
+    try:
+        if DRIVER_CPU:
+            os.sched_setaffinity(0, {int(DRIVER_CPU)})
+        if DRIVER_PRIORIDAD:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(DRIVER_PRIORIDAD))
+    except (OSError, AttributeError, ValueError) as e:
+        print(f"⚠️ Proceso de bombas sin prioridad de tiempo real: {e}", flush=True)
+
+def _servir_bombas(driver, conexion, otra_punta):
+    """Loop del proceso de bombas: atiende pedidos y apaga cada pin en su deadline"""
+    otra_punta.close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C lo maneja el proceso principal
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    _prioridad_tiempo_real()
+
+    reloj = driver.reloj
+    pines = set()
+    deadlines = {}  # pin -> cuándo apagarlo
+    apagadas = {}   # pin -> cuándo se apagó por su deadline (hasta que el worker lo pregunte)
+    try:
+        while True:
+            espera = None
+            if deadlines:
+                pin, deadline = min(deadlines.items(), key=lambda item: item[1])
+                espera = reloj.segundos_reales(deadline - reloj.monotonic_ns()) - reloj.spin_ns / 1e9
+                if espera <= 0:
+                    reloj.esperar_hasta(deadline)
+                    driver.apagar(pin)
+                    apagadas[pin] = reloj.monotonic_ns()
+                    del deadlines[pin]
+                    continue
+            if not conexion.poll(espera):
+                continue
+
+            orden, pin, valor = conexion.recv()
+            respuesta = None
+            if orden == 'encender':
+                driver.encender(pin)
+                respuesta = reloj.monotonic_ns()
+                apagadas.pop(pin, None)
+                if valor is not None:
+                    deadlines[pin] = respuesta + valor
+            elif orden == 'apagar':
+                if pin in apagadas:
+                    respuesta = apagadas.pop(pin)
+                else:
+                    driver.apagar(pin)
+                    respuesta = reloj.monotonic_ns()
+                    deadlines.pop(pin, None)
+            elif orden == 'configurar':
+                driver.configurar(pin)
+                pines.add(pin)
+            elif orden == 'limpiar':
+                driver.limpiar()
+                deadlines.clear()
+            conexion.send(respuesta)
+    except EOFError:
+        pass  # Se cerró el proceso principal
+    finally:
+        for pin in pines:
+            driver.apagar(pin)
+
+def crear_driver(backend=GPIO_BACKEND, proceso=DRIVER_PROCESO):
+    """Crea el driver de bombas indicado ('rpi' o 'sim'), en un proceso aparte si se pide"""
+    if backend == 'sim':
+        velocidad = float(os.environ.get('PI_SIM_VELOCIDAD', '1'))
+        reloj = RelojAcelerado(velocidad) if velocidad != 1 else RelojReal()
+        driver = DriverSimulado(reloj)
+    else:
+        driver = DriverRPi()
+    return DriverProceso(driver) if proceso else driver
+
+bombas = crear_driver()
+
+# ============================================
+# CALIBRACIÓN
+# ============================================
 # CALIBRACIÓN: segundos por mililitro
 # Ajusta estos valores según tu bomba específica
 SEGUNDOS_POR_ML = 0.5  # Por ejemplo: 10ml = 5 segundos, 30ml = 15 segundos
 
+# Por bomba: flow_rate / dead_time_s de pi.json o lo ajustado con mediciones.
+# Las bombas sin datos usan SEGUNDOS_POR_ML.
+CALIBRACION_POR_PIN = {}
+ARRANQUE_POR_PIN = {}  # Tiempo muerto al arrancar, hasta que el líquido llega al vaso
+
+# Versión de la calibración: cambia cada vez que se toca CALIBRACION_POR_PIN
+calibracion_version = 0
+
+def set_calibracion(pin, rate, arranque=None):
+    """Actualiza los seg/ml (y el arranque) de un pin e invalida las recetas compiladas"""
+    global calibracion_version
+    CALIBRACION_POR_PIN[pin] = rate
+    if arranque is not None:
+        ARRANQUE_POR_PIN[pin] = arranque
+    calibracion_version += 1
+
+def duracion_vertido(pin, ml):
+    """Segundos de bomba para servir `ml`: arranque + ml * seg/ml"""
+    if ml <= 0:
+        return 0.0
+    return ARRANQUE_POR_PIN.get(pin, 0.0) + ml * CALIBRACION_POR_PIN.get(pin, SEGUNDOS_POR_ML)
+
+# VERTIDO EN PARALELO: se activa con config.parallel_pour en pi.json.
+# config.max_concurrent_pumps limita cuántas bombas se encienden a la vez
+MAX_CONCURRENT_PUMPS_DEFAULT = 6
+
 # ============================================
-# FUNCIONES DE CONFIGURACIÓN
+# CALIBRACIÓN POR MEDICIONES (LAZO CERRADO)
 # ============================================
-def load_config():
-    """Carga la configuración completa desde pi.json"""
-    try:
-        with open('pi.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        print("❌ Error: pi.json no encontrado")
+# Cada medición es (segundos que estuvo encendida la bomba, ml que cayeron
+# en el vaso). Por bomba se ajusta  ml = caudal * (segundos - arranque):
+# el caudal ya incluye la viscosidad del líquido de esa bomba y `arranque`
+# es el tiempo muerto hasta que el líquido llega al vaso. El resultado se
+# guarda en PI_CALIBRACION ('' = no guardar) y pisa el flow_rate de pi.json
+# (o SEGUNDOS_POR_ML).
+CALIBRACION_PATH = os.environ.get('PI_CALIBRACION', 'calibracion.json')
+MAX_MUESTRAS_CALIBRACION = 30  # Solo las últimas (la bomba se gasta, la manguera cambia)
+MAX_ARRANQUE_S = 3.0
+MIN_DISPERSION_S = 0.5         # Variedad de tiempos necesaria para separar caudal y arranque
+
+def ajustar_caudal(muestras, arranque_previo=0.0):
+    """
+    Ajuste por mínimos cuadrados de [(segundos, ml)].
+    Retorna (caudal_ml_s, arranque_s) o None si las muestras no sirven.
+    """
+    if not all(math.isfinite(t) and math.isfinite(ml) for t, ml in muestras):
         return None
-    except json.JSONDecodeError:
-        print("❌ Error: pi.json mal formateado")
+    n = len(muestras)
+    if n >= 2:
+        media_t = sum(t for t, _ in muestras) / n
+        media_ml = sum(ml for _, ml in muestras) / n
+        var_t = sum((t - media_t) ** 2 for t, _ in muestras) / n
+        if var_t ** 0.5 >= MIN_DISPERSION_S:
+            caudal = sum((t - media_t) * (ml - media_ml) for t, ml in muestras) / n / var_t
+            if caudal > 0:
+                arranque = media_t - media_ml / caudal
+                if 0.0 <= arranque <= MAX_ARRANQUE_S:
+                    return caudal, arranque
+
+    # Tiempos parecidos (o un ajuste sin sentido físico): se conserva el
+    # arranque conocido y solo se corrige el caudal
+    util = sum(max(0.0, t - arranque_previo) for t, _ in muestras)
+    total_ml = sum(ml for _, ml in muestras)
+    if util <= 0 or total_ml <= 0:
         return None
+    caudal = total_ml / util
+    return (caudal, arranque_previo) if math.isfinite(caudal) and math.isfinite(arranque_previo) else None
+
+class CalibracionAutomatica:
+    """Mediciones por pin, modelo ajustado y su persistencia"""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.muestras = {}  # pin -> deque[(segundos, ml)]
+        self.modelos = {}   # pin -> (caudal_ml_s, arranque_s)
+
+    def cargar(self):
+        """Lee las mediciones guardadas y aplica los modelos a CALIBRACION_POR_PIN"""
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                guardado = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        with self._lock:
+            for pin, datos in guardado.items():
+                pin = int(pin)
+                self.muestras[pin] = deque((tuple(m) for m in datos.get('muestras', [])),
+                                           maxlen=MAX_MUESTRAS_CALIBRACION)
+                caudal, arranque = datos['caudal_ml_s'], datos['arranque_s']
+                if (isinstance(caudal, (int, float)) and isinstance(arranque, (int, float)) and
+                        math.isfinite(caudal) and caudal > 0 and math.isfinite(arranque)):
+                    self.modelos[pin] = (caudal, arranque)
+            modelos = dict(self.modelos)
+
+        for pin, (caudal, arranque) in modelos.items():
+            set_calibracion(pin, 1.0 / caudal, arranque)
+
+    def medir(self, pin, segundos, ml):
+        """
+        Agrega una medición, reajusta el modelo del pin y lo aplica.
+        Retorna (caudal, arranque, error_ml) donde error_ml es cuánto se
+        equivocaba el modelo anterior con esta medición, o None.
+        """
+        with self._lock:
+            arranque_previo = ARRANQUE_POR_PIN.get(pin, 0.0)
+            previsto = max(0.0, segundos - arranque_previo) / CALIBRACION_POR_PIN.get(pin, SEGUNDOS_POR_ML)
+            muestras = self.muestras.setdefault(pin, deque(maxlen=MAX_MUESTRAS_CALIBRACION))
+            muestras.append((segundos, ml))
+            modelo = ajustar_caudal(list(muestras), arranque_previo)
+            if modelo is None:
+                muestras.pop()
+                return None
+            self.modelos[pin] = modelo
+            self._guardar()
+
+        caudal, arranque = modelo
+        set_calibracion(pin, 1.0 / caudal, arranque)
+        return caudal, arranque, previsto - ml
+
+    def cantidad(self, pin):
+        with self._lock:
+            return len(self.muestras.get(pin, ()))
+
+    def _guardar(self):
+        if not self.path:
+            return
+        datos = {
+            str(pin): {
+                "caudal_ml_s": round(caudal, 4),
+                "arranque_s": round(arranque, 4),
+                "muestras": [[round(t, 4), round(ml, 2)] for t, ml in self.muestras.get(pin, ())]
+            }
+            for pin, (caudal, arranque) in self.modelos.items()
+        }
+        try:
+            temporal = self.path + '.tmp'
+            with open(temporal, 'w', encoding='utf-8') as f:
+                json.dump(datos, f)
+            os.replace(temporal, self.path)
+        except OSError as e:
+            log.error(f"❌ Error guardando la calibración: {e}")
+
+calibracion_auto = CalibracionAutomatica(CALIBRACION_PATH)
+
+# ============================================
+# CACHÉ DE CONFIGURACIÓN
+# ============================================
+CONFIG_PATH = 'pi.json'
+CONFIG_RECHECK_MS = 500  # Cada cuánto se revisa si pi.json cambió en disco
+
+class _FrozenDict(dict):
+    """dict de solo lectura (sigue siendo serializable por jsonify)"""
+    def _solo_lectura(self, *args, **kwargs):
+        raise TypeError("La configuración es de solo lectura")
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _solo_lectura
+
+def _freeze(value):
+    """Convierte dicts/listas del JSON en estructuras inmutables"""
+    if isinstance(value, dict):
+        return _FrozenDict((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+class ConfigStore:
+    """
+    Mantiene una única copia parseada de pi.json compartida por los
+    endpoints y el worker. Revisa el archivo (stat) como mucho cada
+    `recheck_ms` y solo re-parsea si cambió inode, mtime o tamaño.
+    """
+    def __init__(self, path, recheck_ms=CONFIG_RECHECK_MS):
+        self.path = path
+        self.recheck_s = recheck_ms / 1000.0
+        self.version = 0
+        self.recargas = 0
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._firma = None
+        self._proxima_revision = 0.0
+
+    def get(self):
+        """Devuelve el snapshot actual (o None si pi.json no es válido)"""
+        if time.monotonic() < self._proxima_revision:
+            return self._snapshot
+        
+        with self._lock:
+            ahora = time.monotonic()
+            if ahora < self._proxima_revision:
+                return self._snapshot
+            self._proxima_revision = ahora + self.recheck_s
+            
+            try:
+                st = os.stat(self.path)
+                firma = (st.st_ino, st.st_mtime_ns, st.st_size)
+            except OSError:
+                if self._firma is not None or self.version == 0:
+                    log.error("❌ Error: pi.json no encontrado", archivo=self.path)
+                    self.version += 1
+                self._firma = None
+                self._snapshot = None
+                return None
+            
+            if firma == self._firma:
+                return self._snapshot
+            
+            self._firma = firma
+            self._snapshot = self._leer()
+            self.version += 1
+            self.recargas += 1
+            return self._snapshot
+
+    def invalidar(self):
+        """Fuerza una revisión del archivo en la próxima lectura"""
+        self._proxima_revision = 0.0
+
+    def _leer(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return _freeze(json.load(f))
+        except FileNotFoundError:
+            log.error("❌ Error: pi.json no encontrado", archivo=self.path)
+            return None
+        except json.JSONDecodeError:
+            log.error("❌ Error: pi.json mal formateado", archivo=self.path)
+            return None
+
+config_store = ConfigStore(CONFIG_PATH)
+
+# ============================================
+# FUNCIONES DE CONFIGURACIÓN
+# ============================================
+def load_config():
+    """Devuelve la configuración (snapshot inmutable) desde la caché"""
+    return config_store.get()
 
 def setup_gpio():
     """Configura los pines GPIO inicialmente"""
@@ -45,78 +615,676 @@ def setup_gpio():
     pumps = config.get('pumps', {})
     for pump_id, pump_info in pumps.items():
         pin = pump_info["pin"]
-        GPIO.setup(pin, GPIO.OUT)
-        GPIO.output(pin, GPIO.HIGH)  # Apagado (relés activos en LOW)
-        print(f"✓ Configurado {pump_info['name']} en pin {pin}")
+        bombas.configurar(pin)  # Apagado (relés activos en LOW)
+        
+        flow_rate = pump_info.get('flow_rate')
+        rate = 1.0 / flow_rate if flow_rate else SEGUNDOS_POR_ML
+        set_calibracion(pin, rate, pump_info.get('dead_time_s', 0.0))
+        log.info(f"✓ Configurado {pump_info['name']} en pin {pin} ({rate:.4f} seg/ml)",
+                 pin=pin, bomba=pump_id, seg_por_ml=round(rate, 6))
+    
+    # Lo medido en el vaso manda sobre pi.json
+    calibracion_auto.cargar()
+    for pin, (caudal, arranque) in calibracion_auto.modelos.items():
+        log.info(f"📏 Pin {pin} calibrado por mediciones: {caudal:.2f} ml/s, arranque {arranque:.2f}s",
+                 pin=pin, caudal_ml_s=round(caudal, 4), arranque_s=round(arranque, 4))
     
     return True
 
 # ============================================
 # VALIDACIÓN Y PREPARACIÓN DE RECETAS
 # ============================================
+# Bomba a activar dentro de una receta (inmutable, compartida entre pedidos)
+PasoBomba = namedtuple('PasoBomba', ['pump_id', 'gpio_pin', 'ingredient', 'ml', 'name', 'duration'])
+RecetaCompilada = namedtuple('RecetaCompilada', ['recipe_id', 'recipe_name', 'pumps', 'tiempo_estimado'])
+
+def ajustes_vertido(config):
+    """Retorna (parallel_pour, max_concurrent_pumps) según pi.json"""
+    cfg = config.get('config', {}) if config else {}
+    try:
+        max_bombas = max(1, int(cfg.get('max_concurrent_pumps', MAX_CONCURRENT_PUMPS_DEFAULT)))
+    except (TypeError, ValueError):
+        max_bombas = MAX_CONCURRENT_PUMPS_DEFAULT
+    return bool(cfg.get('parallel_pour', False)), max_bombas
+
+def duracion_paralela(pumps, max_bombas):
+    """Tiempo total de verter `pumps` a la vez con un máximo de `max_bombas` encendidas"""
+    fines = [0.0] * min(max_bombas, len(pumps))
+    for pump_data in pumps:
+        # Cada bomba arranca en el primer hueco que se libera
+        inicio = heapq.heappop(fines)
+        heapq.heappush(fines, inicio + pump_data.duration)
+    return max(fines) if fines else 0.0
+
+def compilar_recetas(config):
+    """
+    Compila todas las recetas de la configuración.
+    Retorna: (recetas, errores) indexados por recipe_id
+    """
+    # Índice ingrediente -> bomba (una sola pasada por las bombas)
+    bomba_por_ingrediente = {}
+    for pump_id, pump_info in config.get('pumps', {}).items():
+        bomba_por_ingrediente.setdefault(pump_info['value'], (pump_id, pump_info))
+    
+    parallel_pour, max_bombas = ajustes_vertido(config)
+    pausa = config.get('config', {}).get('cleanup_delay', 2)
+    recetas = {}
+    errores = {}
+    
+    for recipe_id, recipe in config.get('recipes', {}).items():
+        pumps_to_activate = []
+        
+        for ingredient, ml in recipe['ingredients'].items():
+            if ingredient not in bomba_por_ingrediente:
+                errores[recipe_id] = f"Ingrediente '{ingredient}' no disponible en ninguna bomba"
+                break
+            
+            pump_id, pump_info = bomba_por_ingrediente[ingredient]
+            duracion = duracion_vertido(pump_info['pin'], ml)
+            maximo = pump_info.get('max_on_s')
+            if maximo is not None and duracion > maximo:
+                errores[recipe_id] = (f"'{ingredient}' necesita {duracion:.1f}s de bomba, "
+                                      f"más que el máximo de {maximo}s de {pump_id}")
+                break
+            pumps_to_activate.append(PasoBomba(
+                pump_id, pump_info['pin'], ingredient, ml, pump_info['name'], duracion
+            ))
+        else:
+            pumps_to_activate = tuple(pumps_to_activate)
+            if parallel_pour:
+                tiempo = duracion_paralela(pumps_to_activate, max_bombas)
+            else:
+                # La pausa va entre ingredientes, no después del último
+                tiempo = sum(p.duration for p in pumps_to_activate)
+                tiempo += max(0, len(pumps_to_activate) - 1) * pausa
+            recetas[recipe_id] = RecetaCompilada(recipe_id, recipe['name'], pumps_to_activate, tiempo)
+    
+    return recetas, errores
+
+class RecipeIndex:
+    """Recetas precompiladas, reconstruidas solo cuando cambia pi.json o la calibración"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tabla = (None, {}, {})
+
+    def _actual(self, config):
+        clave = (config_store.version, calibracion_version)
+        tabla = self._tabla
+        if tabla[0] != clave:
+            with self._lock:
+                tabla = self._tabla
+                if tabla[0] != clave:
+                    recetas, errores = compilar_recetas(config)
+                    tabla = self._tabla = (clave, recetas, errores)
+        return tabla
+
+    def recetas(self):
+        """Todas las recetas compiladas con la configuración actual"""
+        config = load_config()
+        return self._actual(config)[1] if config else {}
+
+    def get(self, recipe_id):
+        """Retorna: (RecetaCompilada, None) o (None, mensaje_error)"""
+        config = load_config()
+        if not config:
+            return None, "Error cargando configuración"
+        
+        tabla = self._actual(config)
+        receta = tabla[1].get(recipe_id)
+        if receta:
+            return receta, None
+        if recipe_id in tabla[2]:
+            return None, tabla[2][recipe_id]
+        return None, f"Receta '{recipe_id}' no existe en la configuración"
+
+recipe_index = RecipeIndex()
+
 def validate_and_prepare_recipe(recipe_id):
     """
     Valida que la receta existe y prepara la lista de bombas a activar
     Retorna: (success, data/error_message)
     """
-    config = load_config()
-    if not config:
-        return False, "Error cargando configuración"
-    
-    # Verificar que la receta existe
-    recipes = config.get('recipes', {})
-    if recipe_id not in recipes:
-        return False, f"Receta '{recipe_id}' no existe en la configuración"
-    
-    recipe = recipes[recipe_id]
-    recipe_name = recipe['name']
-    ingredients_needed = recipe['ingredients']  # Dict: {ingrediente: ml}
-    
-    # Buscar qué bomba tiene cada ingrediente
-    available_pumps = config.get('pumps', {})
-    pumps_to_activate = []
-    
-    for ingredient, ml in ingredients_needed.items():
-        # Buscar la bomba que tiene este ingrediente
-        pump_found = None
-        for pump_id, pump_info in available_pumps.items():
-            if pump_info['value'] == ingredient:
-                pump_found = {
-                    'pump_id': pump_id,
-                    'gpio_pin': pump_info['pin'],
-                    'ingredient': ingredient,
-                    'ml': ml,
-                    'name': pump_info['name']
-                }
-                break
-        
-        if not pump_found:
-            return False, f"Ingrediente '{ingredient}' no disponible en ninguna bomba"
-        
-        pumps_to_activate.append(pump_found)
+    receta, error = recipe_index.get(recipe_id)
+    if not receta:
+        return False, error
     
     return True, {
         'recipe_id': recipe_id,
-        'recipe_name': recipe_name,
-        'pumps': pumps_to_activate,
+        'recipe_name': receta.recipe_name,
+        'pumps': receta.pumps,
+        'tiempo_estimado': receta.tiempo_estimado,
         'timestamp': datetime.now().isoformat()
     }
 
+# ============================================
+# TEMPORIZADOR DE BOMBAS
+# ============================================
+# Todos los tiempos de bombas usan el reloj monotónico del driver
+def ahora_ns():
+    return bombas.reloj.monotonic_ns()
+
+def esperar_hasta(deadline_ns):
+    """Bloquea hasta `deadline_ns` (según el reloj del driver de bombas)"""
+    bombas.reloj.esperar_hasta(deadline_ns)
+
+class EstadisticasPulsos:
+    """Registra tiempo pedido vs. tiempo real encendido de cada bomba"""
+    def __init__(self, max_muestras=200):
+        self._lock = threading.Lock()
+        self._muestras = deque(maxlen=max_muestras)
+        self.pasos = 0
+        self._suma_error = 0.0
+        self._suma_error2 = 0.0
+        self._max_error = 0.0
+        self.ultimo = {}  # pin -> segundos reales del último encendido
+
+    def registrar(self, pin, pedido_s, real_s):
+        error = real_s - pedido_s
+        with self._lock:
+            self.ultimo[pin] = real_s
+            self._muestras.append((pin, pedido_s, real_s))
+            self.pasos += 1
+            self._suma_error += error
+            self._suma_error2 += error * error
+            self._max_error = max(self._max_error, abs(error))
+
+    def resumen(self):
+        with self._lock:
+            n = self.pasos
+            muestras = list(self._muestras)
+            media = self._suma_error / n if n else 0.0
+            varianza = max(0.0, self._suma_error2 / n - media * media) if n else 0.0
+            max_error = self._max_error
+        
+        return {
+            'pasos': n,
+            'error_medio_ms': round(media * 1000, 3),
+            'jitter_ms': round(varianza ** 0.5 * 1000, 3),
+            'error_max_ms': round(max_error * 1000, 3),
+            'ultimos': [
+                {'gpio_pin': pin, 'pedido_s': round(pedido, 4), 'real_s': round(real, 4)}
+                for pin, pedido, real in muestras[-20:]
+            ]
+        }
+
+estadisticas_pulsos = EstadisticasPulsos()
+
+def encender_por(pin, segundos):
+    """Enciende `pin` hasta su deadline y retorna el tiempo real encendido"""
+    vigilante.permitir(pin, segundos)
+    duracion_ns = int(segundos * 1e9)
+    inicio = bombas.encender(pin, duracion_ns)  # Relé activo en LOW
+    if inicio is None:
+        inicio = ahora_ns()
+    vigilante.encendida(pin, inicio)
+    try:
+        esperar_hasta(inicio + duracion_ns)
+    finally:
+        fin = bombas.apagar(pin)
+        vigilante.apagada(pin)
+    if fin is None:
+        fin = ahora_ns()
+    real = (fin - inicio) / 1e9
+    
+    estadisticas_pulsos.registrar(pin, segundos, real)
+    return real
+
 # ============================================
 # FUNCIÓN DE VERTIDO
 # ============================================
 def verter(pin, ml, ingredient_name):
     """Activa una bomba específica por el tiempo calculado"""
-    tiempo = ml * SEGUNDOS_POR_ML
+    tiempo = duracion_vertido(pin, ml)
     
-    print(f"  🚰 Vertiendo {ml}ml de {ingredient_name}")
-    print(f"     PIN {pin} | Tiempo: {tiempo:.1f}s")
+    log.info(f"  🚰 Vertiendo {ml}ml de {ingredient_name} (PIN {pin} | Tiempo: {tiempo:.1f}s)",
+             pin=pin, ml=ml, ingrediente=ingredient_name, duracion_s=round(tiempo, 3))
     
-    GPIO.output(pin, GPIO.LOW)   # Encender bomba (relé activo en LOW)
-    time.sleep(tiempo)
-    GPIO.output(pin, GPIO.HIGH)  # Apagar bomba
+    real = encender_por(pin, tiempo)
     
-    print(f"  ✓ Completado: {ingredient_name}")
+    log.info(f"  ✓ Completado: {ingredient_name} ({real:.3f}s reales)",
+             pin=pin, ingrediente=ingredient_name, duracion_s=round(tiempo, 3), real_s=round(real, 4))
+    return real
+
+def verter_paralelo(pumps, max_bombas):
+    """
+    Enciende todas las bombas de la receta a la vez (hasta `max_bombas`) y
+    apaga cada una en su propio deadline. Cuando una termina arranca la
+    siguiente pendiente.
+    """
+    for pump_data in pumps:
+        log.info(f"  🚰 Vertiendo {pump_data.ml}ml de {pump_data.ingredient} "
+                 f"(PIN {pump_data.gpio_pin} | {pump_data.duration:.1f}s)",
+                 pin=pump_data.gpio_pin, ml=pump_data.ml, ingrediente=pump_data.ingredient,
+                 duracion_s=round(pump_data.duration, 3))
+    
+    for pump_data in pumps:
+        vigilante.permitir(pump_data.gpio_pin, pump_data.duration)
+    
+    pendientes = list(pumps)
+    activas = []  # heap de (deadline_ns, orden, inicio_ns, pump_data)
+    terminadas = []
+    orden = 0
+    
+    try:
+        while pendientes or activas:
+            while pendientes and len(activas) < max_bombas:
+                pump_data = pendientes.pop(0)
+                duracion_ns = int(pump_data.duration * 1e9)
+                inicio = bombas.encender(pump_data.gpio_pin, duracion_ns)
+                if inicio is None:
+                    inicio = ahora_ns()
+                vigilante.encendida(pump_data.gpio_pin, inicio)
+                heapq.heappush(activas, (inicio + duracion_ns, orden, inicio, pump_data))
+                orden += 1
+            
+            deadline, _, inicio, pump_data = heapq.heappop(activas)
+            esperar_hasta(deadline)
+            fin = bombas.apagar(pump_data.gpio_pin)
+            vigilante.apagada(pump_data.gpio_pin)
+            if fin is None:
+                fin = ahora_ns()
+            real = (fin - inicio) / 1e9
+            estadisticas_pulsos.registrar(pump_data.gpio_pin, pump_data.duration, real)
+            terminadas.append((pump_data, real))
+    finally:
+        # Nunca dejar una bomba encendida si algo falla
+        for _, _, _, pump_data in activas:
+            bombas.apagar(pump_data.gpio_pin)
+            vigilante.apagada(pump_data.gpio_pin)
+    
+    for pump_data, real in terminadas:
+        log.info(f"  ✓ Completado: {pump_data.ingredient} ({real:.3f}s reales)",
+                 pin=pump_data.gpio_pin, ingrediente=pump_data.ingredient,
+                 duracion_s=round(pump_data.duration, 3), real_s=round(real, 4))
+
+# ============================================
+# PLANIFICADOR DE PEDIDOS
+# ============================================
+PRIORIDAD_MANTENIMIENTO = 'mantenimiento'
+PRIORIDAD_VIP = 'vip'
+PRIORIDAD_NORMAL = 'normal'
+
+# Valores por defecto (config.vip_advantage_s, config.maintenance_delay_s,
+# config.shortest_job_first y config.sjf_weight en pi.json)
+VENTAJA_VIP_S = 120
+RETRASO_MANTENIMIENTO_S = 300
+PESO_SJF = 1.0
+
+def ajustes_planificacion(config):
+    """Retorna {prioridad: desfase_s}, sjf, peso_sjf según pi.json"""
+    cfg = config.get('config', {}) if config else {}
+    desfases = {
+        PRIORIDAD_VIP: -float(cfg.get('vip_advantage_s', VENTAJA_VIP_S)),
+        PRIORIDAD_NORMAL: 0.0,
+        PRIORIDAD_MANTENIMIENTO: float(cfg.get('maintenance_delay_s', RETRASO_MANTENIMIENTO_S)),
+    }
+    return desfases, bool(cfg.get('shortest_job_first', False)), float(cfg.get('sjf_weight', PESO_SJF))
+
+class PlanificadorPedidos(Queue):
+    """
+    Cola con prioridades y reparto equitativo entre clientes. Cada pedido
+    recibe una clave fija al entrar y el worker toma siempre la menor:
+
+        clave = inicio_justo(cliente) + desfase(prioridad) [+ peso_sjf * duración]
+
+    El desfase está acotado (VIP adelanta, mantenimiento atrasa, pero solo
+    unos segundos), así que ningún pedido espera para siempre. Un mismo
+    cliente conserva el orden de llegada de sus pedidos. Lo que tiene delante
+    cada pedido se lleva acumulado (_antes) y sacar el primero solo mueve
+    _base, así la espera estimada no vuelve a sumar la cola.
+    """
+    def _init(self, maxsize):
+        self._claves = []
+        self._pedidos = []
+        self._duraciones = []
+        self._antes = []  # _antes[i] - _base = tiempo de los pedidos antes del i
+        self._base = 0.0
+        self._total = 0.0
+        self._seq = itertools.count()
+        self._fin_cliente = {}
+
+    def _qsize(self):
+        return len(self._claves)
+
+    def _put(self, pedido):
+        desfases, sjf, peso_sjf = ajustes_planificacion(load_config())
+        ahora = ahora_ns() / 1e9
+        duracion = pedido['tiempo_estimado']
+        
+        cliente = pedido.get('cliente')
+        inicio = max(ahora, self._fin_cliente.get(cliente, 0.0))
+        self._fin_cliente[cliente] = inicio + duracion
+        if len(self._fin_cliente) > 1000:
+            self._fin_cliente = {c: fin for c, fin in self._fin_cliente.items() if fin > ahora}
+        
+        clave = inicio + desfases.get(pedido.get('prioridad'), 0.0)
+        if sjf:
+            clave += peso_sjf * duracion
+        
+        entrada = (clave, next(self._seq))
+        pedido['clave_planificacion'] = entrada
+        i = bisect.bisect_left(self._claves, entrada)
+        antes = self._antes[i] if i < len(self._antes) else self._total + self._base
+        self._claves.insert(i, entrada)
+        self._pedidos.insert(i, pedido)
+        self._duraciones.insert(i, duracion)
+        self._antes.insert(i, antes)
+        for k in range(i + 1, len(self._antes)):
+            self._antes[k] += duracion
+        self._total += duracion
+
+    def _get(self):
+        del self._claves[0]
+        del self._antes[0]
+        duracion = self._duraciones.pop(0)
+        self._total -= duracion
+        if self._claves:
+            self._base += duracion
+        else:
+            self._base = self._total = 0.0  # Sin arrastrar error de redondeo
+        return self._pedidos.pop(0)
+
+    def _indice(self, pedido):
+        entrada = pedido.get('clave_planificacion')
+        i = bisect.bisect_left(self._claves, entrada) if entrada else len(self._claves)
+        if i < len(self._claves) and self._claves[i] == entrada:
+            return i
+        return None
+
+    def posicion(self, pedido):
+        """Posición (1 = el próximo) del pedido en la cola, o None si no está"""
+        with self.mutex:
+            i = self._indice(pedido)
+            return None if i is None else i + 1
+
+    def trabajo_antes(self, pedido):
+        """Segundos estimados de lo que se preparará antes que `pedido`"""
+        with self.mutex:
+            i = self._indice(pedido)
+            return self._antes[i] - self._base if i else 0.0
+
+    def trabajo_total(self):
+        with self.mutex:
+            return self._total
+
+pedidos_queue = PlanificadorPedidos()
+
+# ============================================
+# ESTIMACIÓN DE ESPERA
+# ============================================
+class EstimadorCola:
+    """
+    Estima cuándo estará listo un pedido: lo que queda del pedido en curso
+    más lo que el planificador tiene delante (sin recorrer la cola).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fin_actual_ns = None
+
+    def _restante_actual(self):
+        if self._fin_actual_ns is None:
+            return 0.0
+        return max(0.0, (self._fin_actual_ns - ahora_ns()) / 1e9)
+
+    def listo_en(self, pedido):
+        """Segundos hasta que `pedido` (ya encolado) esté listo"""
+        antes = pedidos_queue.trabajo_antes(pedido)
+        with self._lock:
+            return self._restante_actual() + antes + pedido['tiempo_estimado']
+
+    def iniciar(self, segundos):
+        with self._lock:
+            self._fin_actual_ns = ahora_ns() + int(segundos * 1e9)
+
+    def terminar(self):
+        with self._lock:
+            self._fin_actual_ns = None
+
+    def pendiente(self):
+        """Segundos de trabajo pendiente entre el pedido en curso y la cola"""
+        en_cola = pedidos_queue.trabajo_total()
+        with self._lock:
+            return self._restante_actual() + en_cola
+
+estimador_cola = EstimadorCola()
+
+# ============================================
+# PRUEBAS DE BOMBAS
+# ============================================
+# /test_gpio y /test_all_gpios no tocan los pines desde el request: encolan
+# una prueba (prioridad mantenimiento) que el worker corre como un pedido
+# más, así nunca se mezcla con un trago que se está sirviendo.
+PAUSA_ENTRE_PRUEBAS_S = 1
+MAX_DURACION_PRUEBA_S = 30
+MAX_PRUEBAS_GUARDADAS = 50  # Resultados que se pueden consultar en /test_gpio/<id>
+
+ESTADO_PRUEBA_EN_COLA = 'en_cola'
+ESTADO_PRUEBA_EN_CURSO = 'en_curso'
+ESTADO_PRUEBA_COMPLETADA = 'completada'
+
+class RegistroPruebas:
+    """Pruebas encoladas o terminadas por id (se olvidan las más viejas)"""
+    def __init__(self, max_guardadas=MAX_PRUEBAS_GUARDADAS):
+        self._lock = threading.Lock()
+        self._contador = itertools.count(1)
+        self._pruebas = {}
+        self._max = max_guardadas
+
+    def nueva(self, bombas_a_probar, duracion, cliente):
+        """
+        Arma el pedido de prueba para la cola. `bombas_a_probar` es una lista
+        de (pump_id, pump_info) de pi.json.
+        """
+        n = len(bombas_a_probar)
+        with self._lock:
+            prueba_id = next(self._contador)
+            prueba = {
+                'prueba_id': prueba_id,
+                'recipe_name': f"Prueba de GPIO #{prueba_id}",
+                'pumps': (),
+                'tiempo_estimado': n * duracion + max(0, n - 1) * PAUSA_ENTRE_PRUEBAS_S,
+                'prioridad': PRIORIDAD_MANTENIMIENTO,
+                'cliente': cliente,
+                'timestamp': datetime.now().isoformat(),
+                'estado': ESTADO_PRUEBA_EN_COLA,
+                'duration_seconds': duracion,
+                'results': [
+                    {'pump_id': pump_id, 'gpio_pin': pump_info['pin'], 'name': pump_info['name'],
+                     'ingredient': pump_info['value'], 'status': 'pendiente'}
+                    for pump_id, pump_info in bombas_a_probar
+                ]
+            }
+            self._pruebas[prueba_id] = prueba
+            while len(self._pruebas) > self._max:
+                del self._pruebas[next(iter(self._pruebas))]
+        return prueba
+
+    def marcar(self, prueba, estado=None, resultado=None, **campos):
+        """Cambia el estado de la prueba y/o los campos del resultado número `resultado`"""
+        with self._lock:
+            if estado:
+                prueba['estado'] = estado
+            if resultado is not None:
+                prueba['results'][resultado].update(campos)
+
+    def consultar(self, prueba_id):
+        """Copia del estado de una prueba o None si no existe (o ya se olvidó)"""
+        with self._lock:
+            prueba = self._pruebas.get(prueba_id)
+            if prueba is None:
+                return None
+            datos = {
+                'prueba_id': prueba_id,
+                'estado': prueba['estado'],
+                'duration_seconds': prueba['duration_seconds'],
+                'results': [dict(resultado) for resultado in prueba['results']]
+            }
+        if datos['estado'] == ESTADO_PRUEBA_EN_COLA:
+            datos['posicion_cola'] = pedidos_queue.posicion(prueba)
+            datos['listo_en_segundos'] = round(estimador_cola.listo_en(prueba), 1)
+        return datos
+
+registro_pruebas = RegistroPruebas()
+
+def leer_duracion_prueba(datos):
+    """duration_seconds del payload (3 por defecto) o None si no es válido"""
+    try:
+        duracion = float(datos.get('duration_seconds', 3))
+    except (TypeError, ValueError):
+        return None
+    return duracion if 0 < duracion <= MAX_DURACION_PRUEBA_S else None
+
+def encolar_prueba(bombas_a_probar, duracion, cliente):
+    """Encola la prueba y retorna el pedido (con su prueba_id)"""
+    prueba = registro_pruebas.nueva(bombas_a_probar, duracion, cliente)
+    pedidos_queue.put(prueba)
+    return prueba
+
+def respuesta_prueba(prueba, mensaje, **extra):
+    """Respuesta 202 de una prueba encolada: dónde consultar el resultado"""
+    datos = registro_pruebas.consultar(prueba['prueba_id']) or {}
+    datos.pop('results', None)
+    return jsonify({
+        'status': 'success',
+        'mensaje': mensaje,
+        'prueba_id': prueba['prueba_id'],
+        **datos,
+        'resultado': f"/test_gpio/{prueba['prueba_id']}",
+        **extra
+    }), 202
+
+def probar_bombas(prueba):
+    """Corre una prueba en el worker: cada bomba duration_seconds, con una pausa entre bombas"""
+    duracion = prueba['duration_seconds']
+    resultados = prueba['results']
+    registro_pruebas.marcar(prueba, ESTADO_PRUEBA_EN_CURSO)
+    
+    log.info(f"🧪 PRUEBA DE GPIO #{prueba['prueba_id']}: {len(resultados)} bombas, {duracion}s cada una",
+             prueba_id=prueba['prueba_id'], bombas=len(resultados), duracion_s=duracion)
+    
+    for idx, resultado in enumerate(resultados):
+        pin = resultado['gpio_pin']
+        log.info(f"[{idx + 1}/{len(resultados)}] 🚰 Probando {resultado['name']} (GPIO {pin})...",
+                 prueba_id=prueba['prueba_id'], pin=pin)
+        try:
+            real = encender_por(pin, duracion)
+            registro_pruebas.marcar(prueba, resultado=idx, status='ok', real_s=round(real, 3))
+            log.info(f"            ✅ Completado ({real:.3f}s reales)",
+                     prueba_id=prueba['prueba_id'], pin=pin, real_s=round(real, 4))
+        except Exception as e:
+            registro_pruebas.marcar(prueba, resultado=idx, status='error', error=str(e))
+            log.error(f"            ❌ Error: {e}", prueba_id=prueba['prueba_id'], pin=pin)
+        
+        # Pausa entre bombas (excepto la última)
+        if idx < len(resultados) - 1:
+            esperar_hasta(ahora_ns() + int(PAUSA_ENTRE_PRUEBAS_S * 1e9))
+    
+    registro_pruebas.marcar(prueba, ESTADO_PRUEBA_COMPLETADA)
+    log.info(f"✅ PRUEBA #{prueba['prueba_id']} COMPLETADA", prueba_id=prueba['prueba_id'])
+
+# ============================================
+# VIGILANTE DE BOMBAS (WATCHDOG)
+# ============================================
+# Un hilo aparte, que no depende del worker, mira cada VIGILANTE_TICK_S las
+# bombas encendidas y apaga todas si una lleva más que su máximo: "max_on_s"
+# de la bomba en pi.json o el paso más largo de las recetas (al menos una
+# prueba) con margen. Los pasos más largos que "max_on_s" no se encienden.
+VIGILANTE_TICK_S = 0.005
+MARGEN_ENCENDIDA_PCT = 25
+MARGEN_ENCENDIDA_S = 1.0
+LIMITE_SIN_CONFIGURAR_S = MAX_DURACION_PRUEBA_S * (1 + MARGEN_ENCENDIDA_PCT / 100) + MARGEN_ENCENDIDA_S
+
+def limites_encendido(config, recetas):
+    """Retorna ({pin: segundos máximos encendida}, {pin: max_on_s de pi.json})"""
+    largo = {}
+    for receta in recetas.values():
+        for pump_data in receta.pumps:
+            largo[pump_data.gpio_pin] = max(largo.get(pump_data.gpio_pin, 0.0), pump_data.duration)
+    
+    limites = {}
+    maximos = {}
+    for pump_info in config.get('pumps', {}).values():
+        pin = pump_info['pin']
+        if pump_info.get('max_on_s') is not None:
+            limites[pin] = maximos[pin] = float(pump_info['max_on_s'])
+        else:
+            paso = max(largo.get(pin, 0.0), MAX_DURACION_PRUEBA_S)
+            limites[pin] = paso * (1 + MARGEN_ENCENDIDA_PCT / 100) + MARGEN_ENCENDIDA_S
+    return limites, maximos
+
+class Vigilante:
+    """
+    encender_por() y verter_paralelo() avisan encendida()/apagada() de cada
+    pin; el hilo solo recorre las bombas encendidas y sin ninguna duerme.
+    """
+    def __init__(self):
+        self._desde = {}  # pin -> ns desde que está encendida
+        self._aviso = threading.Event()
+        self._limites = ({}, {})
+        self._clave = None
+        self.disparos = 0
+        self.ultimo_disparo = None
+
+    def _actualizar(self):
+        clave = (config_store.version, calibracion_version)
+        if clave != self._clave:
+            config = load_config()
+            if config:
+                self._limites = limites_encendido(config, recipe_index.recetas())
+                self._clave = clave
+        return self._limites
+
+    def permitir(self, pin, segundos):
+        """Lanza ValueError si el paso supera el max_on_s de la bomba"""
+        maximo = self._actualizar()[1].get(pin)
+        if maximo is not None and segundos > maximo:
+            raise ValueError(f"PIN {pin}: {segundos:.1f}s supera el máximo de {maximo}s encendida")
+
+    def encendida(self, pin, desde_ns):
+        self._desde[pin] = desde_ns
+        self._aviso.set()
+
+    def apagada(self, pin):
+        self._desde.pop(pin, None)
+
+    def iniciar(self):
+        threading.Thread(target=self._vigilar, daemon=True).start()
+
+    def _vigilar(self):
+        while True:
+            if not self._desde:
+                self._aviso.clear()
+                if not self._desde:
+                    self._aviso.wait()
+                continue
+            time.sleep(VIGILANTE_TICK_S)
+            try:
+                self._revisar()
+            except Exception as e:
+                log.error(f"❌ Error en el vigilante: {e}")
+
+    def _revisar(self):
+        limites = self._actualizar()[0]
+        ahora = ahora_ns()
+        for pin, desde in list(self._desde.items()):
+            limite = limites.get(pin, LIMITE_SIN_CONFIGURAR_S)
+            if ahora - desde > limite * 1e9:
+                self._disparar(f"PIN {pin} lleva más de {limite:.1f}s encendido", pin=pin,
+                               limite_s=round(limite, 2))
+                return
+
+    def _disparar(self, mensaje, **campos):
+        # Las configuradas y las que el vigilante tiene anotadas como encendidas
+        config = load_config() or {}
+        pines = {info['pin'] for info in config.get('pumps', {}).values()} | set(self._desde)
+        for pin in pines:
+            bombas.apagar(pin)
+        self._desde.clear()
+        self.disparos += 1
+        self.ultimo_disparo = {'mensaje': mensaje, 'timestamp': datetime.now().isoformat()}
+        log.error(f"🐕 VIGILANTE: {mensaje}. Se apagaron todas las bombas", pines=sorted(pines), **campos)
+
+vigilante = Vigilante()
 
 # ============================================
 # PROCESADOR DE PEDIDOS (WORKER THREAD)
@@ -131,55 +1299,63 @@ def procesar_pedidos():
         
         with preparando_lock:
             preparando = True
+        estimador_cola.iniciar(pedido['tiempo_estimado'])
         
         try:
-            print(f"\n{'='*60}")
-            print(f"🍹 INICIANDO PREPARACIÓN: {pedido['recipe_name']}")
-            print(f"   Pedido ID: {pedido['timestamp']}")
-            print(f"   Ingredientes: {len(pedido['pumps'])}")
-            print(f"   Pedidos restantes en cola: {pedidos_queue.qsize()}")
-            print(f"{'='*60}\n")
+            # Las pruebas de bombas pasan por la misma cola que los pedidos
+            if 'prueba_id' in pedido:
+                probar_bombas(pedido)
+                continue
+            
+            log.info(f"🍹 INICIANDO PREPARACIÓN: {pedido['recipe_name']} "
+                     f"({len(pedido['pumps'])} ingredientes, {pedidos_queue.qsize()} en cola)",
+                     pedido=pedido['timestamp'], receta=pedido['recipe_name'],
+                     ingredientes=len(pedido['pumps']), en_cola=pedidos_queue.qsize())
             
             config = load_config()
             max_time = config.get('config', {}).get('max_preparation_time', 60)
             cleanup_delay = config.get('config', {}).get('cleanup_delay', 2)
+            parallel_pour, max_bombas = ajustes_vertido(config)
             
-            start_time = time.time()
+            start_time = ahora_ns()
             
-            # Procesar cada bomba en secuencia
-            for idx, pump_data in enumerate(pedido['pumps'], 1):
-                # Verificar timeout
-                elapsed = time.time() - start_time
-                if elapsed > max_time:
-                    print(f"⚠️  TIMEOUT: Se alcanzó el límite de {max_time}s")
-                    break
-                
-                print(f"\n[{idx}/{len(pedido['pumps'])}] Procesando ingrediente:")
-                
-                pin = pump_data['gpio_pin']
-                ml = pump_data['ml']
-                ingredient = pump_data['ingredient']
-                
-                verter(pin, ml, ingredient)
-                
-                # Pausa entre ingredientes (excepto después del último)
-                if idx < len(pedido['pumps']):
-                    print(f"  ⏸️  Pausa de {cleanup_delay}s antes del siguiente ingrediente\n")
-                    time.sleep(cleanup_delay)
+            if parallel_pour:
+                log.info(f"⚡ Vertido en paralelo (máx. {max_bombas} bombas a la vez)",
+                         pedido=pedido['timestamp'], max_bombas=max_bombas)
+                verter_paralelo(pedido['pumps'], max_bombas)
+            else:
+                # Procesar cada bomba en secuencia
+                for idx, pump_data in enumerate(pedido['pumps'], 1):
+                    # Verificar timeout
+                    elapsed = (ahora_ns() - start_time) / 1e9
+                    if elapsed > max_time:
+                        log.aviso(f"⚠️  TIMEOUT: Se alcanzó el límite de {max_time}s",
+                                  pedido=pedido['timestamp'], max_s=max_time)
+                        break
+                    
+                    log.info(f"[{idx}/{len(pedido['pumps'])}] Procesando ingrediente:",
+                             pedido=pedido['timestamp'], paso=idx, pasos=len(pedido['pumps']))
+                    
+                    verter(pump_data.gpio_pin, pump_data.ml, pump_data.ingredient)
+                    
+                    # Pausa entre ingredientes (excepto después del último)
+                    if idx < len(pedido['pumps']):
+                        log.info(f"  ⏸️  Pausa de {cleanup_delay}s antes del siguiente ingrediente",
+                                 pedido=pedido['timestamp'], pausa_s=cleanup_delay)
+                        esperar_hasta(ahora_ns() + int(cleanup_delay * 1e9))
             
-            total_time = time.time() - start_time
-            print(f"\n{'='*60}")
-            print(f"✅ COMPLETADO: {pedido['recipe_name']}")
-            print(f"   Tiempo total: {total_time:.1f}s")
-            print(f"   Pedidos restantes: {pedidos_queue.qsize()}")
-            print(f"{'='*60}\n")
+            total_time = (ahora_ns() - start_time) / 1e9
+            log.info(f"✅ COMPLETADO: {pedido['recipe_name']} en {total_time:.1f}s "
+                     f"({pedidos_queue.qsize()} en cola)",
+                     pedido=pedido['timestamp'], receta=pedido['recipe_name'],
+                     total_s=round(total_time, 3), en_cola=pedidos_queue.qsize())
             
         except Exception as e:
-            print(f"❌ Error procesando pedido: {e}")
-            import traceback
-            traceback.print_exc()
+            log.error(f"❌ Error procesando pedido: {e}", pedido=pedido.get('timestamp'),
+                      traza=traceback.format_exc())
         
         finally:
+            estimador_cola.terminar()
             with preparando_lock:
                 preparando = False
             pedidos_queue.task_done()
@@ -192,6 +1368,7 @@ def hacer_trago():
     """
     Endpoint principal para recibir pedidos de cócteles
     Payload esperado: {"recipe_id": "mojito"}
+    Opcional: "prioridad" ("normal" | "vip") y "cliente" (id del kiosco)
     """
     global preparando
     
@@ -211,13 +1388,27 @@ def hacer_trago():
                 'mensaje': 'Falta el campo recipe_id'
             }), 400
         
-        print(f"\n📥 Pedido recibido: {recipe_id}")
+        prioridad = datos.get('prioridad', PRIORIDAD_NORMAL)
+        if prioridad not in (PRIORIDAD_NORMAL, PRIORIDAD_VIP):
+            return jsonify({
+                'status': 'error',
+                'mensaje': "prioridad debe ser 'normal' o 'vip'"
+            }), 400
+        
+        cliente = datos.get('cliente') or request.remote_addr
+        if not isinstance(cliente, str):
+            return jsonify({
+                'status': 'error',
+                'mensaje': 'cliente debe ser un texto'
+            }), 400
+        
+        log.info(f"📥 Pedido recibido: {recipe_id}", recipe_id=recipe_id)
         
         # Validar y preparar la receta completa
         is_valid, result = validate_and_prepare_recipe(recipe_id)
         
         if not is_valid:
-            print(f"❌ Validación fallida: {result}")
+            log.aviso(f"❌ Validación fallida: {result}", recipe_id=recipe_id)
             return jsonify({
                 'status': 'error',
                 'mensaje': result
@@ -226,21 +1417,25 @@ def hacer_trago():
         # result ahora contiene toda la info de las bombas a activar
         pedido_completo = result
         
-        # Agregar a la cola
-        posicion = pedidos_queue.qsize() + 1
+        # Tiempo estimado (precalculado al compilar la receta)
+        tiempo_estimado = pedido_completo['tiempo_estimado']
+        
+        # Agregar a la cola (el planificador decide el orden)
+        pedido_completo['prioridad'] = prioridad
+        pedido_completo['cliente'] = cliente
         pedidos_queue.put(pedido_completo)
+        posicion = pedidos_queue.posicion(pedido_completo) or 1
+        listo_en = estimador_cola.listo_en(pedido_completo)
         
         with preparando_lock:
             estado_actual = "preparando" if preparando else "en cola"
         
-        # Calcular tiempo estimado
-        tiempo_estimado = sum(p['ml'] * SEGUNDOS_POR_ML for p in pedido_completo['pumps'])
-        tiempo_estimado += len(pedido_completo['pumps']) * 2  # Agregar pausas
-        
-        print(f"✓ Pedido '{pedido_completo['recipe_name']}' agregado a la cola")
-        print(f"  Posición: {posicion}")
-        print(f"  Bombas a activar: {len(pedido_completo['pumps'])}")
-        print(f"  Tiempo estimado: {tiempo_estimado:.1f}s")
+        log.info(f"✓ Pedido '{pedido_completo['recipe_name']}' agregado a la cola "
+                 f"(posición {posicion}, {len(pedido_completo['pumps'])} bombas, "
+                 f"{tiempo_estimado:.1f}s, listo en {listo_en:.1f}s)",
+                 pedido=pedido_completo['timestamp'], receta=pedido_completo['recipe_name'],
+                 posicion=posicion, tiempo_estimado_s=round(tiempo_estimado, 1),
+                 listo_en_s=round(listo_en, 1))
         
         return jsonify({
             'status': 'success',
@@ -249,13 +1444,12 @@ def hacer_trago():
             'ingredientes': len(pedido_completo['pumps']),
             'posicion_cola': posicion,
             'estado': estado_actual,
-            'tiempo_estimado_segundos': round(tiempo_estimado, 1)
+            'tiempo_estimado_segundos': round(tiempo_estimado, 1),
+            'listo_en_segundos': round(listo_en, 1)
         }), 200
         
     except Exception as e:
-        print(f"❌ Error en endpoint: {e}")
-        import traceback
-        traceback.print_exc()
+        log.error(f"❌ Error en endpoint: {e}", traza=traceback.format_exc())
         return jsonify({
             'status': 'error',
             'mensaje': str(e)
@@ -264,14 +1458,15 @@ def hacer_trago():
 @app.route('/test_gpio', methods=['POST'])
 def test_gpio():
     """
-    Endpoint para probar bombas individuales directamente por GPIO
+    Encola una prueba de una bomba por su GPIO y responde enseguida (202)
     Payload: {
         "gpio_pin": 25,
         "duration_seconds": 5  (opcional, default 3)
     }
+    El resultado se consulta en GET /test_gpio/<prueba_id>
     """
     try:
-        datos = request.json
+        datos = request.get_json(silent=True)
         
         if not datos or 'gpio_pin' not in datos:
             return jsonify({
@@ -280,7 +1475,12 @@ def test_gpio():
             }), 400
         
         gpio_pin = datos.get('gpio_pin')
-        duration = datos.get('duration_seconds', 3)  # Default 3 segundos
+        duration = leer_duracion_prueba(datos)
+        if duration is None:
+            return jsonify({
+                'status': 'error',
+                'mensaje': f'duration_seconds debe estar entre 0 y {MAX_DURACION_PRUEBA_S}'
+            }), 400
         
         # Validar que el pin existe en la configuración
         config = load_config()
@@ -307,35 +1507,21 @@ def test_gpio():
                 'mensaje': f'GPIO {gpio_pin} no está configurado en ninguna bomba'
             }), 400
         
-        print(f"\n{'='*60}")
-        print(f"🧪 PRUEBA DE GPIO")
-        print(f"   Pin: {gpio_pin}")
-        print(f"   Bomba: {pump_info['name']}")
-        print(f"   Ingrediente: {pump_info['value']}")
-        print(f"   Duración: {duration}s")
-        print(f"{'='*60}\n")
-        
-        # Activar bomba directamente
-        print(f"🚰 Activando {pump_info['name']}...")
-        GPIO.output(gpio_pin, GPIO.LOW)   # Encender
-        time.sleep(duration)
-        GPIO.output(gpio_pin, GPIO.HIGH)  # Apagar
-        print(f"✅ Prueba completada\n")
+        prueba = encolar_prueba([(pump_id, pump_info)], duration, request.remote_addr)
+        log.info(f"🧪 Prueba #{prueba['prueba_id']} encolada: {pump_info['name']} (GPIO {gpio_pin}, {duration}s)",
+                 prueba_id=prueba['prueba_id'], pin=gpio_pin, duracion_s=duration)
         
-        return jsonify({
-            'status': 'success',
-            'mensaje': 'Prueba de GPIO completada',
-            'gpio_pin': gpio_pin,
-            'pump_id': pump_id,
-            'pump_name': pump_info['name'],
-            'ingredient': pump_info['value'],
-            'duration_seconds': duration
-        }), 200
+        return respuesta_prueba(
+            prueba, 'Prueba de GPIO encolada',
+            gpio_pin=gpio_pin,
+            pump_id=pump_id,
+            pump_name=pump_info['name'],
+            ingredient=pump_info['value'],
+            duration_seconds=duration
+        )
         
     except Exception as e:
-        print(f"❌ Error en test_gpio: {e}")
-        import traceback
-        traceback.print_exc()
+        log.error(f"❌ Error en test_gpio: {e}", traza=traceback.format_exc())
         return jsonify({
             'status': 'error',
             'mensaje': str(e)
@@ -344,14 +1530,20 @@ def test_gpio():
 @app.route('/test_all_gpios', methods=['POST'])
 def test_all_gpios():
     """
-    Endpoint para probar TODAS las bombas secuencialmente
+    Encola una prueba de TODAS las bombas (una tras otra) y responde enseguida (202)
     Payload: {
         "duration_seconds": 3  (opcional, default 3)
     }
+    El resultado se consulta en GET /test_gpio/<prueba_id>
     """
     try:
-        datos = request.json if request.json else {}
-        duration = datos.get('duration_seconds', 3)
+        datos = request.get_json(silent=True) or {}
+        duration = leer_duracion_prueba(datos)
+        if duration is None:
+            return jsonify({
+                'status': 'error',
+                'mensaje': f'duration_seconds debe estar entre 0 y {MAX_DURACION_PRUEBA_S}'
+            }), 400
         
         config = load_config()
         if not config:
@@ -361,68 +1553,40 @@ def test_all_gpios():
             }), 500
         
         pumps = config.get('pumps', {})
+        if not pumps:
+            return jsonify({
+                'status': 'error',
+                'mensaje': 'No hay bombas configuradas'
+            }), 400
         
-        print(f"\n{'='*60}")
-        print(f"🧪 PRUEBA DE TODAS LAS BOMBAS")
-        print(f"   Duración por bomba: {duration}s")
-        print(f"   Total de bombas: {len(pumps)}")
-        print(f"{'='*60}\n")
+        prueba = encolar_prueba(list(pumps.items()), duration, request.remote_addr)
+        log.info(f"🧪 Prueba #{prueba['prueba_id']} encolada: {len(pumps)} bombas, {duration}s cada una",
+                 prueba_id=prueba['prueba_id'], bombas=len(pumps), duracion_s=duration)
         
-        results = []
-        
-        for idx, (pump_id, pump_info) in enumerate(pumps.items(), 1):
-            pin = pump_info['pin']
-            name = pump_info['name']
-            
-            print(f"[{idx}/{len(pumps)}] 🚰 Probando {name} (GPIO {pin})...")
-            
-            try:
-                GPIO.output(pin, GPIO.LOW)
-                time.sleep(duration)
-                GPIO.output(pin, GPIO.HIGH)
-                
-                results.append({
-                    'pump_id': pump_id,
-                    'gpio_pin': pin,
-                    'name': name,
-                    'status': 'ok'
-                })
-                print(f"            ✅ Completado\n")
-                
-                # Pausa entre bombas (excepto la última)
-                if idx < len(pumps):
-                    time.sleep(1)
-                
-            except Exception as e:
-                results.append({
-                    'pump_id': pump_id,
-                    'gpio_pin': pin,
-                    'name': name,
-                    'status': 'error',
-                    'error': str(e)
-                })
-                print(f"            ❌ Error: {e}\n")
-        
-        print(f"{'='*60}")
-        print("✅ PRUEBA COMPLETADA")
-        print(f"{'='*60}\n")
-        
-        return jsonify({
-            'status': 'success',
-            'mensaje': 'Prueba de todas las bombas completada',
-            'duration_per_pump': duration,
-            'results': results
-        }), 200
+        return respuesta_prueba(
+            prueba, 'Prueba de todas las bombas encolada',
+            duration_per_pump=duration,
+            bombas=len(pumps)
+        )
         
     except Exception as e:
-        print(f"❌ Error en test_all_gpios: {e}")
-        import traceback
-        traceback.print_exc()
+        log.error(f"❌ Error en test_all_gpios: {e}", traza=traceback.format_exc())
         return jsonify({
             'status': 'error',
             'mensaje': str(e)
         }), 500
 
+@app.route('/test_gpio/<int:prueba_id>', methods=['GET'])
+def resultado_prueba(prueba_id):
+    """Estado de una prueba encolada: en_cola, en_curso o completada (con el resultado por bomba)"""
+    datos = registro_pruebas.consultar(prueba_id)
+    if datos is None:
+        return jsonify({
+            'status': 'error',
+            'mensaje': f'Prueba {prueba_id} no existe'
+        }), 404
+    return jsonify(datos), 200
+
 @app.route('/estado', methods=['GET'])
 def get_estado():
     """Endpoint para consultar el estado del sistema"""
@@ -436,9 +1600,16 @@ def get_estado():
         'estado': estado,
         'pedidos_en_cola': pedidos_queue.qsize(),
         'bombas_configuradas': len(pumps),
-        'calibracion_sg_por_ml': SEGUNDOS_POR_ML
+        'espera_estimada_segundos': round(estimador_cola.pendiente(), 1),
+        'calibracion_sg_por_ml': SEGUNDOS_POR_ML,
+        'vigilante': {'disparos': vigilante.disparos, 'ultimo_disparo': vigilante.ultimo_disparo}
     }), 200
 
+@app.route('/precision', methods=['GET'])
+def get_precision():
+    """Estadísticas de error/jitter entre tiempo pedido y tiempo real de bombas"""
+    return jsonify(estadisticas_pulsos.resumen()), 200
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -450,6 +1621,9 @@ def health_check():
 @app.route('/calibracion', methods=['GET'])
 def get_calibracion():
     """Endpoint para consultar la calibración actual"""
+    config = load_config()
+    pumps = config.get('pumps', {}) if config else {}
+    
     return jsonify({
         'segundos_por_ml': SEGUNDOS_POR_ML,
         'ejemplos': {
@@ -457,9 +1631,73 @@ def get_calibracion():
             '30ml': f"{30 * SEGUNDOS_POR_ML}s",
             '50ml': f"{50 * SEGUNDOS_POR_ML}s",
             '100ml': f"{100 * SEGUNDOS_POR_ML}s"
+        },
+        'bombas': {
+            pump_id: {
+                'name': pump_info['name'],
+                'gpio_pin': pump_info['pin'],
+                'segundos_por_ml': CALIBRACION_POR_PIN.get(pump_info['pin'], SEGUNDOS_POR_ML),
+                'arranque_s': round(ARRANQUE_POR_PIN.get(pump_info['pin'], 0.0), 3),
+                'ajustado_por_mediciones': pump_info['pin'] in calibracion_auto.modelos,
+                'mediciones': calibracion_auto.cantidad(pump_info['pin'])
+            }
+            for pump_id, pump_info in pumps.items()
         }
     }), 200
 
+@app.route('/calibracion/medicion', methods=['POST'])
+def registrar_medicion():
+    """
+    Registra lo que realmente cayó en el vaso y reajusta el caudal de la bomba
+    Payload: {"pump_id": "pump_1", "ml": 58}  (último vertido de esa bomba)
+    Opcional: "segundos" encendida, o "gramos" de una balanza en lugar de
+    "ml" (usa density_g_ml de la bomba en pi.json, 1.0 por defecto)
+    """
+    datos = request.get_json(silent=True) or {}
+    config = load_config()
+    if not config:
+        return jsonify({'status': 'error', 'mensaje': 'Error cargando configuración'}), 500
+    
+    pump_info = config.get('pumps', {}).get(datos.get('pump_id'))
+    if not pump_info:
+        return jsonify({
+            'status': 'error',
+            'mensaje': f"Bomba '{datos.get('pump_id')}' no existe"
+        }), 400
+    
+    pin = pump_info['pin']
+    segundos = datos.get('segundos', estadisticas_pulsos.ultimo.get(pin))
+    if segundos is None:
+        return jsonify({'status': 'error', 'mensaje': 'Esa bomba todavía no vertió nada'}), 400
+    
+    try:
+        segundos = float(segundos)
+        if 'ml' in datos:
+            ml = float(datos['ml'])
+        else:
+            ml = float(datos['gramos']) / pump_info.get('density_g_ml', 1.0)
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'status': 'error', 'mensaje': "Se requiere 'ml' o 'gramos' numérico"}), 400
+    if not (math.isfinite(segundos) and segundos > 0 and math.isfinite(ml) and ml > 0):
+        return jsonify({'status': 'error', 'mensaje': 'segundos y ml deben ser números positivos'}), 400
+    
+    resultado = calibracion_auto.medir(pin, segundos, ml)
+    if not resultado:
+        return jsonify({'status': 'error', 'mensaje': 'Medición inconsistente, no se usó'}), 400
+    caudal, arranque, error_ml = resultado
+    
+    log.info(f"📏 {pump_info['name']}: {ml:.1f}ml en {segundos:.2f}s -> {caudal:.2f} ml/s, arranque {arranque:.2f}s",
+             pin=pin, ml=ml, segundos=segundos, caudal_ml_s=round(caudal, 3), arranque_s=round(arranque, 3))
+    return jsonify({
+        'status': 'success',
+        'gpio_pin': pin,
+        'caudal_ml_s': round(caudal, 3),
+        'arranque_s': round(arranque, 3),
+        'segundos_por_ml': round(1.0 / caudal, 4),
+        'error_anterior_ml': round(error_ml, 1),
+        'mediciones': calibracion_auto.cantidad(pin)
+    }), 200
+
 # ============================================
 # INICIALIZACIÓN
 # ============================================
@@ -470,6 +1708,7 @@ if __name__ == '__main__':
     
     print(f"⚙️  CALIBRACIÓN: {SEGUNDOS_POR_ML}s por ml")
     print(f"   Ejemplos: 10ml={10*SEGUNDOS_POR_ML}s | 30ml={30*SEGUNDOS_POR_ML}s | 50ml={50*SEGUNDOS_POR_ML}s\n")
+    print(f"🔌 Backend de bombas: {bombas.nombre}\n")
     
     # Configurar GPIO
     if not setup_gpio():
@@ -479,7 +1718,8 @@ if __name__ == '__main__':
     # Iniciar worker thread para procesar pedidos
     worker_thread = threading.Thread(target=procesar_pedidos, daemon=True)
     worker_thread.start()
-    print("✓ Worker thread iniciado\n")
+    vigilante.iniciar()
+    print("✓ Worker thread y vigilante de bombas iniciados\n")
     
     print("🌐 Servidor Flask iniciando en 0.0.0.0:5000")
     print("="*60 + "\n")
@@ -488,5 +1728,5 @@ if __name__ == '__main__':
         app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
     except KeyboardInterrupt:
         print("\n\n🛑 Deteniendo servidor...")
-        GPIO.cleanup()
+        bombas.limpiar()
         print("✓ GPIO limpiado. Adiós!\n")
\ No newline at end of file
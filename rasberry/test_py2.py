@@ -0,0 +1,127 @@
+"""
+Tests de py2.py. Corren sobre el driver simulado, sin GPIO:
+
+    python -m pytest -q rasberry/test_py2.py
+"""
+import os
+import json
+import random
+
+os.environ.setdefault('PI_GPIO_BACKEND', 'sim')
+os.environ.setdefault('PI_CALIBRACION', '')  # No usar la calibración medida
+os.environ.setdefault('PI_LOG', '')
+import pytest
+
+import py2
+
+# ============================================
+# FIXTURES
+# ============================================
+CONFIG = {
+    "pumps": {
+        "pump_1": {"pin": 17, "name": "Bomba 1", "value": "ron", "flow_rate": 4.0},
+        "pump_2": {"pin": 27, "name": "Bomba 2", "value": "cola", "flow_rate": 4.0},
+    },
+    "recipes": {
+        "cuba": {"name": "Cuba", "ingredients": {"ron": 40, "cola": 60}},
+    },
+    "config": {"cleanup_delay": 0},
+}
+
+@pytest.fixture
+def entorno(tmp_path, monkeypatch):
+    """pi.json de prueba, cola y calibración nuevas"""
+    ruta = tmp_path / 'pi.json'
+    ruta.write_text(json.dumps(CONFIG), encoding='utf-8')
+    monkeypatch.setattr(py2, 'config_store', py2.ConfigStore(str(ruta)))
+    monkeypatch.setattr(py2, 'pedidos_queue', py2.PlanificadorPedidos())
+    monkeypatch.setattr(py2, 'recipe_index', py2.RecipeIndex())
+    monkeypatch.setattr(py2, 'calibracion_auto', py2.CalibracionAutomatica(''))
+    return tmp_path
+
+# ============================================
+# CALIBRACIÓN
+# ============================================
+def test_ajustar_caudal_descarta_no_finitos():
+    assert py2.ajustar_caudal([(10.0, float('nan'))]) is None
+    assert py2.ajustar_caudal([(10.0, 40.0)]) == pytest.approx((4.0, 0.0))
+
+@pytest.mark.parametrize('medicion', [{"ml": "nan"}, {"ml": "inf"}, {"ml": -5}, {"ml": 40, "segundos": "nan"}])
+def test_medicion_rechaza_valores_no_finitos(entorno, monkeypatch, medicion):
+    monkeypatch.setitem(py2.CALIBRACION_POR_PIN, 17, 0.25)
+    respuesta = py2.app.test_client().post('/calibracion/medicion',
+                                          json={"pump_id": "pump_1", "segundos": 10, **medicion})
+    assert respuesta.status_code == 400
+    assert py2.CALIBRACION_POR_PIN[17] == 0.25
+    assert py2.calibracion_auto.cantidad(17) == 0
+
+# ============================================
+# VIGILANTE
+# ============================================
+def test_vigilante_apaga_todas_las_bombas(entorno, monkeypatch):
+    monkeypatch.setattr(py2, 'vigilante', py2.Vigilante())
+    py2.bombas.encender(17)
+    py2.bombas.encender(27)
+    py2.vigilante.encendida(17, py2.ahora_ns() - int(3600 * 1e9))
+    py2.vigilante._revisar()
+    assert py2.bombas.encendidas[17] is False
+    assert py2.bombas.encendidas[27] is False
+    assert py2.vigilante.disparos == 1
+
+def test_paso_mas_largo_que_max_on_s_no_se_enciende(entorno, monkeypatch):
+    config = json.loads(json.dumps(CONFIG))
+    config['pumps']['pump_2']['max_on_s'] = 5
+    (entorno / 'pi.json').write_text(json.dumps(config), encoding='utf-8')
+    py2.config_store.invalidar()
+    monkeypatch.setattr(py2, 'vigilante', py2.Vigilante())
+    monkeypatch.setitem(py2.CALIBRACION_POR_PIN, 27, 0.25)
+
+    ok, error = py2.validate_and_prepare_recipe('cuba')
+    assert not ok and 'máximo' in error
+    with pytest.raises(ValueError):
+        py2.encender_por(27, 6)
+    assert py2.bombas.encendidas.get(27) is not True
+
+# ============================================
+# RECETAS
+# ============================================
+def test_ingrediente_sin_bomba_solo_anula_su_receta(entorno):
+    config = json.loads(json.dumps(CONFIG))
+    config['recipes']['fernet'] = {"name": "Fernet", "ingredients": {"fernet": 50, "cola": 150}}
+    recetas, errores = py2.compilar_recetas(config)
+    assert list(recetas) == ['cuba']
+    # El mismo motivo que da pi.py al leer este pi.json
+    assert errores == {'fernet': "Ingrediente 'fernet' no disponible en ninguna bomba"}
+
+# ============================================
+# PEDIDOS
+# ============================================
+@pytest.mark.parametrize('cliente', [["mesa"], {"mesa": 1}, 7])
+def test_hacer_trago_rechaza_cliente_que_no_es_texto(entorno, cliente):
+    respuesta = py2.app.test_client().post('/hacer_trago', json={"recipe_id": "cuba", "cliente": cliente})
+    assert respuesta.status_code == 400
+    assert py2.pedidos_queue.qsize() == 0
+
+def test_hacer_trago_encola_con_cliente(entorno):
+    respuesta = py2.app.test_client().post('/hacer_trago', json={"recipe_id": "cuba", "cliente": "mesa"})
+    assert respuesta.status_code == 200
+    assert py2.pedidos_queue._pedidos[0]['cliente'] == "mesa"
+
+# ============================================
+# PLANIFICADOR
+# ============================================
+def test_trabajo_antes_sigue_a_la_cola(entorno):
+    """El acumulado incremental coincide con sumar la cola en cada paso"""
+    cola = py2.pedidos_queue
+    azar = random.Random(7)
+    for _ in range(400):
+        if azar.random() < 0.6 or not cola.qsize():
+            cola.put({'tiempo_estimado': azar.uniform(1, 60), 'cliente': azar.choice('abc'),
+                      'prioridad': azar.choice([py2.PRIORIDAD_NORMAL, py2.PRIORIDAD_VIP])})
+        else:
+            cola.get()
+
+        duraciones = [pedido['tiempo_estimado'] for pedido in cola._pedidos]
+        for i, pedido in enumerate(cola._pedidos):
+            assert cola.trabajo_antes(pedido) == pytest.approx(sum(duraciones[:i]))
+        assert cola.trabajo_total() == pytest.approx(sum(duraciones))
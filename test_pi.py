@@ -0,0 +1,472 @@
+"""
+Tests de pi.py: orden y ETA del planificador, admisión todo-o-nada y
+recuperación del diario. Corren sobre el driver simulado, sin GPIO:
+
+    python -m pytest -q test_pi.py
+"""
+import os
+import json
+import random
+
+os.environ.setdefault('PI_GPIO_BACKEND', 'sim')
+os.environ.setdefault('PI_INVENTARIO', '')  # No pisar el inventario real
+os.environ.setdefault('PI_CALIBRACION', '')  # ...ni usar la calibración medida
+os.environ.setdefault('PI_DIARIO', '')
+os.environ.setdefault('PI_LOG', '')
+import pytest
+
+import pi
+
+# ============================================
+# FIXTURES
+# ============================================
+CONFIG = {
+    "config": {
+        "pump_1": {"label": "Ron", "pin": 17, "flow_rate": 4.0, "capacidad_ml": 1000},
+        "pump_2": {"label": "Cola", "pin": 27, "flow_rate": 4.0, "capacidad_ml": 100},
+    },
+    "menu": [
+        {"id": 1, "name": "Cuba", "ingredients": [{"pump": "pump_1", "ml": 40}, {"pump": "pump_2", "ml": 60}]},
+    ],
+    "preparacion": {"modo": "serie"},
+    "planificacion": {"ventaja_vip_s": 120, "retraso_mantenimiento_s": 300},
+}
+
+class DiarioMemoria:
+    """Diario que guarda los registros en una lista"""
+    activo = True
+
+    def __init__(self):
+        self.registros = []
+
+    def registrar(self, tipo, pedido_id, **datos):
+        self.registros.append((tipo, pedido_id, datos))
+
+@pytest.fixture
+def entorno(tmp_path, monkeypatch):
+    """pi.json de prueba y cola, tabla, inventario y diario nuevos"""
+    ruta = tmp_path / 'pi.json'
+    ruta.write_text(json.dumps(CONFIG), encoding='utf-8')
+    monkeypatch.setattr(pi, 'config_store', pi.ConfigStore(str(ruta)))
+    monkeypatch.setattr(pi, 'pedidos_queue', pi.PlanificadorPedidos())
+    monkeypatch.setattr(pi, 'pedidos', pi.TablaPedidos())
+    monkeypatch.setattr(pi, 'motor_eta', pi.MotorETA())
+    monkeypatch.setattr(pi, 'diario', DiarioMemoria())
+    monkeypatch.setattr(pi, 'pedidos_interrumpidos', [])
+    inventario = pi.Inventario('')
+    inventario.configurar(pi.load_modelo())
+    monkeypatch.setattr(pi, 'inventario', inventario)
+    return tmp_path
+
+def pedido(duracion=10.0, cliente='kiosco', prioridad=pi.PRIORIDAD_NORMAL, pin=17, ml=0):
+    pasos = (pi.Paso('Ron', pin, ml, duracion, 0.25),)
+    return pi.nuevo_job('Trago', pasos, duracion, cliente=cliente, prioridad=prioridad)
+
+def orden_cola():
+    return [job['pedido_id'] for job in pi.pedidos_queue._pedidos]
+
+# ============================================
+# PLANIFICADOR
+# ============================================
+def test_mismo_cliente_respeta_orden_de_llegada(entorno):
+    jobs = [pedido() for _ in range(4)]
+    for job in jobs:
+        pi.pedidos_queue.put(job)
+    assert [pi.pedidos_queue.get() for _ in jobs] == jobs
+
+def test_vip_se_adelanta(entorno):
+    normal = pedido()
+    vip = pedido(prioridad=pi.PRIORIDAD_VIP)
+    pi.pedidos_queue.put(normal)
+    pi.pedidos_queue.put(vip)
+    assert pi.pedidos_queue.get() is vip
+
+def test_mantenimiento_espera_a_los_clientes(entorno):
+    prueba = pedido(prioridad=pi.PRIORIDAD_MANTENIMIENTO)
+    normal = pedido()
+    pi.pedidos_queue.put(prueba)
+    pi.pedidos_queue.put(normal)
+    assert pi.pedidos_queue.get() is normal
+
+def test_reparto_equitativo_entre_clientes(entorno):
+    mesa = [pedido(duracion=60, cliente='mesa') for _ in range(3)]
+    barra = pedido(duracion=60, cliente='barra')
+    for job in mesa + [barra]:
+        pi.pedidos_queue.put(job)
+    assert orden_cola()[:2] == [mesa[0]['pedido_id'], barra['pedido_id']]
+
+def test_trabajo_antes_sigue_a_la_cola(entorno):
+    """El acumulado incremental coincide con sumar la cola en cada paso"""
+    cola = pi.pedidos_queue
+    azar = random.Random(7)
+    vivos = []
+    for _ in range(400):
+        accion = azar.random()
+        if accion < 0.5 or not vivos:
+            job = pedido(duracion=azar.uniform(1, 60), cliente=azar.choice('abc'),
+                         prioridad=azar.choice([pi.PRIORIDAD_NORMAL, pi.PRIORIDAD_VIP]))
+            cola.put(job)
+            vivos.append(job)
+        elif accion < 0.7:
+            vivos.remove(cola.get())
+        elif accion < 0.85:
+            job = azar.choice(vivos)
+            assert cola.quitar(job)
+            vivos.remove(job)
+        else:
+            job = cola.tomar_compatible(set(), 3, 5)
+            if job:
+                vivos.remove(job)
+
+        duraciones = [job['tiempo_estimado'] for job in cola._pedidos]
+        for i, job in enumerate(cola._pedidos):
+            assert cola.trabajo_antes(job) == pytest.approx(sum(duraciones[:i]))
+        assert cola.trabajo_total() == pytest.approx(sum(duraciones))
+
+def test_eta_en_cola(entorno):
+    jobs = [pedido(duracion=d) for d in (10, 20, 30)]
+    for job in jobs:
+        job['estado'] = pi.ESTADO_EN_COLA
+        pi.pedidos_queue.put(job)
+    assert pi.motor_eta.eta(jobs[2]) == pytest.approx(60)
+    pi.pedidos_queue.get()
+    assert pi.motor_eta.eta(jobs[2]) == pytest.approx(50)
+    assert pi.motor_eta.trabajo_pendiente() == pytest.approx(50)
+
+def test_eta_en_cola_con_varios_vasos(entorno, monkeypatch):
+    """Tres vasos a la vez: los pedidos sin bombas en común terminan juntos"""
+    config = json.loads(json.dumps(CONFIG))
+    config['preparacion']['vasos_simultaneos'] = 3
+    (entorno / 'pi.json').write_text(json.dumps(config), encoding='utf-8')
+    monkeypatch.setattr(pi, 'config_store', pi.ConfigStore(str(entorno / 'pi.json')))
+
+    jobs = [pedido(pin=pin) for pin in (17, 27, 22, 17)]
+    for job in jobs:
+        job['estado'] = pi.ESTADO_EN_COLA
+        pi.pedidos_queue.put(job)
+    assert [pi.motor_eta.eta(job) for job in jobs] == pytest.approx([10, 10, 10, 20], abs=0.01)
+    assert pi.motor_eta.trabajo_pendiente() == pytest.approx(20, abs=0.01)
+
+    # Con un vaso por vez vuelve a ser la suma de la cola
+    config['preparacion']['vasos_simultaneos'] = 1
+    (entorno / 'pi.json').write_text(json.dumps(config), encoding='utf-8')
+    monkeypatch.setattr(pi, 'config_store', pi.ConfigStore(str(entorno / 'pi.json')))
+    assert [pi.motor_eta.eta(job) for job in jobs] == pytest.approx([10, 20, 30, 40], abs=0.01)
+
+def test_eta_con_varios_vasos_reparte_las_bombas(entorno, monkeypatch):
+    """En paralelo con 3 bombas para la estación, el segundo vaso arranca con la que sobra"""
+    config = json.loads(json.dumps(CONFIG))
+    config['preparacion'].update(modo='paralelo', vasos_simultaneos=2, max_bombas_simultaneas=3)
+    (entorno / 'pi.json').write_text(json.dumps(config), encoding='utf-8')
+    monkeypatch.setattr(pi, 'config_store', pi.ConfigStore(str(entorno / 'pi.json')))
+
+    jobs = []
+    for pines in ((17, 27), (22, 23)):
+        pasos = tuple(pi.Paso('Trago', pin, 0, 10.0, 0.25) for pin in pines)
+        jobs.append(pi.nuevo_job('Trago', pasos, 10.0, estado=pi.ESTADO_EN_COLA))
+        pi.pedidos_queue.put(jobs[-1])
+    assert [pi.motor_eta.eta(job) for job in jobs] == pytest.approx([10, 15], abs=0.01)
+
+def test_tomar_compatible_no_pasa_mas_de_max_adelantos(entorno):
+    ocupado = pedido(pin=17)
+    libre = pedido(pin=27)
+    pi.pedidos_queue.put(ocupado)
+    pi.pedidos_queue.put(libre)
+    ocupado['adelantos'] = 1
+    assert pi.pedidos_queue.tomar_compatible({17}, 8, max_adelantos=1) is None
+    ocupado['adelantos'] = 0
+    assert pi.pedidos_queue.tomar_compatible({17}, 8, max_adelantos=1) is libre
+    assert ocupado['adelantos'] == 1
+
+# ============================================
+# ADMISIÓN
+# ============================================
+def test_admitir_lote_reserva_y_anota(entorno):
+    jobs = [pedido(ml=40), pedido(ml=40)]
+    assert pi.pedidos.admitir_lote(jobs, pi.pedidos_queue) is None
+    assert pi.pedidos.activos() == 2
+    assert pi.inventario.estado(17)[2] == 80
+    assert [r[:2] for r in pi.diario.registros] == [(pi.REG_ADMITIDO, job['pedido_id']) for job in jobs]
+
+def test_admitir_lote_sin_stock_no_reserva_nada(entorno):
+    jobs = [pedido(pin=27, ml=60), pedido(pin=27, ml=60)]
+    motivo, _ = pi.pedidos.admitir_lote(jobs, pi.pedidos_queue)
+    assert motivo == pi.RECHAZO_SIN_STOCK
+    assert pi.inventario.reservado.get(27, 0) == 0
+    assert pi.pedidos_queue.qsize() == 0
+
+def test_admitir_lote_deshace_todo_si_falla_la_cola(entorno):
+    bueno = pedido(ml=40, cliente='mesa')
+    roto = pedido(ml=40, cliente=['no', 'hasheable'])
+    with pytest.raises(TypeError):
+        pi.pedidos.admitir_lote([bueno, roto], pi.pedidos_queue)
+
+    assert pi.pedidos_queue.qsize() == 0
+    assert pi.pedidos_queue.trabajo_total() == 0
+    assert pi.pedidos_queue._fin_cliente == {}
+    assert pi.pedidos.activos() == 0
+    assert pi.pedidos.get(bueno['pedido_id']) is None
+    assert pi.inventario.estado(17)[2] == 0
+    assert pi.diario.registros == []
+
+# ============================================
+# DIARIO
+# ============================================
+def escribir_diario(directorio, registros):
+    ruta = directorio / 'pedidos.journal'
+    with open(ruta, 'w', encoding='utf-8') as f:
+        for registro in registros:
+            f.write(json.dumps(registro) + "\n")
+    return ruta
+
+def admision(pedido_id, **extra):
+    return {"tipo": pi.REG_ADMITIDO, "id": pedido_id, "receta": f"Trago {pedido_id}",
+            "pasos": [["Ron", 17, 40, 10.0, 0.25, 0]], "tiempo_estimado": 10.0,
+            "timestamp": 1.0, **extra}
+
+@pytest.fixture
+def diario_en(entorno, monkeypatch):
+    def abrir(registros):
+        diario = pi.DiarioPedidos(str(escribir_diario(entorno, registros)))
+        monkeypatch.setattr(pi, 'diario', diario)
+        monkeypatch.setattr(pi, '_contador_pedidos', pi.itertools.count(1))
+        monkeypatch.setattr(pi, '_contador_rondas', pi.itertools.count(1))
+        pi.recuperar_pedidos()
+        return diario
+    return abrir
+
+def test_recuperar_reencola_y_marca_interrumpidos(diario_en):
+    diario = diario_en([
+        admision(1), admision(2), admision(3), admision(4),
+        {"tipo": pi.REG_TERMINADO, "id": 1, "estado": pi.ESTADO_COMPLETADO},
+        {"tipo": pi.REG_PASO_INICIADO, "id": 2, "paso": 0},
+    ])
+    assert orden_cola() == [3, 4]
+    assert pi.pedidos.get(2)['estado'] == pi.ESTADO_INTERRUMPIDO
+    assert [p['pedido_id'] for p in pi.pedidos_interrumpidos] == [2]
+    assert pi.nuevo_pedido_id() == 5
+    assert [r['id'] for r in diario.leer()] == [3, 4]
+
+def test_recuperar_descarta_registros_rotos(diario_en):
+    diario = diario_en([
+        admision(1, cliente=['x']),          # no se puede volver a encolar
+        admision(2),
+        {"tipo": pi.REG_ADMITIDO, "id": 3, "pasos": [[1, 2]]},
+        {"tipo": pi.REG_ADMITIDO, "id": ["z"]},
+        5,
+        admision(6, ronda=2),
+    ])
+    assert orden_cola() == [2, 6]
+    assert pi.pedidos.activos() == 2
+    assert pi.inventario.estado(17)[2] == 80
+    assert [r['id'] for r in diario.leer()] == [2, 6]
+
+# ============================================
+# CALIBRACIÓN
+# ============================================
+def test_ajustar_caudal_descarta_no_finitos():
+    assert pi.ajustar_caudal([(10.0, float('nan'))]) is None
+    assert pi.ajustar_caudal([(float('inf'), 40.0)]) is None
+    assert pi.ajustar_caudal([(10.0, 40.0)]) == pytest.approx((4.0, 0.0))
+
+@pytest.mark.parametrize('medicion', [
+    {"ml": "nan"}, {"ml": "inf"}, {"ml": -5}, {"ml": 0}, {"ml": 40, "segundos": "nan"}, {"gramos": "-inf"},
+])
+def test_medicion_rechaza_valores_no_finitos(entorno, monkeypatch, medicion):
+    monkeypatch.setattr(pi, 'calibracion_auto', pi.CalibracionAutomatica(''))
+    monkeypatch.setitem(pi.CALIBRACION_POR_PIN, 17, 0.25)
+    respuesta = pi.app.test_client().post('/calibracion/medicion',
+                                         json={"pump": "pump_1", "segundos": 10, **medicion})
+    assert respuesta.status_code == 400
+    assert pi.CALIBRACION_POR_PIN[17] == 0.25
+    assert pi.calibracion_auto.cantidad(17) == 0
+
+def test_medicion_con_literal_nan(entorno, monkeypatch):
+    monkeypatch.setattr(pi, 'calibracion_auto', pi.CalibracionAutomatica(''))
+    respuesta = pi.app.test_client().post('/calibracion/medicion', data='{"pump": "pump_1", "segundos": 10, "ml": NaN}',
+                                         content_type='application/json')
+    assert respuesta.status_code == 400
+
+# ============================================
+# VIGILANTE Y PRUEBA MANUAL
+# ============================================
+def test_vigilante_apaga_bomba_pasada_de_su_maximo(entorno, monkeypatch):
+    monkeypatch.setattr(pi, 'estacion', pi.Estacion())
+    monkeypatch.setattr(pi, 'vigilante', pi.Vigilante())
+    pi.bombas.encender(17)
+    pi.vigilante.encendida(17, pi.ahora_ns() - int(3600 * 1e9))
+    pi.vigilante._revisar()
+    assert pi.bombas.encendidas[17] is False
+    assert pi.vigilante.disparos == {pi.DISPARO_MAX_ENCENDIDA: 1}
+    assert not pi.estacion._habilitada.is_set()
+
+@pytest.mark.parametrize('segundos', ["nan", "inf", -1])
+def test_prueba_manual_rechaza_segundos_no_finitos(entorno, segundos):
+    respuesta = pi.app.test_client().post('/prueba_manual', json={"acciones": [{"pin": 17, "segundos": segundos}]})
+    assert respuesta.status_code == 400
+    assert pi.pedidos_queue.qsize() == 0
+
+# ============================================
+# PARADA DE EMERGENCIA
+# ============================================
+def test_reanudar_antes_de_que_despierte_el_worker_igual_interrumpe(entorno, monkeypatch):
+    """/parar y /reanudar mientras el worker duerme: el vaso queda interrumpido"""
+    monkeypatch.setattr(pi, 'estacion', pi.Estacion())
+    cliente = pi.app.test_client()
+    job = pedido(duracion=10, ml=40)
+    pi.pedidos.admitir_lote([job], pi.pedidos_queue)
+    pi.pedidos_queue.get()
+
+    def esperar_con_parada(deadline_ns, interrumpir=None):
+        assert pi.bombas.encendidas[17] is True
+        assert cliente.post('/parar').status_code == 200
+        assert pi.bombas.encendidas[17] is False
+        assert cliente.post('/reanudar').status_code == 200
+    monkeypatch.setattr(pi, 'esperar_hasta', esperar_con_parada)
+
+    pi.estacion.atender(job)
+    assert job['estado'] == pi.ESTADO_INTERRUMPIDO
+    assert [p['pedido_id'] for p in pi.pedidos_interrumpidos] == [job['pedido_id']]
+    assert pi.pedidos_interrumpidos[0]['pasos'][0]['estado'] == "cortado"
+    assert not pi.estacion.detenida
+    assert pi.pedidos_queue.unfinished_tasks == 0
+
+def test_parada_antes_de_empezar_no_enciende_nada(entorno, monkeypatch):
+    monkeypatch.setattr(pi, 'estacion', pi.Estacion())
+    job = pedido(duracion=10)
+    pi.pedidos.admitir_lote([job], pi.pedidos_queue)
+    pi.pedidos_queue.get()
+    pi.bombas.apagar(17)
+    pi.estacion.parar({17})
+
+    pi.estacion.atender(job)
+    assert job['estado'] == pi.ESTADO_INTERRUMPIDO
+    assert pi.bombas.encendidas[17] is False
+
+# ============================================
+# RONDAS
+# ============================================
+@pytest.mark.parametrize('cantidad', [2.7, 1.0, "1", True, None])
+def test_ronda_rechaza_cantidad_no_entera(entorno, cantidad):
+    respuesta = pi.app.test_client().post('/hacer_tragos',
+                                         json={"tragos": [{"recipe_id": 1, "cantidad": cantidad}]})
+    assert respuesta.status_code == 400
+    assert pi.pedidos_queue.qsize() == 0
+
+def test_ronda_usa_una_sola_version_del_menu(entorno, monkeypatch):
+    """Si pi.json cambia a mitad de la ronda, la ronda sigue con lo que leyó primero"""
+    monkeypatch.setattr(pi, 'plan_index', pi.PlanIndex())
+    version, modelo = pi.config_store.vigente()
+    lecturas = [(version, modelo._replace(por_clave={"cuba": 1}))]
+    monkeypatch.setattr(pi.config_store, 'vigente', lambda: lecturas.pop() if lecturas else (version + 1, None))
+    respuesta = pi.app.test_client().post('/hacer_tragos', json={"tragos": [{"recipe_id": "cuba", "cantidad": 1}]})
+    assert respuesta.status_code == 200
+    assert pi.pedidos_queue.qsize() == 1
+
+# ============================================
+# RECARGA DE PI.JSON
+# ============================================
+def recargar(directorio, config):
+    (directorio / 'pi.json').write_text(json.dumps(config), encoding='utf-8')
+    pi.config_store.invalidar()
+    pi.config_store.revisar()
+
+def test_recarga_invalida_sigue_con_la_ultima_buena(entorno):
+    version, modelo = pi.config_store.vigente()
+    roto = json.loads(json.dumps(CONFIG))
+    roto['config']['pump_1']['pin'] = "diecisiete"
+    recargar(entorno, roto)
+    assert pi.config_store.vigente() == (version, modelo)
+    assert pi.config_store.rechazos == 1
+    assert 'pump_1' in pi.config_store.ultimo_error
+
+    (entorno / 'pi.json').write_text('{"config": {', encoding='utf-8')  # A medio escribir
+    pi.config_store.invalidar()
+    assert pi.load_modelo() is modelo
+    assert pi.config_store.rechazos == 2
+
+def test_recarga_espera_a_que_se_vacie_la_estacion(entorno, monkeypatch):
+    monkeypatch.setattr(pi, 'estacion', pi.Estacion())
+    monkeypatch.setattr(pi, 'plan_index', pi.PlanIndex())
+    ron, cola = pedido(ml=40, pin=17), pi.nuevo_job('Cola', (pi.Paso('Cola', 27, 60, 15.0, 0.25),), 15.0)
+    pi.pedidos.admitir_lote([ron, cola], pi.pedidos_queue)
+    version = pi.config_store.version
+
+    sin_cola = json.loads(json.dumps(CONFIG))
+    del sin_cola['config']['pump_2']
+    sin_cola['menu'] = []
+    with pi.config_store.en_uso:  # El worker está sirviendo
+        recargar(entorno, sin_cola)
+        assert pi.config_store.pendiente and pi.config_store.version == version
+        pi.estacion.max_vasos, pi.estacion.ventana, pi.estacion.max_adelantos = 2, 8, 3
+        pi.estacion._admitir()
+        assert pi.estacion.vasos == [] and pi.pedidos_queue.qsize() == 2
+
+    pi.config_store.aplicar_pendiente()
+    assert pi.config_store.version == version + 1
+    assert 27 not in pi.load_modelo().por_pin
+    # El pedido que usaba la bomba quitada no se va a servir
+    assert cola['estado'] == pi.ESTADO_FALLIDO and 'pin 27' in cola['error']
+    assert orden_cola() == [ron['pedido_id']]
+    assert pi.inventario.reservado.get(27, 0) == 0
+
+# ============================================
+# DOS DIALECTOS DE PI.JSON
+# ============================================
+CONFIG_PY2 = {
+    "pumps": {
+        "pump_1": {"pin": 17, "name": "Bomba 1", "value": "Ron", "flow_rate": 4.0, "max_on_s": 30},
+        "pump_2": {"pin": 27, "name": "Bomba 2", "value": "Cola", "flow_rate": 4.0},
+    },
+    "recipes": {
+        "cuba": {"name": "Cuba", "ingredients": {"Ron": 40, "Cola": 60}},
+        "7": {"name": "Ron solo", "ingredients": {"Ron": 50}},
+        "fernet": {"name": "Fernet", "ingredients": {"Fernet": 50, "Cola": 150}},
+    },
+    "config": {"parallel_pour": True, "max_concurrent_pumps": 2, "vip_advantage_s": 60},
+}
+
+def cargar(directorio, config):
+    ruta = directorio / 'pi.json'
+    ruta.write_text(json.dumps(config), encoding='utf-8')
+    return pi.ConfigStore(str(ruta))
+
+def test_los_dos_dialectos_dan_el_mismo_modelo(tmp_path):
+    propio = cargar(tmp_path, CONFIG).modelo()
+    py2 = cargar(tmp_path, CONFIG_PY2).modelo()
+    bombas = lambda modelo: {b.pin: (b.label, b.flow_rate) for b in modelo.bombas.values()}
+    assert bombas(py2) == bombas(propio) == {17: ("Ron", 4.0), 27: ("Cola", 4.0)}
+    assert py2.bombas['pump_1'].max_encendida_s == 30
+    ingredientes = lambda receta: [(i.bomba.pin, i.ml) for i in receta.ingredientes]
+    cuba = py2.recetas[py2.por_clave['cuba']]
+    assert ingredientes(cuba) == ingredientes(propio.recetas[1]) == [(17, 40), (27, 60)]
+    # Los ids de texto reciben un id libre; los numéricos se conservan
+    assert py2.por_clave['7'] == 7 and py2.por_clave['cuba'] > 7
+
+def test_dialecto_py2_traduce_las_opciones(tmp_path):
+    config = cargar(tmp_path, CONFIG_PY2).get()
+    assert config['preparacion'] == {"modo": pi.MODO_PARALELO, "max_bombas_simultaneas": 2}
+    assert config['planificacion'] == {"ventaja_vip_s": 60}
+
+def test_dialecto_py2_ingrediente_sin_bomba_solo_anula_su_receta(tmp_path):
+    modelo = cargar(tmp_path, CONFIG_PY2).modelo()
+    fernet = modelo.por_clave['fernet']
+    assert fernet not in modelo.recetas
+    assert modelo.no_disponibles[fernet] == "Ingrediente 'Fernet' no disponible en ninguna bomba"
+    assert len(modelo.recetas) == 2
+
+def test_dialecto_py2_invalido_se_rechaza(tmp_path):
+    roto = json.loads(json.dumps(CONFIG_PY2))
+    roto['pumps']['pump_2']['pin'] = 17
+    store = cargar(tmp_path, roto)
+    assert store.modelo() is None
+    assert 'pin 17 ya lo usa pump_1' in store.ultimo_error
+
+@pytest.mark.parametrize('recipe_id, status', [("cuba", 200), (7, 200), ("7", 200), ("fernet", 400), ("mojito", 400)])
+def test_hacer_trago_con_config_py2(entorno, monkeypatch, recipe_id, status):
+    monkeypatch.setattr(pi, 'config_store', cargar(entorno, CONFIG_PY2))
+    monkeypatch.setattr(pi, 'plan_index', pi.PlanIndex())
+    pi.inventario.configurar(pi.load_modelo())
+    respuesta = pi.app.test_client().post('/hacer_trago', json={"recipe_id": recipe_id})
+    assert respuesta.status_code == status
+    assert pi.pedidos_queue.qsize() == (status == 200)